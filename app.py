@@ -1,136 +1,82 @@
-from flask import Flask, render_template, render_template_string, request, redirect, url_for, flash, session
-from functools import wraps
-from flask import send_file
-from data_access import hent_udlaan_med_brugernavn_og_bogtitel
+from flask import Flask, render_template, request, redirect, url_for, flash, session
+from functools import wraps, lru_cache
+from flask import send_from_directory, jsonify, Response
+from werkzeug.http import is_resource_modified
 import os
+import csv
+import io
+import operator
+import zlib
+import hashlib
 import datetime
+import time
+import hmac
+import threading
 import data_access as db
+import forfald
+import metrikker
+import profilering
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'skift_denne_til_en_stærk_nøgle')
+# Statiske filer linkes med versionsparameter, så de kan caches længe
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 365 * 24 * 3600
+
+UDLAAN_BESKEDER = {
+    db.UDLAAN_OK: "Udlån registreret",
+    db.UKENDT_BRUGER: "Bruger ikke fundet",
+    db.UKENDT_BOG: "Bog ikke fundet",
+    db.ALLEREDE_UDLAANT: "Bog er allerede udlånt",
+}
+
+# Baggrundstrådene startes ved første forespørgsel i hver proces, ikke ved
+# import, så hverken værktøjer, der importerer appen, eller Gunicorns master
+# med --preload starter tråde, der ikke skal bruges
+_baggrund_laas = threading.Lock()
+_baggrund_startet = False
+
+def _efter_fork():
+    global _baggrund_laas, _baggrund_startet
+    _baggrund_laas = threading.Lock()
+    _baggrund_startet = False
+
+os.register_at_fork(after_in_child=_efter_fork)
+
+@app.before_request
+def _start_baggrund():
+    global _baggrund_startet
+    if _baggrund_startet:
+        return
+    with _baggrund_laas:
+        if _baggrund_startet:
+            return
+        _baggrund_startet = True
+        db.start_komprimering(int(os.environ.get('UDLAAN_KOMPRIMERING_SEK', '300')))
+        # Daglige rapporter over overskredne udlån og påmindelser; se forfald.py
+        if os.environ.get('BIBLIOTEK_FORFALDSRAPPORTER', '1') != '0':
+            forfald.start()
+
+@app.before_request
+def _start_maaling():
+    request.environ['bibliotek.start'] = time.perf_counter()
+    metrikker.start_forespoergsel()
+
+@app.after_request
+def _slut_maaling(response):
+    start = request.environ.get('bibliotek.start')
+    if start is not None:
+        metrikker.slut_forespoergsel(request.endpoint or 'ukendt', request.method,
+                                     str(response.status_code), time.perf_counter() - start)
+    return response
+
+def _er_admin(environ):
+    with app.request_context(environ):
+        return bool(session.get('admin_logged_in'))
+
+# Profilering på forespørgsel; se profilering.py
+if profilering.PROFILERING:
+    app.wsgi_app = profilering.Profilering(app.wsgi_app, _er_admin)
 
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Bibliotek System</title>
-    <style>
-        :root {
-            --primær-bg: #f8f9f4;
-            --accent: #2a5d3b;
-            --text-color: #333;
-        }
-        body {
-            background: var(--primær-bg);
-            color: var(--text-color);
-            font-family: 'Segoe UI', sans-serif;
-            margin: 0;
-            padding: 0;
-        }
-        header {
-            background: var(--accent);
-            color: white;
-            padding: 1em;
-            display: flex;
-            align-items: center;
-            justify-content: space-between;
-        }
-        nav a {
-            color: white;
-            margin: 0 1em;
-            text-decoration: none;
-            font-weight: bold;
-        }
-        .hero {
-            padding: 2em;
-            background: #e8ede5;
-            text-align: center;
-        }
-        .container {
-            max-width: 800px;
-            margin: auto;
-            padding: 2em;
-        }
-        form {
-            background: white;
-            padding: 1em;
-            margin-bottom: 1em;
-            border-radius: 8px;
-            box-shadow: 0 0 10px rgba(0,0,0,0.05);
-        }
-        input, button {
-            padding: 0.5em;
-            margin: 0.5em 0;
-            width: 100%;
-            border: 1px solid #ccc;
-            border-radius: 4px;
-        }
-        button {
-            background: var(--accent);
-            color: white;
-            cursor: pointer;
-            font-weight: bold;
-        }
-        button:hover {
-            background: #244a31;
-        }
-        ul {
-            list-style: none;
-            padding: 0;
-        }
-        li {
-            background: #fff;
-            margin-bottom: 0.5em;
-            padding: 0.5em;
-            border-left: 4px solid var(--accent);
-        }
-        .message {
-            background: #fff3cd;
-            padding: 1em;
-            margin-bottom: 1em;
-            border-left: 4px solid #ffeeba;
-        }
-    </style>
-</head>
-<body>
-    <header>
-        <h1>📚 Bibliotek</h1>
-        <nav>
-            <a href="/udlaan-oversigt">📚 Se aktuelle udlån</a><br>
-            <a href="/admin">🔐 Gå til Adminside</a>
-        </nav>
-    </header>
-    <section class="hero">
-        <h2>Velkommen til Bibliotekssystemet</h2>
-        <p>Scan, lån og aflever – nemt og hurtigt.</p>
-    </section>
-    <div class="container">
-        <form method="POST" action="/udlaan">
-            <h3>📤 Udlån</h3>
-            Scan bruger: <input name="bruger" required><br>
-            Scan bog: <input name="bog" required><br>
-            <button type="submit">Udlån</button>
-        </form>
-
-        <form method="POST" action="/aflevering">
-            <h3>📥 Aflevering</h3>
-            Scan bog: <input name="bog" required><br>
-            <button type="submit">Aflever</button>
-        </form>
-
-        {% with messages = get_flashed_messages() %}
-          {% if messages %}
-            <div class="message">
-              {% for message in messages %}
-                <p>{{ message }}</p>
-              {% endfor %}
-            </div>
-          {% endif %}
-        {% endwith %}
-    </div>
-</body>
-</html>
-'''
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -140,21 +86,44 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated
 
+@lru_cache(maxsize=None)
+def _statisk_version(filnavn):
+    return int(os.path.getmtime(os.path.join(app.static_folder, filnavn)))
+
+@app.template_global()
+def statisk(filnavn):
+    """URL til en statisk fil med filens ændringstid som version"""
+    return url_for('static', filename=filnavn, v=_statisk_version(filnavn))
+
+_side_cache = {}
+
+def _statisk_side(skabelon):
+    """Sider uden data renderes én gang og besvares derefter med ETag/304.
+
+    Står der flash-beskeder i sessionen, renderes siden normalt, så
+    beskederne bliver vist og fjernet.
+    """
+    if session.get('_flashes'):
+        return render_template(skabelon)
+    metrikker.cache('side', skabelon in _side_cache)
+    if skabelon not in _side_cache:
+        html = render_template(skabelon)
+        _side_cache[skabelon] = (html, hashlib.sha1(html.encode('utf-8')).hexdigest())
+    html, etag = _side_cache[skabelon]
+    response = Response(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return _statisk_side('index.html')
 
 @app.route('/udlaan', methods=['POST'])
 def udlaan():
     bruger, bog = request.form['bruger'], request.form['bog']
-    if not db.find_bruger(bruger):
-        flash("Bruger ikke fundet"); return redirect(url_for('index'))
-    if not db.find_bog(bog):
-        flash("Bog ikke fundet"); return redirect(url_for('index'))
-    if db.bog_udlaant(bog):
-        flash("Bog er allerede udlånt"); return redirect(url_for('index'))
-    db.registrer_udlaan(bruger, bog)
-    flash("Udlån registreret"); return redirect(url_for('index'))
+    flash(UDLAAN_BESKEDER[db.checkout(bruger, bog)])
+    return redirect(url_for('index'))
 
 @app.route('/aflevering', methods=['POST'])
 def aflevering():
@@ -165,8 +134,40 @@ def aflevering():
         flash("Bog er ikke udlånt")
     return redirect(url_for('index'))
 
+@app.route('/scan-batch', methods=['POST'])
+def scan_batch():
+    """Udlån og afleveringer i én JSON-forespørgsel.
+
+    Forventer {"aflevering": ["BOG001", ...], "udlaan": [{"bruger": ..., "bog": ...}, ...]}.
+    Afleveringerne registreres før udlånene, så en bog kan afleveres og
+    lånes ud igen i samme batch.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(fejl="Forventede et JSON-objekt"), 400
+    afleveringer = data.get('aflevering', [])
+    udlaan = data.get('udlaan', [])
+    if (not isinstance(afleveringer, list) or not isinstance(udlaan, list)
+            or not all(isinstance(bog, str) for bog in afleveringer)
+            or not all(isinstance(u, dict) and isinstance(u.get('bruger'), str)
+                       and isinstance(u.get('bog'), str) for u in udlaan)):
+        return jsonify(fejl="'aflevering' skal være en liste af bogkoder og "
+                            "'udlaan' en liste af {bruger, bog}"), 400
+
+    afleveret = db.registrer_aflevering_batch(afleveringer) if afleveringer else []
+    udlaant = db.registrer_udlaan_batch([(u['bruger'], u['bog']) for u in udlaan]) if udlaan else []
+    return jsonify(
+        aflevering=[{'bog': bog, 'resultat': 'ok' if ok else 'ikke_udlaant'}
+                    for bog, ok in zip(afleveringer, afleveret)],
+        udlaan=[{'bruger': u['bruger'], 'bog': u['bog'], 'resultat': resultat}
+                for u, resultat in zip(udlaan, udlaant)],
+    )
+
 @app.route('/udlaan-oversigt', methods=['GET', 'POST'])
 def udlaan_oversigt():
+    if request.method == 'GET':
+        return _statisk_side('udlaan_oversigt.html')
+
     bruger = None
     udlaante = []
     fejl = None
@@ -176,120 +177,89 @@ def udlaan_oversigt():
         if not db.find_bruger(bruger):
             fejl = "Brugeren findes ikke."
         else:
-            udlaante_rå = db.hent_udlaan_for_bruger(bruger)
-            boeger = {b['kode']: b['titel'] for b in db.hent_alle_boeger()}
-            udlaante = [{
-                'bog': u['bog'],
-                'titel': boeger.get(u['bog'], 'Ukendt titel'),
-                'dato': u['dato']
-            } for u in udlaante_rå]
-
-    return render_template_string(HTML_TEMPLATE_OVERSIGT, bruger=bruger, udlaante=udlaante, fejl=fejl)
-HTML_TEMPLATE_OVERSIGT = '''
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Bibliotek Udlån Oversigt</title>
-    <style>
-        /* Samme CSS som din forside ... */
-        {{ styles }}
-    </style>
-</head>
-<body>
-    <header>
-        <h1>📚 Bibliotek</h1>
-        <nav>
-            <a href="/">🏠 Forside</a><br>
-            <a href="/admin">🔐 Admin</a>
-        </nav>
-    </header>
-    <section class="hero">
-        <h2>Se aktuelle udlån</h2>
-        <p>Indtast brugerkode for at se aktive udlån</p>
-    </section>
-    <div class="container">
-        <form method="POST">
-            Brugerkode: <input name="bruger" required><br>
-            <button type="submit">Søg</button>
-        </form>
-
-        {% if bruger %}
-            {% if fejl %}
-                <div class="message">{{ fejl }}</div>
-            {% elif udlaante %}
-                <h3>Aktive udlån for: {{ bruger }}</h3>
-                <ul>
-                {% for u in udlaante %}
-                    <li>{{ u.titel }} ({{ u.bog }}) – Udlånt: {{ u.dato[:10] }}</li>
-                {% endfor %}
-                </ul>
-            {% else %}
-                <div class="message">Ingen aktive udlån for {{ bruger }}.</div>
-            {% endif %}
-        {% endif %}
-    </div>
-</body>
-</html>
-'''.replace("{{ styles }}", HTML_TEMPLATE.split("<style>")[1].split("</style>")[0])
+            udlaante = _brugerens_udlaan(bruger)
+
+    return render_template('udlaan_oversigt.html', bruger=bruger, udlaante=udlaante, fejl=fejl)
+
+def _brugerens_udlaan(bruger):
+    udlaante = []
+    for u in db.hent_udlaan_for_bruger(bruger):
+        bog = db.hent_bog(u['bog'])
+        udlaante.append({
+            'bog': u['bog'],
+            'titel': bog['titel'] if bog else 'Ukendt titel',
+            'dato': u['dato']
+        })
+    return udlaante
+
+# JSON-API til kiosker og skærme, der spørger igen og igen. Svarene har
+# dataversionen som ETag, så et uændret If-None-Match får 304, uden at der
+# læses data.
+def _betinget_json(hent):
+    """Svar med hent()'s (data, status) som JSON, eller 304 hvis intet er skrevet siden"""
+    etag = db.hent_dataversion()  # Før data læses; se dataversion.py
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        data, status = hent()
+        response = jsonify(data)
+        response.status_code = status
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/bruger/<kode>/udlaan')
+def api_brugerens_udlaan(kode):
+    """Brugerens åbne udlån: {"bruger": kode, "udlaan": [{bog, titel, dato}]}"""
+    def hent():
+        if not db.find_bruger(kode):
+            return {'fejl': "Brugeren findes ikke"}, 404
+        return {'bruger': kode, 'udlaan': _brugerens_udlaan(kode)}, 200
+    return _betinget_json(hent)
+
+@app.route('/api/bog/<kode>/status')
+def api_bogstatus(kode):
+    """{"bog": kode, "udlaant": true/false}"""
+    def hent():
+        if not db.find_bog(kode):
+            return {'fejl': "Bogen findes ikke"}, 404
+        return {'bog': kode, 'udlaant': db.bog_udlaant(kode)}, 200
+    return _betinget_json(hent)
+
+@app.route('/api/bog/<kode>')
+def api_bog(kode):
+    """Bogen med kode, titel, forfatter, placering og udlaant"""
+    def hent():
+        bog = db.hent_bog(kode)
+        if bog is None:
+            return {'fejl': "Bogen findes ikke"}, 404
+        bog['udlaant'] = db.bog_udlaant(kode)
+        return bog, 200
+    return _betinget_json(hent)
+
+SOEG_SIDESTOERRELSE = 20
+
+def _soeg():
+    resultat = db.soeg_boeger(request.args.get('q', '').strip(),
+                              side=request.args.get('side', 1, type=int),
+                              antal=request.args.get('antal', SOEG_SIDESTOERRELSE, type=int))
+    for bog in resultat['rows']:
+        bog['udlaant'] = db.bog_udlaant(bog['kode'])
+    return resultat
+
+@app.route('/soeg')
+def soeg():
+    return render_template('soeg.html', resultat=_soeg())
+
+@app.route('/api/soeg')
+def api_soeg():
+    """Søgeresultatet som JSON. Parametre: q, side og antal."""
+    return jsonify(_soeg())
 
 @app.route('/admin')
 @admin_required
 def admin():
-    return render_template_string('''
-        <!DOCTYPE html>
-        <html lang="da">
-        <head>
-            <meta charset="UTF-8">
-            <title>Adminpanel</title>
-            <style>
-                body { font-family: sans-serif; background-color: #f0f4f8; padding: 40px; }
-                .container { max-width: 600px; margin: auto; background: white; padding: 20px; border-radius: 8px; box-shadow: 0 0 10px rgba(0,0,0,0.1); }
-                h2 { color: #2a5d3b; }
-                a.button {
-                    display: block;
-                    background-color: #2a5d3b;
-                    color: white;
-                    padding: 12px;
-                    margin: 10px 0;
-                    text-align: center;
-                    text-decoration: none;
-                    border-radius: 6px;
-                }
-                a.button:hover {
-                    background-color: #244e33;
-                }
-                .message {
-                    padding: 10px;
-                    background-color: #e3f7e0;
-                    border-left: 5px solid #2a5d3b;
-                    margin-bottom: 20px;
-                    border-radius: 4px;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h2>🔐 Adminpanel</h2>
-
-                {% with messages = get_flashed_messages() %}
-                  {% if messages %}
-                    {% for message in messages %}
-                      <div class="message">{{ message }}</div>
-                    {% endfor %}
-                  {% endif %}
-                {% endwith %}
-
-                <a href="/admin/opret-bruger" class="button">➕ Opret ny bruger</a>
-                <a href="/admin/opret-bog" class="button">📚 Opret ny bog</a>
-                <a href="/admin/oversigt" class="button">📊 Se oversigt over brugere og bøger</a>
-                <a href="/admin/download-brugere" class="button">⬇️ Download brugere</a>
-                <a href="/admin/download-boeger" class="button">⬇️ Download bøger</a>
-                <a href="/admin/download-udlaan" class="button">⬇️ Download udlån</a>
-                <a href="/admin/logout" class="button">🚪 Log ud</a>
-            </div>
-        </body>
-        </html>
-    ''')
+    return render_template('admin.html')
 
 
 @app.route('/admin/login', methods=['GET', 'POST'])
@@ -303,42 +273,7 @@ def admin_login():
             flash("Forkert brugernavn eller kodeord")
             return redirect(url_for('admin_login'))
 
-    return render_template_string('''
-        <!DOCTYPE html>
-        <html lang="da">
-        <head>
-            <meta charset="UTF-8">
-            <title>Admin Login</title>
-            <style>
-                body { font-family: sans-serif; background-color: #f0f4f8; padding: 40px; }
-                form { background-color: white; padding: 20px; max-width: 400px; margin: auto; border-radius: 8px; box-shadow: 0 0 10px rgba(0,0,0,0.1); }
-                h2 { color: #2a5d3b; }
-                label, input { display: block; width: 100%; margin-bottom: 10px; }
-                input[type="submit"] { background-color: #2a5d3b; color: white; border: none; padding: 10px; border-radius: 4px; cursor: pointer; }
-                input[type="submit"]:hover { background-color: #244e33; }
-                .message { padding: 10px; background-color: #e3f7e0; border-left: 5px solid #2a5d3b; margin-bottom: 20px; }
-            </style>
-        </head>
-        <body>
-            {% with messages = get_flashed_messages() %}
-              {% if messages %}
-                {% for message in messages %}
-                  <div class="message">{{ message }}</div>
-                {% endfor %}
-              {% endif %}
-            {% endwith %}
-
-            <form method="POST">
-                <h2>Admin Login</h2>
-                <label for="username">Brugernavn:</label>
-                <input type="text" name="username" id="username" required>
-                <label for="password">Kodeord:</label>
-                <input type="password" name="password" id="password" required>
-                <input type="submit" value="Login">
-            </form>
-        </body>
-        </html>
-    ''')
+    return render_template('admin_login.html')
 
 
 @app.route('/admin/opret-bruger', methods=['GET','POST'])
@@ -351,207 +286,175 @@ def opret_bruger():
             flash("Bruger med den kode findes allerede")
         return redirect(url_for('admin'))
 
-    return render_template_string('''
-        <html lang="da">
-        <head>
-            <meta charset="UTF-8">
-            <title>Opret Bruger</title>
-            <style>
-                body { font-family: sans-serif; background-color: #f0f4f8; padding: 40px; }
-                form { background: white; padding: 20px; max-width: 400px; margin: auto; border-radius: 8px; box-shadow: 0 0 10px rgba(0,0,0,0.1); }
-                label, input { display: block; width: 100%; margin-bottom: 10px; }
-                input[type="submit"] { background-color: #2a5d3b; color: white; padding: 10px; border: none; border-radius: 4px; cursor: pointer; }
-                input[type="submit"]:hover { background-color: #244e33; }
-            </style>
-        </head>
-        <body>
-            <form method="POST">
-                <h2>➕ Opret ny bruger</h2>
-                <label for="kode">Brugerens stregkode:</label>
-                <input type="text" name="kode" id="kode" required>
-                <label for="navn">Navn:</label>
-                <input type="text" name="navn" id="navn" required>
-                <input type="submit" value="Opret">
-            </form>
-        </body>
-        </html>
-    ''')
+    return render_template('opret_bruger.html')
 
 @app.route('/admin/opret-bog', methods=['GET','POST'])
 @admin_required
 def opret_bog():
     if request.method == 'POST':
-        if db.opret_bog(request.form['kode'], request.form['titel']):
+        if db.opret_bog(request.form['kode'], request.form['titel'],
+                        request.form.get('forfatter', ''), request.form.get('placering', '')):
             flash("Bog oprettet")
         else:
             flash("Bog med den kode findes allerede")
         return redirect(url_for('admin'))
 
-    return render_template_string('''
-        <html lang="da">
-        <head>
-            <meta charset="UTF-8">
-            <title>Opret Bog</title>
-            <style>
-                body { font-family: sans-serif; background-color: #f0f4f8; padding: 40px; }
-                form { background: white; padding: 20px; max-width: 400px; margin: auto; border-radius: 8px; box-shadow: 0 0 10px rgba(0,0,0,0.1); }
-                label, input { display: block; width: 100%; margin-bottom: 10px; }
-                input[type="submit"] { background-color: #2a5d3b; color: white; padding: 10px; border: none; border-radius: 4px; cursor: pointer; }
-                input[type="submit"]:hover { background-color: #244e33; }
-            </style>
-        </head>
-        <body>
-            <form method="POST">
-                <h2>📚 Opret ny bog</h2>
-                <label for="kode">Bog stregkode:</label>
-                <input type="text" name="kode" id="kode" required>
-                <label for="titel">Titel:</label>
-                <input type="text" name="titel" id="titel" required>
-                <input type="submit" value="Opret">
-            </form>
-        </body>
-        </html>
-    ''')
+    return render_template('opret_bog.html')
+
+# Viser kun de første fejl; resten står i antallet
+IMPORT_VIS_FEJL = 200
+
+@app.route('/admin/importer', methods=['GET', 'POST'])
+@admin_required
+def importer():
+    """Opret brugere eller bøger fra en uploadet CSV-fil. Se db.importer_brugere()."""
+    resultat = None
+    if request.method == 'POST':
+        fil = request.files.get('fil')
+        tabel = request.form.get('tabel')
+        if not fil or tabel not in ('brugere', 'boeger'):
+            flash("Vælg en CSV-fil og om den indeholder brugere eller bøger")
+            return redirect(url_for('importer'))
+        importer_ = db.importer_brugere if tabel == 'brugere' else db.importer_boeger
+        try:
+            resultat = importer_(fil.stream)
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('importer'))
+        resultat['tabel'] = tabel
+
+    return render_template('importer.html', resultat=resultat, vis_fejl=IMPORT_VIS_FEJL)
+
+def _side_argumenter(prefix):
+    args = request.args
+    return {
+        'side': args.get(f'{prefix}_side', 1, type=int),
+        'antal': args.get(f'{prefix}_antal', OVERSIGT_SIDESTOERRELSE, type=int),
+        'sorter': args.get(f'{prefix}_sorter'),
+        'faldende': args.get(f'{prefix}_faldende') == '1',
+        'soeg': args.get(f'{prefix}_soeg', '').strip(),
+    }
+
+def _side_url(**aendringer):
+    """URL til oversigten med de nuværende parametre, ændret som angivet"""
+    args = request.args.to_dict()
+    args.update(aendringer)
+    return url_for('admin_oversigt', **{k: v for k, v in args.items() if v not in (None, '')})
+
+OVERSIGT_SIDESTOERRELSE = 50
 
 @app.route('/admin/oversigt')
 @admin_required
 def admin_oversigt():
-    brugere = db.hent_alle_brugere()
-    boeger_liste = db.hent_alle_boeger()
-    udlaan = db.hent_alle_udlaan()
-
-    brugere_dict = {b['kode'].strip(): b['navn'] for b in brugere}
-    boeger_dict = {bog['kode'].strip(): bog for bog in boeger_liste}
-
-    for u in udlaan:
-        bogkode = u['bog'].strip()
-        bog = boeger_dict.get(bogkode)
-        if bog:
-            u['titel'] = bog.get('titel', 'Ukendt titel')
-        else:
-            u['titel'] = 'Ukendt titel'
-        u['brugernavn'] = brugere_dict.get(u['bruger'].strip(), 'Ukendt bruger')
-
-    return render_template_string('''
-<!DOCTYPE html>
-<html lang="da">
-<head>
-    <meta charset="UTF-8">
-    <title>Adminoversigt</title>
-    <style>
-        body { font-family: sans-serif; padding: 20px; background-color: #f9f9f9; }
-        table { border-collapse: collapse; width: 100%; margin-bottom: 40px; cursor: default; }
-        th, td { border: 1px solid #ccc; padding: 8px; text-align: left; }
-        th { background-color: #2a5d3b; color: white; cursor: pointer; }
-        h2 { color: #2a5d3b; }
-        a { display: inline-block; margin-bottom: 20px; color: #2a5d3b; text-decoration: none; }
-        input[type="text"] { width: 100%; padding: 8px; margin-bottom: 10px; border: 1px solid #ccc; border-radius: 4px; }
-        label { display: block; margin-bottom: 10px; }
-    </style>
-    <script>
-        function filterTable(inputId, tableId, showOnlyActive = false) {
-            const input = document.getElementById(inputId).value.toLowerCase();
-            const rows = document.querySelectorAll(`#${tableId} tbody tr`);
-            rows.forEach(row => {
-                const text = row.textContent.toLowerCase();
-                const isActive = row.dataset.afleveret === "nej";
-                const match = text.includes(input);
-                row.style.display = (match && (!showOnlyActive || isActive)) ? '' : 'none';
-            });
-        }
-
-        function toggleActiveOnly() {
-            filterTable('udlaanSearch', 'udlaantabel', document.getElementById('activeOnly').checked);
-        }
-
-        function sortTable(tableId, colIndex) {
-            const table = document.getElementById(tableId);
-            const tbody = table.tBodies[0];
-            const rows = Array.from(tbody.rows);
-            const ascending = table.dataset.sortAsc === "true" ? false : true;
-            rows.sort((a, b) => {
-                const valA = a.cells[colIndex].innerText.toLowerCase();
-                const valB = b.cells[colIndex].innerText.toLowerCase();
-                return ascending ? valA.localeCompare(valB) : valB.localeCompare(valA);
-            });
-            rows.forEach(row => tbody.appendChild(row));
-            table.dataset.sortAsc = ascending;
-        }
-    </script>
-</head>
-<body>
-    <h1>📊 Adminoversigt</h1>
-    <a href="/admin">⬅️ Tilbage til adminside</a>
-
-    <h2>Brugere</h2>
-    <input type="text" id="brugerSearch" placeholder="🔍 Søg brugere..." onkeyup="filterTable('brugerSearch', 'brugertabel')">
-    <table id="brugertabel" data-sort-asc="true">
-        <thead>
-            <tr>
-                <th onclick="sortTable('brugertabel', 0)">Stregkode</th>
-                <th onclick="sortTable('brugertabel', 1)">Navn</th>
-            </tr>
-        </thead>
-        <tbody>
-        {% for b in brugere %}
-            <tr><td>{{ b['kode'] }}</td><td>{{ b['navn'] }}</td></tr>
-        {% endfor %}
-        </tbody>
-    </table>
-
-<h2>Bøger</h2>
-<input type="text" id="bogSearch" placeholder="🔍 Søg bøger..." onkeyup="filterTable('bogSearch', 'bogtabel')">
-<table id="bogtabel" data-sort-asc="true">
-    <thead>
-        <tr>
-            <th onclick="sortTable('bogtabel', 0)">Stregkode</th>
-            <th onclick="sortTable('bogtabel', 1)">Titel</th>
-            <th onclick="sortTable('bogtabel', 2)">Forfatter</th>
-            <th onclick="sortTable('bogtabel', 3)">Placering</th>
-        </tr>
-    </thead>
-    <tbody>
-    {% for bog in boeger %}
-        <tr>
-            <td>{{ bog['kode'] }}</td>
-            <td>{{ bog['titel'] }}</td>
-            <td>{{ bog.get('forfatter', '') }}</td>
-            <td>{{ bog.get('placering', '') }}</td>
-        </tr>
-    {% endfor %}
-    </tbody>
-</table>
-
-    <h2>Udlån</h2>
-    <input type="text" id="udlaanSearch" placeholder="🔍 Søg udlån (bruger/bog/titel)..." onkeyup="toggleActiveOnly()">
-    <label><input type="checkbox" id="activeOnly" onchange="toggleActiveOnly()"> Vis kun aktive udlån</label>
-    <table id="udlaantabel" data-sort-asc="true">
-
-        <thead>
-            <tr>
-                <th onclick="sortTable('udlaantabel', 0)">Bruger</th>
-                <th onclick="sortTable('udlaantabel', 1)">Bog</th>
-                <th onclick="sortTable('udlaantabel', 2)">Titel</th>
-                <th onclick="sortTable('udlaantabel', 3)">Udlånsdato</th>
-                <th onclick="sortTable('udlaantabel', 4)">Afleveret</th>
-            </tr>
-        </thead>
-        <tbody>
-        {% for u in udlaan %}
-            <tr data-afleveret="{{ 'nej' if not u['afleveret'] else 'ja' }}">
-                <td>{{ u['brugernavn'] }}</td>
-                <td>{{ u['bog'] }}</td>
-                <td>{{ u['titel'] }}</td>
-                <td>{{ u['dato'] }}</td>
-                <td>{{ u['afleveret'] if u['afleveret'] else 'Nej' }}</td>
-            </tr>
-        {% endfor %}
-        </tbody>
-    </table>
-</body>
-</html>
-''', brugere=brugere, boeger=boeger_liste, udlaan=udlaan)
+    brugere = db.hent_side('brugere', **_side_argumenter('bruger'))
+    boeger = db.hent_side('boeger', **_side_argumenter('bog'))
+    # Arkiverede udlån læses kun for de måneder, perioden dækker
+    try:
+        fra, til = _dato_arg('udlaan_fra'), _dato_arg('udlaan_til')
+    except ValueError:
+        fra = til = None
+    udlaan = db.hent_side('udlaan', kun_aktive=request.args.get('udlaan_aktive') == '1',
+                          fra=fra, til=til, **_side_argumenter('udlaan'))
+
+    return render_template('admin_oversigt.html', brugere=brugere, boeger=boeger, udlaan=udlaan, side_url=_side_url)
+
+HAENDELSER_PING_SEK = 15
+HAENDELSER_MAKS_SEK = 300
+
+@app.route('/admin/haendelser')
+@admin_required
+def admin_haendelser():
+    """Skrivningerne som Server-Sent Events til oversigten; se db.abonner_haendelser().
+
+    Forbindelsen lukkes efter HAENDELSER_MAKS_SEK, og browseren kobler til
+    igen med Last-Event-ID og får det, den har misset. Hver forbindelse
+    holder en tråd, så serveren skal køre med tråde (eller gevent).
+    """
+    sidste_id = request.headers.get('Last-Event-ID')
+
+    def stream():
+        # Abonnér først, når svaret sendes, så afmeld() altid bliver kaldt
+        abonnent = db.abonner_haendelser(sidste_id)
+        try:
+            yield 'retry: 3000\n\n'
+            slut = time.monotonic() + HAENDELSER_MAKS_SEK
+            while time.monotonic() < slut:
+                nye = abonnent.hent(min(HAENDELSER_PING_SEK, slut - time.monotonic()))
+                # En kommentar holder forbindelsen i live gennem proxyer
+                yield ''.join(f'id: {id}\nevent: {navn}\ndata: {data}\n\n'
+                              for id, navn, data in nye) or ': ping\n\n'
+        finally:
+            abonnent.afmeld()
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx må ikke samle svaret op
+    return response
+
+
+def _statistik():
+    return db.hent_statistik(dage=request.args.get('dage', 30, type=int),
+                             top=request.args.get('top', 10, type=int))
+
+@app.route('/admin/statistik')
+@admin_required
+def statistik():
+    s = _statistik()
+    return render_template('statistik.html', s=s,
+                           maks_pr_dag=max([d['antal'] for d in s['pr_dag']] + [1]))
 
+@app.route('/admin/statistik.json')
+@admin_required
+def statistik_json():
+    """Statistikken som JSON. Parametre: dage og top."""
+    return jsonify(_statistik())
+
+
+FORFALD_VIS = 200
+
+@app.route('/admin/forfald')
+@admin_required
+def admin_forfald():
+    """Overskredne udlån, udlån der forfalder snart, og de daglige rapporter"""
+    return render_template('forfald.html', overskredne=db.hent_overskredne(FORFALD_VIS),
+                           snart=db.hent_forfalder_snart(forfald.PAAMINDELSE_DAGE, FORFALD_VIS),
+                           dage=forfald.PAAMINDELSE_DAGE, vis=FORFALD_VIS,
+                           rapporter=forfald.rapporter())
+
+@app.route('/admin/forfald/<navn>')
+@admin_required
+def download_rapport(navn):
+    return send_from_directory(os.path.abspath(forfald.RAPPORTMAPPE), navn,
+                               mimetype='text/csv', as_attachment=True)
+
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.route('/metrics')
+def metrics():
+    """Metrikker i Prometheus-format.
+
+    Kræver admin-login eller, hvis METRICS_TOKEN er sat, headeren
+    'Authorization: Bearer <token>', så Prometheus kan hente dem.
+    """
+    auth = request.headers.get('Authorization', '')
+    token_ok = METRICS_TOKEN and hmac.compare_digest(auth, f'Bearer {METRICS_TOKEN}')
+    if not token_ok and not session.get('admin_logged_in'):
+        return "Kræver admin-login eller METRICS_TOKEN", 401
+    return Response(metrikker.prometheus_tekst(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiler')
+@admin_required
+def admin_profiler():
+    """De gemte profiler; profilér en forespørgsel med headeren X-Profil eller ?profil="""
+    return render_template('profiler.html', profiler=profilering.profiler(),
+                           andel=profilering.PROFIL_ANDEL)
+
+@app.route('/admin/profiler/<navn>')
+@admin_required
+def download_profil(navn):
+    return send_from_directory(os.path.abspath(profilering.PROFILMAPPE), navn,
+                               mimetype='text/plain', as_attachment=True)
 
 @app.route('/admin/logout')
 def admin_logout():
@@ -559,10 +462,96 @@ def admin_logout():
     flash("Du er nu logget ud")
     return redirect(url_for('index'))
 
+def _csv_bytes(felter, rows, komprimer):
+    """Generér CSV-filen i bidder, eventuelt gzip-komprimeret"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # Felterne hentes med itemgetter i stedet for DictWriter, der slår op
+    # i Python for hvert felt
+    felter_af = operator.itemgetter(*felter)
+    # wbits=31 giver gzip-format uden tidsstempel, så output er ens hver gang
+    gzip = zlib.compressobj(wbits=31) if komprimer else None
+
+    def tag():
+        data = buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+        return gzip.compress(data) if gzip else data
+
+    writer.writerow(felter)
+    for row in rows:
+        writer.writerow(felter_af(row))
+        if buf.tell() >= 64 * 1024:
+            yield tag()
+    yield tag()
+    if gzip:
+        yield gzip.flush()
+
+# Den samlede længde pr. ETag, så et Range-svar (et genoptaget download)
+# ikke genererer hele filen igen for hver forespørgsel
+_eksport_laengder = {}
+EKSPORT_LAENGDER_MAKS = 64
+
+def _csv_eksport(navn, felter, tabeller, hent_rows):
+    """Stream en CSV-eksport med ETag, Last-Modified og Range.
+
+    ETag'en bygger på tabellernes versioner og forespørgslens parametre, så
+    et uændret download kan besvares med 304 uden at læse data.
+    """
+    komprimer = request.args.get('gzip') == '1'
+    versioner = [db.tabel_version(tabel) for tabel in tabeller]
+    noegle = repr((navn, sorted(request.args.items(multi=True)), [v for v, _ in versioner]))
+    etag = hashlib.sha1(noegle.encode('utf-8')).hexdigest()
+    filnavn = f'{navn}.csv.gz' if komprimer else f'{navn}.csv'
+
+    response = Response(
+        mimetype='application/gzip' if komprimer else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filnavn}'},
+    )
+    response.set_etag(etag)
+    response.last_modified = max(aendret for _, aendret in versioner) or None
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    # Samme kontrol som make_conditional(), men før data hentes
+    if not is_resource_modified(request.environ, response.headers.get('ETag'), None,
+                                response.headers.get('Last-Modified')):
+        return response.make_conditional(request)
+
+    response.response = _csv_bytes(felter, hent_rows(), komprimer)
+    laengde = None
+    if 'Range' in request.headers:
+        laengde = _eksport_laengder.get(etag)
+        if laengde is None:
+            laengde = sum(len(bid) for bid in _csv_bytes(felter, hent_rows(), komprimer))
+            if len(_eksport_laengder) >= EKSPORT_LAENGDER_MAKS:
+                _eksport_laengder.clear()
+            _eksport_laengder[etag] = laengde
+    return response.make_conditional(request, accept_ranges=True, complete_length=laengde)
+
+def _dato_arg(navn):
+    vaerdi = request.args.get(navn)
+    return datetime.date.fromisoformat(vaerdi) if vaerdi else None
+
 @app.route('/admin/download-udlaan')
 @admin_required
 def download_udlaan():
-    return send_file('data/udlaan.csv', as_attachment=True)
+    """Udlån som CSV.
+
+    Parametre: fra/til (ÅÅÅÅ-MM-DD, udlånsdato), aktive=1 (kun ikke-afleverede),
+    beriget=1 (med brugernavn og titel) og gzip=1.
+    """
+    try:
+        fra, til = _dato_arg('fra'), _dato_arg('til')
+    except ValueError:
+        return "Datoer skal skrives som ÅÅÅÅ-MM-DD", 400
+    kun_aktive = request.args.get('aktive') == '1'
+    beriget = request.args.get('beriget') == '1'
+    if beriget:
+        felter, tabeller = db.BERIGET_UDLAAN_FELTER, ['udlaan', 'brugere', 'boeger']
+    else:
+        felter, tabeller = db.EKSPORT_FELTER['udlaan'], ['udlaan']
+    return _csv_eksport('udlaan', felter, tabeller,
+                        lambda: db.eksporter_rows('udlaan', fra, til, kun_aktive, beriget))
 
 @app.route('/admin/slet-bruger/<kode>', methods=['POST'])
 @admin_required
@@ -583,12 +572,14 @@ def slet_bog(kode):
 @app.route('/admin/download-brugere')
 @admin_required
 def download_brugere():
-    return send_file('data/brugere.csv', as_attachment=True)
+    return _csv_eksport('brugere', db.EKSPORT_FELTER['brugere'], ['brugere'],
+                        lambda: db.eksporter_rows('brugere'))
 
 @app.route('/admin/download-boeger')
 @admin_required
 def download_boeger():
-    return send_file('data/boeger.csv', as_attachment=True)
+    return _csv_eksport('boeger', db.EKSPORT_FELTER['boeger'], ['boeger'],
+                        lambda: db.eksporter_rows('boeger'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,14 @@
+"""Målinger af bibliotekets ydelse.
+
+Modulerne køres med python -m benchmark.<modul> fra projektets rod og
+arbejder på en kopi af data/ eller på genererede data, så de rigtige filer
+ikke ændres:
+
+- suite: data_access og ruterne ved 1k-1M udlån, JSON med p50/p95/p99
+- testdata: syntetiske brugere, bøger og udlån
+- skabeloner: renderingstid og svarstørrelse pr. side
+- hukommelse: RSS og peak pr. worker efter indlæsning af tabellerne
+- opstart: koldstart fra en ny worker til første svar, med og uden binære kopier
+- belastning: mange kiosker på én gang mod en rigtig WSGI-server, med
+  kontrol af data bagefter
+"""
@@ -0,0 +1,413 @@
+"""Belastningstest: mange kiosker, der scanner på én gang mod en rigtig WSGI-server.
+
+Kør fra projektets rod:
+
+    python -m benchmark.belastning [--kiosker 30] [--sek 30] [--udlaan 100000]
+        [--server gunicorn --workers 4 --traade 8] [--backend csv] [--json]
+
+Testdata genereres (benchmark.testdata) i en midlertidig mappe, og appen
+startes i en egen proces under Gunicorn (hvis det er installeret) eller
+Werkzeugs server med tråde. Kioskerne er tråde fordelt på et par
+klientprocesser, med hver sin forbindelse; de skifter mellem handlingerne i
+BLANDING efter vægt uden pause imellem (medmindre --pause-ms angives):
+
+- udlaan: POST /scan-batch med ét udlån af en bog blandt --boeger bøger, så
+  kioskerne ofte scanner de samme bøger på samme tid.
+- aflevering: POST /scan-batch med en bog, kiosken selv har lånt ud.
+- oversigt: POST /udlaan-oversigt for en bruger.
+- status: GET /api/bog/<kode>/status.
+- admin: GET /admin/oversigt med de aktive udlån, logget ind.
+
+Rapporten viser forespørgsler pr. sekund, percentiler og fejl pr.
+handling. Fejl er svar med status 500 eller derover, mistede forbindelser
+og afleveringer af kioskens egne udlån, der ikke lykkes. Efter kørslen
+stoppes serveren, og data kontrolleres:
+
+- ingen mistede udlån: alle udlån fra før plus de lykkede udlån findes, og
+  antallet af åbne passer med de lykkede udlån og afleveringer;
+- hvert udlån, en kiosk stadig har ude, er åbent for den rigtige bruger;
+- ingen bog har to åbne udlån;
+- ingen afkortede filer: CSV-filerne og journalen har overskrift og det
+  rigtige antal felter i hver linje og slutter med et linjeskift (SQLite:
+  PRAGMA quick_check).
+
+Programmet afslutter med kode 1, hvis der er fejl, eller en kontrol fejler.
+"""
+import argparse
+import csv
+import glob
+import http.client
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+
+from benchmark import testdata
+from benchmark.suite import _percentiler
+
+BLANDING = {'udlaan': 35, 'aflevering': 25, 'oversigt': 15, 'status': 15, 'admin': 10}
+SERVERE = ['gunicorn', 'werkzeug']
+START_SEK = 120
+STOP_SEK = 30
+
+# Serveren under Werkzeug; Gunicorn startes med sit eget program
+_WERKZEUG = '''
+import logging
+import sys
+from werkzeug.serving import run_simple
+from app import app
+logging.getLogger('werkzeug').setLevel(logging.WARNING)  # Ingen linje pr. forespørgsel
+run_simple('127.0.0.1', int(sys.argv[1]), app, threaded=True)
+'''
+
+
+def kontrol(mappe, kilde, backend):
+    """Optælling af udlånene i mappe og kontrol af filerne. Køres i sin egen proces."""
+    os.chdir(mappe)
+    sys.path.insert(0, kilde)
+    os.environ['BIBLIOTEK_BACKEND'] = backend
+    import data_access as db
+    udlaan = db.hent_alle_udlaan()
+    aabne = Counter(u['bog'] for u in udlaan if not u['afleveret'])
+    resultat = {
+        'udlaan': len(udlaan),
+        'aabne': sum(aabne.values()),
+        'aabne_pr_bog': {u['bog']: u['bruger'] for u in udlaan if not u['afleveret']},
+        'dobbelt_udlaant': sorted(bog for bog, n in aabne.items() if n > 1),
+        'filfejl': [],
+    }
+    if backend == 'sqlite':
+        import sqlite3
+        import sqlite_backend
+        with sqlite3.connect(sqlite_backend.DATABASEFIL) as con:
+            svar = [r[0] for r in con.execute('PRAGMA quick_check')]
+        if svar != ['ok']:
+            resultat['filfejl'].append(f'{sqlite_backend.DATABASEFIL}: {"; ".join(svar)}')
+        return resultat
+    import csv_backend
+    filer = {sti: None for sti in glob.glob(os.path.join('data', '**', '*.csv'), recursive=True)}
+    if os.path.exists(csv_backend.UDLAANJOURNAL):
+        # Journalen har ingen overskrift. Forfaldsdatoen står kun på udlån, så
+        # afleveringer og udlån fra før den har et felt mindre.
+        antal = len(csv_backend.JOURNAL_FELTER)
+        filer[csv_backend.UDLAANJOURNAL] = {antal - 1, antal}
+    for sti, felter in sorted(filer.items()):
+        with open(sti, encoding='utf-8', newline='') as f:
+            tekst = f.read()
+        if tekst and not tekst.endswith('\n'):
+            resultat['filfejl'].append(f'{sti}: slutter midt i en linje')
+        linjer = list(csv.reader(tekst.splitlines()))
+        foerste = 1
+        if felter is None:
+            if not linjer:
+                resultat['filfejl'].append(f'{sti}: tom, uden overskrift')
+                continue
+            felter = {len(linjer.pop(0))}
+            foerste = 2
+        forkerte = [nr for nr, linje in enumerate(linjer, foerste) if len(linje) not in felter]
+        if forkerte:
+            resultat['filfejl'].append(f'{sti}: {len(forkerte)} linjer med forkert antal felter '
+                                       f'(første: linje {forkerte[0]})')
+    return resultat
+
+
+def _fri_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start_server(args, mappe, kilde, port):
+    env = dict(os.environ, BIBLIOTEK_BACKEND=args.backend, PYTHONPATH=kilde,
+               UDLAAN_KOMPRIMERING_SEK=str(args.komprimering_sek))
+    if args.server == 'gunicorn':
+        kommando = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+                    '--workers', str(args.workers), '--threads', str(args.traade),
+                    '--log-level', 'warning', 'app:app']
+    else:
+        kommando = [sys.executable, '-c', _WERKZEUG, str(port)]
+    server = subprocess.Popen(kommando, cwd=mappe, env=env)
+    # Første svar indlæser tabellerne, så vent på det, før uret startes
+    slut = time.monotonic() + START_SEK
+    while True:
+        if server.poll() is not None:
+            raise SystemExit(f'Serveren stoppede med kode {server.returncode}')
+        try:
+            forbindelse = http.client.HTTPConnection('127.0.0.1', port, timeout=START_SEK)
+            forbindelse.request('GET', '/api/bog/findes-ikke/status')
+            forbindelse.getresponse().read()
+            forbindelse.close()
+            return server
+        except OSError:
+            if time.monotonic() > slut:
+                server.kill()
+                raise SystemExit('Serveren svarede ikke')
+            time.sleep(0.2)
+
+
+def _stop_server(server, navn):
+    # Werkzeug stopper pænt på SIGINT og Gunicorn på SIGTERM
+    server.send_signal(signal.SIGTERM if navn == 'gunicorn' else signal.SIGINT)
+    try:
+        server.wait(STOP_SEK)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+class _Kiosk:
+    """En kiosk med sin egen forbindelse og de udlån, den har registreret"""
+
+    def __init__(self, nr, port, brugere, boeger, blanding, admin_cookie, seed):
+        self.port = port
+        self.brugere = brugere
+        self.boeger = boeger
+        self.handlinger = list(blanding)
+        self.vaegte = list(blanding.values())
+        self.admin_cookie = admin_cookie
+        self.rnd = random.Random(seed * 1000 + nr)
+        self.forbindelse = None
+        self.ude = {}  # bog -> bruger for kioskens åbne udlån
+        self.tider = {navn: [] for navn in blanding}
+        self.fejl = Counter()
+        self.udlaant = 0
+        self.afleveret = 0
+
+    def _kald(self, metode, url, krop=None, headers=None):
+        """(status, svar); ved en mistet forbindelse oprettes en ny ved næste kald"""
+        if self.forbindelse is None:
+            self.forbindelse = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            self.forbindelse.request(metode, url, krop, headers or {})
+            svar = self.forbindelse.getresponse()
+            return svar.status, svar.read()
+        except (OSError, http.client.HTTPException):
+            self.forbindelse.close()
+            self.forbindelse = None
+            return None, b''
+
+    def _scan(self, data):
+        status, svar = self._kald('POST', '/scan-batch', json.dumps(data),
+                                  {'Content-Type': 'application/json'})
+        return status, json.loads(svar) if status == 200 else None
+
+    def udlaan(self):
+        bruger, bog = self.rnd.choice(self.brugere), self.rnd.choice(self.boeger)
+        status, svar = self._scan({'udlaan': [{'bruger': bruger, 'bog': bog}]})
+        if svar and svar['udlaan'][0]['resultat'] == 'ok':
+            self.ude[bog] = bruger
+            self.udlaant += 1
+        return status
+
+    def aflevering(self):
+        bog = self.rnd.choice(list(self.ude))
+        status, svar = self._scan({'aflevering': [bog]})
+        if svar and svar['aflevering'][0]['resultat'] == 'ok':
+            del self.ude[bog]
+            self.afleveret += 1
+        elif svar:
+            self.fejl['aflevering: bogen var ikke udlånt'] += 1
+        return status
+
+    def oversigt(self):
+        return self._kald('POST', '/udlaan-oversigt',
+                          urlencode({'bruger': self.rnd.choice(self.brugere)}),
+                          {'Content-Type': 'application/x-www-form-urlencoded'})[0]
+
+    def status(self):
+        return self._kald('GET', f'/api/bog/{self.rnd.choice(self.boeger)}/status')[0]
+
+    def admin(self):
+        return self._kald('GET', '/admin/oversigt?udlaan_aktive=1',
+                          headers={'Cookie': self.admin_cookie})[0]
+
+    def koer(self, slut, pause):
+        while time.monotonic() < slut:
+            navn = self.rnd.choices(self.handlinger, self.vaegte)[0]
+            if navn == 'aflevering' and not self.ude:
+                navn = 'udlaan'
+            start = time.perf_counter()
+            status = getattr(self, navn)()
+            self.tider[navn].append(time.perf_counter() - start)
+            if status is None:
+                self.fejl[f'{navn}: mistet forbindelse'] += 1
+            elif status >= 500:
+                self.fejl[f'{navn}: status {status}'] += 1
+            if pause:
+                time.sleep(pause)
+        if self.forbindelse is not None:
+            self.forbindelse.close()
+
+
+def klienter(numre, port, brugere, boeger, blanding, admin_cookie, seed, sek, pause):
+    """Kør kioskerne numre som tråde i sek sekunder. Køres i sin egen proces."""
+    kiosker = [_Kiosk(nr, port, brugere, boeger, blanding, admin_cookie, seed) for nr in numre]
+    slut = time.monotonic() + sek
+    traade = [threading.Thread(target=k.koer, args=(slut, pause)) for k in kiosker]
+    for t in traade:
+        t.start()
+    for t in traade:
+        t.join()
+    return [{'tider': k.tider, 'fejl': dict(k.fejl), 'ude': k.ude,
+             'udlaant': k.udlaant, 'afleveret': k.afleveret} for k in kiosker]
+
+
+def _admin_cookie(port):
+    forbindelse = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    forbindelse.request('POST', '/admin/login', urlencode({'username': 'admin', 'password': 'admin'}),
+                        {'Content-Type': 'application/x-www-form-urlencoded'})
+    svar = forbindelse.getresponse()
+    svar.read()
+    forbindelse.close()
+    return svar.getheader('Set-Cookie', '').split(';')[0]
+
+
+def _koder(mappe, fil):
+    with open(os.path.join(mappe, 'data', fil), encoding='utf-8', newline='') as f:
+        return [linje[0] for linje in csv.reader(f)][1:]
+
+
+def _kontroller(foer, efter, kiosker):
+    """[(kontrol, fejl eller None)]"""
+    udlaant = sum(k['udlaant'] for k in kiosker)
+    afleveret = sum(k['afleveret'] for k in kiosker)
+    ude = {bog: bruger for k in kiosker for bog, bruger in k['ude'].items()}
+    forkerte = [bog for bog, bruger in ude.items() if efter['aabne_pr_bog'].get(bog) != bruger]
+    return [
+        ('ingen mistede udlån',
+         None if efter['udlaan'] == foer['udlaan'] + udlaant
+         else f"{efter['udlaan']} udlån, forventede {foer['udlaan']} + {udlaant}"),
+        ('åbne udlån passer',
+         None if efter['aabne'] == foer['aabne'] + udlaant - afleveret
+         else f"{efter['aabne']} åbne, forventede {foer['aabne']} + {udlaant} - {afleveret}"),
+        ('kioskernes udlån er åbne',
+         None if not forkerte else f"{len(forkerte)} bøger, f.eks. {', '.join(forkerte[:5])}"),
+        ('ingen bog udlånt to gange',
+         None if not efter['dobbelt_udlaant']
+         else f"{len(efter['dobbelt_udlaant'])} bøger, f.eks. {', '.join(efter['dobbelt_udlaant'][:5])}"),
+        ('filerne er hele', '; '.join(efter['filfejl']) or None),
+    ]
+
+
+def _blanding(tekst):
+    blanding = {}
+    for del_ in tekst.split(','):
+        navn, _, vaegt = del_.partition('=')
+        if navn not in BLANDING or not vaegt.isdigit():
+            raise argparse.ArgumentTypeError(
+                f"Forventede f.eks. udlaan=35,aflevering=25 med handlinger fra {', '.join(BLANDING)}")
+        blanding[navn] = int(vaegt)
+    return blanding
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--kiosker', type=int, default=30)
+    parser.add_argument('--sek', type=float, default=30, help='varighed (standard: 30)')
+    parser.add_argument('--udlaan', type=int, default=100000, help='udlån i testdata')
+    parser.add_argument('--boeger', type=int, default=500,
+                        help='antal bøger, kioskerne scanner blandt (standard: 500)')
+    parser.add_argument('--blanding', type=_blanding, default=BLANDING,
+                        help='vægte, f.eks. udlaan=35,aflevering=25,oversigt=15,status=15,admin=10')
+    parser.add_argument('--pause-ms', type=float, default=0, help='pause efter hver handling')
+    parser.add_argument('--server', choices=SERVERE,
+                        default='gunicorn' if importlib.util.find_spec('gunicorn') else 'werkzeug')
+    parser.add_argument('--workers', type=int, default=4, help='Gunicorn-workers (standard: 4)')
+    parser.add_argument('--traade', type=int, default=8, help='tråde pr. Gunicorn-worker')
+    parser.add_argument('--klientprocesser', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--komprimering-sek', type=int, default=10,
+                        help='UDLAAN_KOMPRIMERING_SEK for serveren (standard: 10)')
+    parser.add_argument('--kilde', default='.', help='projektmappe med app.py (standard: .)')
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='skriv resultatet som JSON')
+    args = parser.parse_args()
+    kilde = os.path.abspath(args.kilde)
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        with ctx.Pool(1) as pool:
+            antal = pool.apply(testdata.generer, (os.path.join(tmp, 'data'), args.udlaan))
+        with ctx.Pool(1) as pool:
+            foer = pool.apply(kontrol, (tmp, kilde, args.backend))
+        brugere = _koder(tmp, 'brugere.csv')
+        boeger = _koder(tmp, 'boeger.csv')[:args.boeger]
+
+        port = _fri_port()
+        server = _start_server(args, tmp, kilde, port)
+        try:
+            admin_cookie = _admin_cookie(port)
+            processer = min(args.klientprocesser, args.kiosker)
+            with ctx.Pool(processer) as pool:
+                start = time.monotonic()
+                dele = pool.starmap(klienter, [
+                    (range(i, args.kiosker, processer), port, brugere, boeger, args.blanding,
+                     admin_cookie, args.seed, args.sek, args.pause_ms / 1000)
+                    for i in range(processer)])
+                varighed = time.monotonic() - start
+        finally:
+            _stop_server(server, args.server)
+        kiosker = [k for del_ in dele for k in del_]
+
+        with ctx.Pool(1) as pool:
+            efter = pool.apply(kontrol, (tmp, kilde, args.backend))
+
+    handlinger = {}
+    for navn in args.blanding:
+        tider = [t for k in kiosker for t in k['tider'][navn]]
+        if tider:
+            handlinger[navn] = dict(_percentiler(tider), pr_sek=round(len(tider) / varighed, 1))
+    fejl = Counter()
+    for k in kiosker:
+        fejl.update(k['fejl'])
+    kontroller = _kontroller(foer, efter, kiosker)
+    forespoergsler = sum(h['n'] for h in handlinger.values())
+    resultat = {
+        'meta': {'server': args.server, 'workers': args.workers if args.server == 'gunicorn' else 1,
+                 'traade': args.traade if args.server == 'gunicorn' else None,
+                 'backend': args.backend, 'kiosker': args.kiosker, 'sek': round(varighed, 1),
+                 'boeger': len(boeger), 'data': antal},
+        'forespoergsler': forespoergsler,
+        'pr_sek': round(forespoergsler / varighed, 1),
+        'fejl': dict(fejl),
+        'fejlrate': round(sum(fejl.values()) / max(forespoergsler, 1), 4),
+        'udlaant': sum(k['udlaant'] for k in kiosker),
+        'afleveret': sum(k['afleveret'] for k in kiosker),
+        'handlinger': handlinger,
+        'kontroller': {navn: fejl_ or 'ok' for navn, fejl_ in kontroller},
+    }
+    ok = not fejl and all(fejl_ is None for _, fejl_ in kontroller)
+
+    if args.json:
+        print(json.dumps(resultat, indent=2, ensure_ascii=False))
+        return 0 if ok else 1
+    m = resultat['meta']
+    print(f"{m['kiosker']} kiosker i {m['sek']} s mod {m['server']} "
+          f"({m['workers']} workers, {args.backend}); {args.udlaan} udlån, {len(boeger)} bøger i omløb")
+    print(f"{forespoergsler} forespørgsler, {resultat['pr_sek']}/s, "
+          f"{resultat['udlaant']} udlån og {resultat['afleveret']} afleveringer lykkedes")
+    print(f"{'handling':12} {'antal':>8} {'pr. s':>8} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'maks ms':>9}")
+    for navn, h in handlinger.items():
+        print(f"{navn:12} {h['n']:>8} {h['pr_sek']:>8.1f} {h['p50_ms']:>9.2f} {h['p95_ms']:>9.2f} "
+              f"{h['p99_ms']:>9.2f} {h['maks_ms']:>9.2f}")
+    print(f"Fejl: {sum(fejl.values())} ({resultat['fejlrate']:.2%})")
+    for navn, n in fejl.most_common():
+        print(f'  {navn}: {n}')
+    for navn, fejl_ in kontroller:
+        print(f"{'OK  ' if fejl_ is None else 'FEJL'} {navn}{'' if fejl_ is None else ': ' + fejl_}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Hukommelse pr. worker, når tabellerne er indlæst.
+
+Kør fra projektets rod:
+
+    python -m benchmark.hukommelse [--udlaan 1000000] [--kilde STI] [--backend csv]
+
+Testdata genereres (benchmark.testdata) i en midlertidig mappe, og
+målingen køres i en ny proces, der importerer data_access og indlæser
+brugere, bøger og udlån, som en worker gør ved første forespørgsel. RSS er
+den nuværende hukommelse og peak den højeste undervejs (ru_maxrss).
+--kilde peger på et andet checkout af projektet, så før og efter kan
+måles med samme script.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from benchmark import testdata
+
+
+def _rss_mb():
+    with open('/proc/self/statm') as f:
+        sider = int(f.read().split()[1])
+    return round(sider * os.sysconf('SC_PAGE_SIZE') / 2**20, 1)
+
+
+def _peak_mb():
+    # ru_maxrss er i KiB på Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def maal(mappe, kilde, backend):
+    """Indlæs tabellerne i mappe med koden i kilde. Køres i sin egen proces."""
+    os.chdir(mappe)
+    sys.path.insert(0, kilde)
+    os.environ['BIBLIOTEK_BACKEND'] = backend
+    import data_access as db
+    resultat = {'import': {'rss_mb': _rss_mb(), 'peak_mb': _peak_mb()}}
+
+    start = time.perf_counter()
+    db.find_bruger('')
+    db.find_bog('')
+    db.bog_udlaant('')
+    resultat['indlaest'] = {'rss_mb': _rss_mb(), 'peak_mb': _peak_mb(),
+                            'sek': round(time.perf_counter() - start, 2)}
+    # En side af oversigten over alle udlån; den holder en sorteret liste
+    db.hent_side('udlaan', sorter='dato')
+    resultat['oversigt'] = {'rss_mb': _rss_mb(), 'peak_mb': _peak_mb()}
+    return resultat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--udlaan', type=int, default=1000000)
+    parser.add_argument('--kilde', default='.', help='projektmappe med data_access.py (standard: .)')
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--json', action='store_true', help='skriv resultatet som JSON')
+    args = parser.parse_args()
+
+    # Data genereres og måles i hver sin nye proces ('spawn'), så målingen
+    # hverken arver generatorens hukommelse eller dens peak
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        with ctx.Pool(1) as pool:
+            antal = pool.apply(testdata.generer, (os.path.join(tmp, 'data'), args.udlaan))
+        with ctx.Pool(1) as pool:
+            resultat = pool.apply(maal, (tmp, os.path.abspath(args.kilde), args.backend))
+    resultat['data'] = antal
+
+    if args.json:
+        print(json.dumps(resultat, indent=2))
+        return
+    print(', '.join(f'{n} {navn}' for navn, n in antal.items()) + f' ({args.backend})')
+    for trin in ('import', 'indlaest', 'oversigt'):
+        r = resultat[trin]
+        print(f"{trin:10} RSS {r['rss_mb']:8.1f} MB   peak {r['peak_mb']:8.1f} MB"
+              + (f"   {r['sek']} s" if 'sek' in r else ''))
+
+
+if __name__ == '__main__':
+    main()
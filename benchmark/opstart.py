@@ -0,0 +1,93 @@
+"""Koldstart: tid fra en ny worker starter til den har svaret på første forespørgsel.
+
+Kør fra projektets rod:
+
+    python -m benchmark.opstart [--udlaan 1000000] [--gentagelser 3] [--backend csv]
+
+Testdata genereres (benchmark.testdata) i en midlertidig mappe. Hver
+måling er en ny proces, der importerer app og sender POST /udlaan-oversigt
+for en bruger med udlån, som indlæser brugere, bøger og udlån. For CSV
+måles tre tilfælde:
+
+- csv: uden binære kopier (BIBLIOTEK_BINAERE_KOPIER=0); CSV-filerne parses.
+- binaer_foerste: kopierne findes ikke endnu; CSV parses, og kopierne skrives.
+- binaer: kopierne findes og passer.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from benchmark import testdata
+
+
+def maal(mappe, kilde, backend, binaer):
+    """Importér app og svar på første forespørgsel. Køres i sin egen proces."""
+    start = time.perf_counter()
+    os.chdir(mappe)
+    sys.path.insert(0, kilde)
+    os.environ['BIBLIOTEK_BACKEND'] = backend
+    os.environ['BIBLIOTEK_BINAERE_KOPIER'] = '1' if binaer else '0'
+    from app import app
+    importeret = time.perf_counter()
+    with open(os.path.join('data', 'udlaan.csv'), encoding='utf-8') as f:
+        f.readline()
+        bruger = f.readline().split(',')[0]
+    client = app.test_client(use_cookies=False)
+    svar = client.post('/udlaan-oversigt', data={'bruger': bruger})
+    assert svar.status_code == 200, svar.status_code
+    slut = time.perf_counter()
+    return {'import_ms': round((importeret - start) * 1000, 1),
+            'foerste_svar_ms': round((slut - importeret) * 1000, 1),
+            'i_alt_ms': round((slut - start) * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--udlaan', type=int, default=1000000)
+    parser.add_argument('--gentagelser', type=int, default=3)
+    parser.add_argument('--kilde', default='.', help='projektmappe med app.py (standard: .)')
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--json', action='store_true', help='skriv resultatet som JSON')
+    args = parser.parse_args()
+    kilde = os.path.abspath(args.kilde)
+
+    if args.backend == 'csv':
+        tilfaelde = [('csv', False, False), ('binaer_foerste', True, True), ('binaer', True, False)]
+    else:
+        tilfaelde = [('sqlite', False, False)]
+
+    # Hver måling i en ny proces ('spawn'), så intet er indlæst på forhånd
+    ctx = multiprocessing.get_context('spawn')
+    resultat = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        with ctx.Pool(1) as pool:
+            antal = pool.apply(testdata.generer, (os.path.join(tmp, 'data'), args.udlaan))
+        for navn, binaer, slet in tilfaelde:
+            maalinger = []
+            for _ in range(args.gentagelser):
+                if slet:
+                    for fil in glob.glob(os.path.join(tmp, 'data', '**', '*.bin'), recursive=True):
+                        os.remove(fil)
+                with ctx.Pool(1) as pool:
+                    maalinger.append(pool.apply(maal, (tmp, kilde, args.backend, binaer)))
+            # Medianen af gentagelserne efter det samlede tidsforbrug
+            resultat[navn] = sorted(maalinger, key=lambda m: m['i_alt_ms'])[len(maalinger) // 2]
+    resultat['data'] = antal
+
+    if args.json:
+        print(json.dumps(resultat, indent=2))
+        return
+    print(', '.join(f'{n} {navn}' for navn, n in antal.items()) + f' ({args.backend})')
+    for navn, _, _ in tilfaelde:
+        r = resultat[navn]
+        print(f"{navn:15} import {r['import_ms']:8.1f} ms   første svar {r['foerste_svar_ms']:8.1f} ms"
+              f"   i alt {r['i_alt_ms']:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Renderingstid og svarstørrelse pr. side.
+
+Kør fra projektets rod:
+
+    python -m benchmark.skabeloner [--kilde STI] [--gentagelser N]
+
+--kilde peger på et andet checkout af projektet (f.eks. et git worktree
+af en ældre commit), så før og efter kan måles med samme script.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+SIDER = [
+    ('GET', '/', None),
+    ('GET', '/udlaan-oversigt', None),
+    ('POST', '/udlaan-oversigt', {'bruger': 'BRU001'}),
+    ('GET', '/admin/login', None),
+    ('GET', '/admin', None),
+    ('GET', '/admin/opret-bruger', None),
+    ('GET', '/admin/opret-bog', None),
+    ('GET', '/admin/oversigt', None),
+]
+
+
+def maal(app, gentagelser):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+
+    resultater = {}
+    for metode, sti, data in SIDER:
+        tider = []
+        for _ in range(gentagelser):
+            start = time.perf_counter()
+            response = client.open(sti, method=metode, data=data)
+            body = response.get_data()
+            tider.append(time.perf_counter() - start)
+        resultater[f'{metode} {sti}'] = {
+            'status': response.status_code,
+            'median_ms': round(statistics.median(tider) * 1000, 3),
+            'bytes': len(body),
+        }
+
+    # Stylesheets hentes én gang og caches derefter af browseren
+    css = {}
+    if os.path.isdir(app.static_folder or ''):
+        for navn in sorted(os.listdir(app.static_folder)):
+            if navn.endswith('.css'):
+                css[navn] = len(client.get(f'/static/{navn}').get_data())
+    return resultater, css
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--kilde', default='.', help='projektmappe med app.py (standard: .)')
+    parser.add_argument('--gentagelser', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='skriv resultatet som JSON')
+    args = parser.parse_args()
+
+    kilde = os.path.abspath(args.kilde)
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copytree(os.path.join(kilde, 'data'), os.path.join(tmp, 'data'))
+        os.chdir(tmp)
+        sys.path.insert(0, kilde)
+        from app import app
+
+        resultater, css = maal(app, args.gentagelser)
+
+    if args.json:
+        print(json.dumps({'sider': resultater, 'css': css}, indent=2))
+        return
+    print(f"{'side':32} {'status':>6} {'median ms':>10} {'bytes':>8}")
+    for side, r in resultater.items():
+        print(f"{side:32} {r['status']:>6} {r['median_ms']:>10.3f} {r['bytes']:>8}")
+    for navn, stoerrelse in css.items():
+        print(f"{'static/' + navn:32} {'':>6} {'':>10} {stoerrelse:>8}")
+
+
+if __name__ == '__main__':
+    main()
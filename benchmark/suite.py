@@ -0,0 +1,387 @@
+"""Tider for data_access og de vigtigste ruter ved voksende datamængder.
+
+    python -m benchmark.suite koer [--skala 1000 --skala 100000] [--backend sqlite] [--ud fil.json]
+    python -m benchmark.suite sammenlign foer.json efter.json [--graense 0.25]
+
+For hver skala genereres testdata (benchmark.testdata) i en midlertidig
+mappe, og målingerne køres i en ny proces, så caches og forbindelser ikke
+følger med fra den forrige skala. Hvert kald måles efter et opvarmningskald;
+det første kald gemmes for sig som 'foerste_ms'. Skrivende kald måles parvis
+med et kald, der fører data tilbage, så alle målinger ser de samme data.
+Importen af mange brugere og bøger måles til sidst for sig ('import'), da
+den lader tabellerne vokse.
+
+Før målingerne kontrolleres API'ets betingede svar: med den aktuelle ETag
+svarer /api/... 304 uden at røre backenden, og efter en skrivning 200 med
+en ny ETag. Fejler det, stopper kørslen, da '(304)'-målingen så ikke
+måler det, den skal.
+
+sammenlign markerer målinger, hvor p50 eller p95 er steget mere end
+--graense (relativt) og --min-ms (absolut), og afslutter med kode 1, hvis
+der er nogen.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+from benchmark import testdata
+
+SKALAER = [1000, 10000, 100000]
+GENTAGELSER = 100
+MAKS_SEK = 5.0
+MIN_GENTAGELSER = 3
+# Den sidste hele måned i testdata, til målinger af en periode
+MAANED_TIL = (testdata.NU.replace(day=1) - timedelta(days=1)).date()
+MAANED_FRA = MAANED_TIL.replace(day=1)
+
+
+def _percentiler(tider):
+    ms = sorted(t * 1000 for t in tider)
+    if len(ms) == 1:
+        ms = ms * 2
+    q = statistics.quantiles(ms, n=100, method='inclusive')
+    return {'n': len(tider), 'p50_ms': round(q[49], 4), 'p95_ms': round(q[94], 4),
+            'p99_ms': round(q[98], 4), 'maks_ms': round(ms[-1], 4)}
+
+
+def _maal(kald, tilbage=None, gentagelser=GENTAGELSER, maks_sek=MAKS_SEK):
+    """Tag tid på kald(i) og eventuelt tilbage(i) skiftevis.
+
+    Returnerer {'kald': resultat, 'tilbage': resultat}. Det første kald
+    tæller ikke med i percentilerne.
+    """
+    tider = {'kald': [], 'tilbage': []}
+    foerste = {}
+    slut = time.perf_counter() + maks_sek
+    for i in range(gentagelser + 1):
+        for navn, fn in (('kald', kald), ('tilbage', tilbage)):
+            if fn is None:
+                continue
+            start = time.perf_counter()
+            fn(i)
+            tid = time.perf_counter() - start
+            if i == 0:
+                foerste[navn] = tid
+            else:
+                tider[navn].append(tid)
+        if i >= MIN_GENTAGELSER and time.perf_counter() > slut:
+            break
+    return {navn: dict(_percentiler(tider[navn]), foerste_ms=round(foerste[navn] * 1000, 4))
+            for navn in foerste}
+
+
+def _data(db):
+    """Koder til målingerne: brugere, bøger, ledige bøger og brugere med udlån"""
+    brugere = [b['kode'] for b in db.hent_alle_brugere()]
+    boeger = [b['kode'] for b in db.hent_alle_boeger()]
+    aabne = [u for u in db.hent_alle_udlaan() if not u['afleveret']]
+    udlaante = {u['bog'] for u in aabne}
+    ord_ = sorted({o for b in db.hent_alle_boeger()[:200] for o in b['titel'].split()})
+    return {
+        'brugere': brugere,
+        'boeger': boeger,
+        'ledige': [kode for kode in boeger if kode not in udlaante],
+        'laanere': sorted({u['bruger'] for u in aabne}) or brugere,
+        'ord': ord_ or ['bog'],
+    }
+
+
+def _funktioner(db, d):
+    """[(navn, kald, tilbagenavn, tilbage)] for hver målt data_access-funktion"""
+    def n(liste, i):
+        return liste[i % len(liste)]
+
+    def batch(i):
+        return [n(d['ledige'], i * 10 + j) for j in range(10)]
+
+    return [
+        ('find_bruger', lambda i: db.find_bruger(n(d['brugere'], i)), None, None),
+        ('hent_alle_brugere', lambda i: db.hent_alle_brugere(), None, None),
+        ('find_bog', lambda i: db.find_bog(n(d['boeger'], i)), None, None),
+        ('hent_bog', lambda i: db.hent_bog(n(d['boeger'], i)), None, None),
+        ('hent_alle_boeger', lambda i: db.hent_alle_boeger(), None, None),
+        ('soeg_boeger', lambda i: db.soeg_boeger(n(d['ord'], i)), None, None),
+        ('bog_udlaant', lambda i: db.bog_udlaant(n(d['boeger'], i)), None, None),
+        ('hent_udlaan_for_bruger', lambda i: db.hent_udlaan_for_bruger(n(d['laanere'], i)),
+         None, None),
+        ('hent_alle_udlaan', lambda i: db.hent_alle_udlaan(), None, None),
+        ('hent_alle_udlaan (én måned)',
+         lambda i: db.hent_alle_udlaan(MAANED_FRA, MAANED_TIL),
+         None, None),
+        ('hent_udlaan_med_brugernavn_og_bogtitel',
+         lambda i: db.hent_udlaan_med_brugernavn_og_bogtitel(), None, None),
+        ('hent_side', lambda i: db.hent_side('udlaan', side=i % 10 + 1, sorter='dato'), None, None),
+        ('tabel_version', lambda i: db.tabel_version('udlaan'), None, None),
+        ('hent_dataversion', lambda i: db.hent_dataversion(), None, None),
+        ('eksporter_rows', lambda i: sum(1 for _ in db.eksporter_rows('udlaan', beriget=True)),
+         None, None),
+        ('eksporter', lambda i: db.eksporter('udlaan'), None, None),
+        ('hent_statistik', lambda i: db.hent_statistik(), None, None),
+        ('hent_overskredne (100)', lambda i: db.hent_overskredne(100), None, None),
+        ('hent_forfalder_snart', lambda i: db.hent_forfalder_snart(3), None, None),
+        ('genopbyg_statistik', lambda i: db.genopbyg_statistik(), None, None),
+        ('komprimer_udlaan', lambda i: db.komprimer_udlaan(), None, None),
+        ('opret_bruger', lambda i: db.opret_bruger(f'BENCH{i}', 'Benchmark'),
+         'slet_bruger', lambda i: db.slet_bruger(f'BENCH{i}')),
+        ('opret_bog', lambda i: db.opret_bog(f'BENCH{i}', 'Benchmark', '', ''),
+         'slet_bog', lambda i: db.slet_bog(f'BENCH{i}')),
+        ('checkout', lambda i: db.checkout(n(d['brugere'], i), n(d['ledige'], i)),
+         'registrer_aflevering', lambda i: db.registrer_aflevering(n(d['ledige'], i))),
+        ('registrer_udlaan', lambda i: db.registrer_udlaan(n(d['brugere'], i), n(d['ledige'], i)),
+         None, lambda i: db.registrer_aflevering(n(d['ledige'], i))),
+        ('registrer_udlaan_batch',
+         lambda i: db.registrer_udlaan_batch([(n(d['brugere'], i), bog) for bog in batch(i)]),
+         'registrer_aflevering_batch', lambda i: db.registrer_aflevering_batch(batch(i))),
+    ]
+
+
+IMPORT_RAEKKER = 50000
+
+
+def _importer(db):
+    """[(navn, kald, None, None)] for importen af IMPORT_RAEKKER nye brugere og bøger.
+
+    Hvert kald importerer nye koder, så tabellerne vokser; målingerne køres
+    derfor til sidst.
+    """
+    def fil(overskrift, linje, i):
+        linjer = [overskrift] + [linje.format(i, j) for j in range(IMPORT_RAEKKER)]
+        return io.BytesIO(('\n'.join(linjer) + '\n').encode('utf-8'))
+
+    return [
+        (f'importer_brugere ({IMPORT_RAEKKER} rækker)',
+         lambda i: db.importer_brugere(fil('kode,navn', 'IMPORT{0}-{1},Elev {1}', i)), None, None),
+        (f'importer_boeger ({IMPORT_RAEKKER} rækker)',
+         lambda i: db.importer_boeger(fil('kode,titel,forfatter,placering',
+                                          'IMPORT{0}-{1},Importeret bog {1},Forfatter,Hylde', i)),
+         None, None),
+    ]
+
+
+def _ruter(kiosk, client, d, db):
+    """[(navn, kald, tilbagenavn, tilbage)] for hver målt rute.
+
+    Kioskruterne kaldes uden cookies, så flash-beskederne ikke hober sig op
+    i sessionen.
+    """
+    def n(liste, i):
+        return liste[i % len(liste)]
+
+    def get(url, c=client):
+        return lambda i: c.get(url).get_data()
+
+    def post(url, data):
+        return lambda i: kiosk.post(url, data=data(i)).get_data()
+
+    return [
+        ('GET /', get('/', kiosk), None, None),
+        ('POST /udlaan', post('/udlaan', lambda i: {'bruger': n(d['brugere'], i),
+                                                     'bog': n(d['ledige'], i)}),
+         'POST /aflevering', post('/aflevering', lambda i: {'bog': n(d['ledige'], i)})),
+        ('GET /udlaan-oversigt', get('/udlaan-oversigt', kiosk), None, None),
+        ('POST /udlaan-oversigt', post('/udlaan-oversigt', lambda i: {'bruger': n(d['laanere'], i)}),
+         None, None),
+        ('GET /api/bruger/<kode>/udlaan',
+         lambda i: kiosk.get(f"/api/bruger/{n(d['laanere'], i)}/udlaan").get_data(), None, None),
+        ('GET /api/bruger/<kode>/udlaan (304)',
+         lambda i: kiosk.get(f"/api/bruger/{n(d['laanere'], i)}/udlaan",
+                             headers={'If-None-Match': f'"{db.hent_dataversion()}"'}).get_data(),
+         None, None),
+        ('GET /api/bog/<kode>', lambda i: kiosk.get(f"/api/bog/{n(d['boeger'], i)}").get_data(),
+         None, None),
+        ('GET /soeg', lambda i: kiosk.get('/soeg', query_string={'q': n(d['ord'], i)}).get_data(),
+         None, None),
+        ('GET /admin/oversigt', get('/admin/oversigt'), None, None),
+        ('GET /admin/oversigt (aktive udlån)', get('/admin/oversigt?udlaan_aktive=1'), None, None),
+        ('GET /admin/oversigt (én måned)',
+         get(f'/admin/oversigt?udlaan_fra={MAANED_FRA}&udlaan_til={MAANED_TIL}'), None, None),
+        ('GET /admin/oversigt (side, sortering, søgning)',
+         get('/admin/oversigt?udlaan_side=3&udlaan_sorter=titel&bruger_soeg=an&bog_faldende=1'),
+         None, None),
+        ('GET /admin/statistik', get('/admin/statistik'), None, None),
+        ('GET /admin/download-udlaan', get('/admin/download-udlaan'), None, None),
+        ('GET /admin/download-udlaan (beriget, gzip)',
+         get('/admin/download-udlaan?beriget=1&gzip=1'), None, None),
+        ('GET /admin/download-brugere', get('/admin/download-brugere'), None, None),
+        ('GET /admin/download-boeger', get('/admin/download-boeger'), None, None),
+    ]
+
+
+class _Afvisende:
+    """En backend, der fejler ved enhver brug"""
+
+    def __getattr__(self, navn):
+        raise AssertionError(f'backenden blev brugt ({navn}) til et 304-svar')
+
+
+def _kontroller_304(kiosk, d, db):
+    """Kontrollér ETag og 304 på API'et; fører data tilbage bagefter"""
+    bog = d['ledige'][0]
+    urler = [f"/api/bruger/{d['laanere'][0]}/udlaan", f'/api/bog/{bog}/status', f'/api/bog/{bog}']
+    etag = kiosk.get(urler[0]).headers['ETag']
+    backend, db._backend = db._backend, _Afvisende()
+    try:
+        for url in urler:
+            svar = kiosk.get(url, headers={'If-None-Match': etag})
+            if svar.status_code != 304 or svar.headers.get('ETag') != etag or svar.get_data():
+                raise AssertionError(f'{url}: {svar.status_code} i stedet for 304')
+    finally:
+        db._backend = backend
+    db.registrer_udlaan(d['brugere'][0], bog)
+    try:
+        svar = kiosk.get(urler[1], headers={'If-None-Match': etag})
+        if svar.status_code != 200 or svar.headers.get('ETag') == etag:
+            raise AssertionError(f'{urler[1]}: {svar.status_code} med samme ETag efter et udlån')
+    finally:
+        db.registrer_aflevering(bog)
+
+
+def _koer(maalinger, gentagelser, maks_sek):
+    resultater = {}
+    for navn, kald, tilbagenavn, tilbage in maalinger:
+        maalt = _maal(kald, tilbage, gentagelser, maks_sek)
+        resultater[navn] = maalt['kald']
+        if tilbagenavn:
+            resultater[tilbagenavn] = maalt['tilbage']
+        print(f'  {navn}: p50 {maalt["kald"]["p50_ms"]:.3f} ms', file=sys.stderr)
+    return resultater
+
+
+def maal_skala(udlaan, backend, gentagelser, maks_sek):
+    """Generér data til skalaen og mål. Køres i sin egen proces."""
+    # Baggrundstråde (f.eks. de binære kopier) kan skrive, mens mappen slettes
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        antal = testdata.generer(os.path.join(tmp, 'data'), udlaan)
+        os.chdir(tmp)
+        os.environ['BIBLIOTEK_BACKEND'] = backend
+        start = time.perf_counter()
+        import data_access as db
+        from app import app
+        # Mål på data, som en kørende installation har dem: de afleverede
+        # udlån ligger i arkivet
+        db.komprimer_udlaan()
+        d = _data(db)
+        opstart = time.perf_counter() - start
+
+        funktioner = _funktioner(db, d)
+        maalt = {navn.split(' (')[0] for navn, _, _, _ in funktioner + _importer(db)} | {
+            tilbagenavn for _, _, tilbagenavn, _ in funktioner}
+        ikke_maalt = sorted(
+            navn for navn in dir(db)
+            if not navn.startswith('_') and callable(getattr(db, navn))
+            and getattr(getattr(db, navn), '__module__', None) == 'data_access'
+            and navn not in maalt and navn not in ('vaelg_backend', 'start_komprimering'))
+
+        print(f'{udlaan} udlån ({backend}):', file=sys.stderr)
+        kiosk = app.test_client(use_cookies=False)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['admin_logged_in'] = True
+        _kontroller_304(kiosk, d, db)
+
+        return {
+            'data': antal,
+            'opstart_ms': round(opstart * 1000, 1),
+            'funktioner': _koer(funktioner, gentagelser, maks_sek),
+            'ruter': _koer(_ruter(kiosk, client, d, db), gentagelser, maks_sek),
+            'import': _koer(_importer(db), MIN_GENTAGELSER, maks_sek),
+            'ikke_maalt': ikke_maalt,
+        }
+
+
+def koer(args):
+    kilde = os.getcwd()
+    sys.path.insert(0, kilde)
+    resultat = {
+        'meta': {
+            'tidspunkt': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'backend': args.backend,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'gentagelser': args.gentagelser,
+            'maks_sek': args.maks_sek,
+        },
+        'skalaer': {},
+    }
+    # Ny proces pr. skala; 'spawn' så intet modul er importeret på forhånd
+    ctx = multiprocessing.get_context('spawn')
+    for udlaan in args.skala or SKALAER:
+        with ctx.Pool(1, initializer=sys.path.insert, initargs=(0, kilde)) as pool:
+            resultat['skalaer'][str(udlaan)] = pool.apply(
+                maal_skala, (udlaan, args.backend, args.gentagelser, args.maks_sek))
+
+    tekst = json.dumps(resultat, indent=2, ensure_ascii=False)
+    if args.ud:
+        with open(args.ud, 'w', encoding='utf-8') as f:
+            f.write(tekst + '\n')
+    else:
+        print(tekst)
+    for skala, r in resultat['skalaer'].items():
+        if r['ikke_maalt']:
+            print(f"Ikke målt ({skala}): {', '.join(r['ikke_maalt'])}", file=sys.stderr)
+
+
+def sammenlign(args):
+    with open(args.foer, encoding='utf-8') as f:
+        foer = json.load(f)
+    with open(args.efter, encoding='utf-8') as f:
+        efter = json.load(f)
+
+    regressioner = 0
+    print(f"{'skala':>8} {'måling':48} {'p50 før':>9} {'p50 efter':>9} "
+          f"{'p95 før':>9} {'p95 efter':>9}")
+    for skala, ny in efter['skalaer'].items():
+        gammel = foer['skalaer'].get(skala)
+        if gammel is None:
+            continue
+        for gruppe in ('funktioner', 'ruter', 'import'):
+            for navn, e in ny[gruppe].items():
+                f_ = gammel.get(gruppe, {}).get(navn)
+                if f_ is None:
+                    continue
+                markering = ''
+                for p in ('p50_ms', 'p95_ms'):
+                    if (e[p] > f_[p] * (1 + args.graense) and e[p] - f_[p] > args.min_ms):
+                        markering = '  REGRESSION'
+                regressioner += bool(markering)
+                if markering or not args.kun_regressioner:
+                    print(f"{skala:>8} {navn[:48]:48} {f_['p50_ms']:>9.3f} {e['p50_ms']:>9.3f} "
+                          f"{f_['p95_ms']:>9.3f} {e['p95_ms']:>9.3f}{markering}")
+    print(f'{regressioner} regressioner')
+    return 1 if regressioner else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    under = parser.add_subparsers(dest='kommando', required=True)
+    p = under.add_parser('koer', help='mål og skriv JSON')
+    p.add_argument('--skala', type=int, action='append',
+                   help=f'antal udlån; kan gentages (standard: {SKALAER})')
+    p.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    p.add_argument('--gentagelser', type=int, default=GENTAGELSER)
+    p.add_argument('--maks-sek', type=float, default=MAKS_SEK,
+                   help='stop en måling efter så mange sekunder')
+    p.add_argument('--ud', help='JSON-fil (standard: stdout)')
+    p = under.add_parser('sammenlign', help='find regressioner mellem to kørsler')
+    p.add_argument('foer')
+    p.add_argument('efter')
+    p.add_argument('--graense', type=float, default=0.25, help='relativ stigning (standard 0.25)')
+    p.add_argument('--min-ms', type=float, default=0.1, help='mindste absolutte stigning')
+    p.add_argument('--kun-regressioner', action='store_true')
+    args = parser.parse_args()
+    if args.kommando == 'koer':
+        koer(args)
+    else:
+        sys.exit(sammenlign(args))
+
+
+if __name__ == '__main__':
+    main()
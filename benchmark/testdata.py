@@ -0,0 +1,98 @@
+"""Syntetiske brugere, bøger og udlån i samme format som data/.
+
+    python -m benchmark.testdata MAPPE --udlaan 100000 [--aabne 0.08] [--seed 1]
+
+Antallet af brugere og bøger følger antallet af udlån (et udlån pr. 20.
+bruger og 5 pr. bog), medmindre de angives. Hver bog har en række udlån
+efter hinanden frem til NU; den sidste er stadig åben for en andel af
+bøgerne, så andelen af åbne udlån svarer til --aabne.
+"""
+import argparse
+import csv
+import os
+import random
+from datetime import datetime, timedelta
+
+FORNAVNE = ['Anna', 'Bent', 'Carla', 'David', 'Emma', 'Frederik', 'Grete', 'Hans',
+            'Ida', 'Jens', 'Karen', 'Lars', 'Mette', 'Niels', 'Ole', 'Pia', 'Søren',
+            'Tove', 'Ulla', 'Viggo', 'Åse', 'Ærbø', 'Øjvind']
+EFTERNAVNE = ['Andersen', 'Bentsen', 'Christiansen', 'Damgaard', 'Hansen', 'Jensen',
+              'Larsen', 'Mikkelsen', 'Nielsen', 'Pedersen', 'Sørensen', 'Østergaard',
+              'Ågesen', 'Kierkegaard', 'Blixen']
+TITELORD = ['Huset', 'ved', 'havet', 'Den', 'sidste', 'sommer', 'Mørke', 'skove',
+            'Æblehaven', 'Rejsen', 'til', 'Ærø', 'Byen', 'under', 'isen', 'Kongens',
+            'fald', 'Lyset', 'fra', 'fyret', 'Børnene', 'på', 'Åen', 'Stormen',
+            'Fortællinger', 'om', 'Danmark', 'Vinter', 'Natten', 'hemmelige', 'brev']
+TIDSFORMAT = '%Y-%m-%dT%H:%M:%S'
+# Fast slutdato, så samme seed giver de samme filer
+NU = datetime(2025, 7, 1)
+
+
+def _skriv(sti, felter, rows):
+    with open(sti, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(felter)
+        writer.writerows(rows)
+
+
+def generer(mappe, udlaan, brugere=None, boeger=None, aabne=0.08, seed=1):
+    """Skriv brugere.csv, boeger.csv og udlaan.csv i mappe. Returnerer antallene."""
+    rnd = random.Random(seed)
+    brugere = brugere or max(udlaan // 20, 50)
+    boeger = boeger or max(udlaan // 5, 100)
+    os.makedirs(mappe, exist_ok=True)
+
+    bruger_koder = [f'BRU{i:07d}' for i in range(1, brugere + 1)]
+    _skriv(os.path.join(mappe, 'brugere.csv'), ['kode', 'navn'],
+           ([kode, f'{rnd.choice(FORNAVNE)} {rnd.choice(EFTERNAVNE)}'] for kode in bruger_koder))
+
+    bog_koder = [f'BOG{i:07d}' for i in range(1, boeger + 1)]
+    _skriv(os.path.join(mappe, 'boeger.csv'), ['kode', 'titel', 'forfatter', 'placering'], (
+        [kode,
+         ' '.join(rnd.choices(TITELORD, k=rnd.randint(1, 5))).capitalize(),
+         f'{rnd.choice(FORNAVNE)} {rnd.choice(EFTERNAVNE)}',
+         f'Hylde {rnd.choice("ABCDEFGHJK")}{rnd.randint(1, 40)}']
+        for kode in bog_koder))
+
+    # Fordel udlånene på bøgerne og læg hver bogs udlån efter hinanden
+    pr_bog = [0] * boeger
+    for _ in range(udlaan):
+        pr_bog[rnd.randrange(boeger)] += 1
+    aabne_boeger = set(rnd.sample([i for i, n in enumerate(pr_bog) if n],
+                                  min(round(udlaan * aabne), sum(1 for n in pr_bog if n))))
+    rows = []
+    for i, antal in enumerate(pr_bog):
+        # (udlånstid, pause før næste udlån) i dage; rækken slutter inden NU
+        perioder = [(rnd.uniform(1, 30), rnd.uniform(0, 20)) for _ in range(antal)]
+        tid = NU - timedelta(days=sum(a + p for a, p in perioder) + rnd.uniform(0, 30))
+        for n, (laant, pause) in enumerate(perioder):
+            # Nogle brugere låner meget mere end andre
+            bruger = bruger_koder[min(int(rnd.expovariate(3 / brugere)), brugere - 1)]
+            dato = tid
+            tid += timedelta(days=laant)
+            aaben = n == antal - 1 and i in aabne_boeger
+            rows.append((dato, bruger, bog_koder[i], '' if aaben else tid.strftime(TIDSFORMAT)))
+            tid += timedelta(days=pause)
+    rows.sort()
+    _skriv(os.path.join(mappe, 'udlaan.csv'), ['bruger', 'bog', 'dato', 'afleveret'],
+           ([bruger, bog, dato.strftime(TIDSFORMAT), afleveret]
+            for dato, bruger, bog, afleveret in rows))
+
+    return {'brugere': brugere, 'boeger': boeger, 'udlaan': udlaan, 'aabne': len(aabne_boeger)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('mappe')
+    parser.add_argument('--udlaan', type=int, default=10000)
+    parser.add_argument('--brugere', type=int)
+    parser.add_argument('--boeger', type=int)
+    parser.add_argument('--aabne', type=float, default=0.08, help='andel åbne udlån')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    antal = generer(args.mappe, args.udlaan, args.brugere, args.boeger, args.aabne, args.seed)
+    print(', '.join(f'{n} {navn}' for navn, n in antal.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Binære kopier af de parsede tabeller, så en ny worker ikke skal parse CSV.
+
+Kopien ligger ved siden af CSV-filen (udlaan.csv -> udlaan.csv.bin) og er
+lavet til at blive mmap'et. Den starter med et hoved: formatversion,
+CRC32 over resten af filen, antal rækker og CSV-filens størrelse, mtime og
+SHA-256. Derefter kommer felternes navne og én kolonne pr. felt, hver
+justeret til 8 bytes:
+
+- tekst: antal forskellige værdier, værdierne som én UTF-8-tekst med
+  tegn-offsets (uint32) og et indeks (uint32) pr. række.
+- tid (dato, afleveret og forfald): heltal (int64, se raekker.tid()), MANGLER for None.
+
+laes() returnerer None, hvis kopien mangler, er beskadiget, er fra en
+anden version eller ikke passer til CSV-filen. Så læses CSV-filen, og
+kopien skrives forfra.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from itertools import accumulate
+from operator import attrgetter
+
+import raekker
+
+MAGI = b'BIBLBIN\x00'
+VERSION = 1
+_HOVED = struct.Struct('<8sIIqqq32s')  # magi, version, crc, rækker, størrelse, mtime, sha256
+_TAL = struct.Struct('<qq')
+TIDSFELTER = ('dato', 'afleveret', 'forfald')
+MANGLER = -2**63
+
+def sti(csvfil):
+    return csvfil + '.bin'
+
+def filhash(f):
+    """SHA-256 af den åbne binære fil fra starten"""
+    f.seek(0)
+    return hashlib.file_digest(f, 'sha256').digest()
+
+def _udfyld(data):
+    data.extend(bytes(-len(data) % 8))
+
+def _skriv_tekst(data, kolonne):
+    vaerdier = list(dict.fromkeys(kolonne))
+    plads = dict(zip(vaerdier, range(len(vaerdier))))
+    tekst = ''.join(vaerdier).encode('utf-8')
+    data += _TAL.pack(len(vaerdier), len(tekst))
+    data += array('I', accumulate(map(len, vaerdier), initial=0)).tobytes()
+    _udfyld(data)
+    data += tekst
+    _udfyld(data)
+    data += array('I', map(plads.__getitem__, kolonne)).tobytes()
+    _udfyld(data)
+
+def _skriv_tid(data, kolonne):
+    data += array('q', [MANGLER if t is None else t for t in kolonne]).tobytes()
+
+def skriv(csvfil, klasse, rows, f):
+    """Skriv kopien af rows, der er parset fra CSV-filen f (åben binært)"""
+    st = os.fstat(f.fileno())
+    digest = filhash(f)
+    data = bytearray()
+    felter = ','.join(klasse.FELTER).encode('utf-8')
+    data += struct.pack('<q', len(felter)) + felter
+    _udfyld(data)
+    for felt in klasse.FELTER:
+        kolonne = list(map(attrgetter(felt), rows))
+        (_skriv_tid if felt in TIDSFELTER else _skriv_tekst)(data, kolonne)
+    hoved = _HOVED.pack(MAGI, VERSION, zlib.crc32(data), len(rows),
+                        st.st_size, st.st_mtime_ns, digest)
+    tmp = f'{sti(csvfil)}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as ud:
+        ud.write(hoved)
+        ud.write(data)
+    os.replace(tmp, sti(csvfil))
+    return len(hoved) + len(data)
+
+class _Laeser:
+    def __init__(self, m, start):
+        self.m = m
+        self.pos = start
+
+    def tal(self, antal, fmt, stoerrelse):
+        slut = self.pos + antal * stoerrelse
+        ud = self.m[self.pos:slut].cast(fmt).tolist()
+        self.pos = slut + (-slut % 8)
+        return ud
+
+    def bytes(self, antal):
+        slut = self.pos + antal
+        ud = self.m[self.pos:slut].tobytes()
+        self.pos = slut + (-slut % 8)
+        return ud
+
+def _laes_tekst(laeser, antal):
+    n, laengde = laeser.tal(2, 'q', 8)
+    offsets = laeser.tal(n + 1, 'I', 4)
+    tekst = laeser.bytes(laengde).decode('utf-8')
+    vaerdier = [tekst[a:b] for a, b in zip(offsets, offsets[1:])]
+    return list(map(vaerdier.__getitem__, laeser.tal(antal, 'I', 4)))
+
+def _laes_tid(laeser, antal):
+    return [None if t == MANGLER else t for t in laeser.tal(antal, 'q', 8)]
+
+def laes(csvfil, klasse, f):
+    """Rækkerne fra kopien af CSV-filen f (åben binært), eller None.
+
+    Hash'en af CSV-filen regnes kun, når størrelse og mtime passer.
+    """
+    try:
+        fil = open(sti(csvfil), 'rb')
+    except FileNotFoundError:
+        return None
+    st = os.fstat(f.fileno())
+    with fil:
+        if os.fstat(fil.fileno()).st_size < _HOVED.size:
+            return None
+        with (mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as m,
+              raekker.uden_gc()):
+            magi, version, crc, antal, stoerrelse, mtime, digest = _HOVED.unpack_from(m)
+            if (magi, version, stoerrelse, mtime) != (MAGI, VERSION, st.st_size, st.st_mtime_ns):
+                return None
+            if zlib.crc32(m[_HOVED.size:]) != crc or filhash(f) != digest:
+                return None
+            laeser = _Laeser(m, _HOVED.size)
+            (laengde,) = laeser.tal(1, 'q', 8)
+            if laeser.bytes(laengde).decode('utf-8') != ','.join(klasse.FELTER):
+                return None
+            kolonner = [(_laes_tid if felt in TIDSFELTER else _laes_tekst)(laeser, antal)
+                        for felt in klasse.FELTER]
+            return list(map(klasse, *kolonner))
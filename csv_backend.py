@@ -0,0 +1,1142 @@
+"""CSV-backend: tabellerne ligger som CSV-filer i data/"""
+import bisect
+import csv
+import fcntl
+import heapq
+import io
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import binaer
+import metrikker
+import raekker
+import soegning
+import statistik
+
+BRUGERFIL = 'data/brugere.csv'
+BOGFIL = 'data/boeger.csv'
+UDLAANFIL = 'data/udlaan.csv'
+BRUGER_FELTER = ['kode', 'navn']
+BOG_FELTER = ['kode', 'titel', 'forfatter', 'placering']
+
+# Udlån og afleveringer skrives som hændelser i en journal, der kun tilføjes
+# til. Journalen foldes ind i UDLAANFIL, når den bliver for stor eller ved
+# den periodiske komprimering. Udlån har forfaldsdatoen som femte felt;
+# afleveringer og udlån fra før forfaldsdatoerne har kun fire.
+UDLAANJOURNAL = 'data/udlaan.journal'
+JOURNAL_FELTER = ['handling', 'bruger', 'bog', 'tidspunkt', 'forfald']
+UDLAAN_FELTER = ['bruger', 'bog', 'dato', 'afleveret', 'forfald']
+JOURNAL_MAKS_POSTER = int(os.environ.get('UDLAAN_JOURNAL_MAKS_POSTER', '1000'))
+
+# Komprimeringen flytter afleverede udlån fra UDLAANFIL til et arkiv med én
+# fil pr. måned (efter udlånsdatoen), så UDLAANFIL kun holder de åbne udlån
+# og dem, der er afleveret siden. Arkivet læses først, når en forespørgsel
+# skal bruge en af dets måneder.
+ARKIVMAPPE = 'data/arkiv'
+UDLAANEKSPORT = 'data/udlaan-alle.csv'
+
+# Rækker og journallinjer, der ikke kan læses (f.eks. et ugyldigt
+# tidspunkt), springes over, så resten af tabellen kan bruges. Før filen,
+# de står i, skrives om uden dem, føjes de til AFVISTFIL i samme format som
+# integritet.py's afvist.csv.
+AFVISTFIL = 'data/afvist.csv'
+AFVIST_FELTER = ['fil', 'linje', 'problem', 'raekke']
+
+# Hver tabel får en binær kopi ved siden af CSV-filen (binaer.py), som en
+# ny worker indlæser i stedet for at parse CSV-filen. Kopien skrives igen,
+# når filen skrives, og en kopi, der ikke passer til filen, ignoreres.
+# 0 slår kopierne fra. Formatet er little-endian.
+BINAERE_KOPIER = (os.environ.get('BIBLIOTEK_BINAERE_KOPIER', '1') != '0'
+                  and sys.byteorder == 'little')
+
+# Alle skrivninger tager en flock på LAASFIL, så de også er serialiseret på
+# tværs af Gunicorn-workers. Skrivninger, der kommer inden for
+# SKRIV_VINDUE_MS millisekunder af hinanden, samles af skrivetråden og
+# skrives i én gruppe-commit. 0 slår samlingen fra.
+LAASFIL = 'data/bibliotek.lock'
+SKRIV_VINDUE_MS = float(os.environ.get('BIBLIOTEK_SKRIV_VINDUE_MS', '2'))
+
+# Resultater fra checkout()
+UDLAAN_OK = 'ok'
+UKENDT_BRUGER = 'ukendt_bruger'
+UKENDT_BOG = 'ukendt_bog'
+ALLEREDE_UDLAANT = 'allerede_udlaant'
+
+# Hjælpefunktioner
+
+# Tabeller holdes parset i hukommelsen som kompakte rækker (raekker.py) og
+# genindlæses kun, når filens inode, størrelse eller mtime ændrer sig. Et
+# cache-hit koster kun et stat.
+# Cachen ændres kun under _laas_traad; læsere tager i stedet en kopi af
+# listerne (list() og dict() kopierer uden at slippe GIL'en).
+_cache = {}
+
+def _signatur(filepath):
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _klasse(filepath):
+    return {BRUGERFIL: raekker.Bruger, BOGFIL: raekker.Bog}.get(filepath, raekker.Udlaan)
+
+def _ny_tabel(signatur, rows, klasse):
+    return {
+        'signatur': signatur,
+        'rows': rows,
+        'kode': {row.kode: row for row in rows} if 'kode' in klasse.FELTER else {},
+    }
+
+def _tabel(filepath):
+    """Returnér den cachede tabel for filen og genindlæs den hvis den er ændret"""
+    tabel = _cache.get(filepath)
+    if tabel is not None and tabel['signatur'] == _signatur(filepath):
+        metrikker.cache('tabel', True)
+        return tabel
+    with _laas_traad:
+        signatur = _signatur(filepath)
+        tabel = _cache.get(filepath)
+        if tabel is not None and tabel['signatur'] == signatur:
+            metrikker.cache('tabel', True)
+            return tabel
+        metrikker.cache('tabel', False)
+        klasse = _klasse(filepath)
+        signatur, rows = _laes_fil(filepath, klasse)
+        tabel = _cache[filepath] = _ny_tabel(signatur, rows, klasse)
+    return tabel
+
+def _laes_fil(filepath, klasse):
+    """(signatur, rows) for filen, fra den binære kopi, hvis den passer;
+    (None, []) hvis filen ikke findes"""
+    _afviste.pop(filepath, None)
+    try:
+        f = open(filepath, 'rb')
+    except FileNotFoundError:
+        return None, []
+    with f:
+        st = os.fstat(f.fileno())
+        signatur = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if BINAERE_KOPIER:
+            rows = binaer.laes(filepath, klasse, f)
+            metrikker.cache('binaer', rows is not None)
+            if rows is not None:
+                _laest(binaer.sti(filepath), os.path.getsize(binaer.sti(filepath)))
+                return signatur, rows
+            f.seek(0)
+        tekst = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        afviste = []
+        rows = raekker.laes(tekst, klasse, afviste)
+        tekst.detach()
+        _laest(filepath, st.st_size)
+        if afviste:
+            # Ingen binær kopi; den ville skjule de afviste rækker ved næste
+            # indlæsning, og de skal med i AFVISTFIL, når filen skrives om
+            _afvis(filepath, afviste)
+        else:
+            _skriv_binaer(filepath, klasse, rows, f)
+    return signatur, rows
+
+_afviste = {}  # fil -> [(linjenummer, felter)], der blev sprunget over ved indlæsningen
+
+def _afvis(filepath, afviste):
+    _afviste.setdefault(filepath, []).extend(afviste)
+    metrikker.tael('bibliotek_afviste_raekker_total', len(afviste),
+                   fil=os.path.basename(filepath))
+
+def _gem_afviste(filepath):
+    """Føj filens afviste rækker til AFVISTFIL, før filen skrives om uden dem.
+    Kaldes under _laas."""
+    afviste = _afviste.pop(filepath, None)
+    if not afviste:
+        return
+    ny = not os.path.exists(AFVISTFIL)
+    with open(AFVISTFIL, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        if ny:
+            writer.writerow(AFVIST_FELTER)
+        for nr, felter in afviste:
+            linje = io.StringIO()
+            csv.writer(linje, lineterminator='').writerow(felter)
+            writer.writerow([filepath, nr, 'tidspunkt', linje.getvalue()])
+        f.flush()
+        os.fsync(f.fileno())
+
+# Efter en commit skrives de binære kopier af en tråd for sig, når der
+# ikke er bestilt flere i BINAER_PAUSE_SEK, så de ikke tager CPU fra en
+# række skrivninger. Kommer der flere commits af samme fil, skrives kun
+# kopien af den seneste. En ældre kopi, der når at overskrive en nyere,
+# afvises ved næste indlæsning.
+BINAER_PAUSE_SEK = 1.0
+_binaere = {}  # fil -> (rækker, filen åben), der venter på en kopi
+_binaere_betingelse = threading.Condition()
+_binaer_bestilt = 0.0
+_binaer_pid = None
+
+def _bestil_binaer(filepath, rows, f):
+    global _binaer_pid, _binaer_bestilt
+    with _binaere_betingelse:
+        if _binaer_pid != os.getpid():
+            threading.Thread(target=_binaer_loop, name='csv-binaer', daemon=True).start()
+            _binaer_pid = os.getpid()
+        gammel = _binaere.pop(filepath, None)
+        if gammel is not None:
+            gammel[1].close()
+        _binaere[filepath] = (rows, f)
+        _binaer_bestilt = time.monotonic()
+        _binaere_betingelse.notify()
+
+def _binaer_loop():
+    while True:
+        with _binaere_betingelse:
+            while not _binaere:
+                _binaere_betingelse.wait()
+            while True:
+                rest = _binaer_bestilt + BINAER_PAUSE_SEK - time.monotonic()
+                if rest <= 0:
+                    break
+                _binaere_betingelse.wait(rest)
+            filepath, (rows, f) = _binaere.popitem()
+        with f:
+            _skriv_binaer(filepath, _klasse(filepath), rows, f)
+
+def _skriv_binaer(filepath, klasse, rows, f=None):
+    """Skriv den binære kopi af filen, som rows er læst fra eller lige skrevet til"""
+    if not BINAERE_KOPIER:
+        return
+    try:
+        if f is None:
+            with open(filepath, 'rb') as f:
+                antal_bytes = binaer.skriv(filepath, klasse, rows, f)
+        else:
+            antal_bytes = binaer.skriv(filepath, klasse, rows, f)
+    except OSError:
+        return  # Kopien er kun en genvej; CSV-filen læses igen næste gang
+    _skrevet(binaer.sti(filepath), antal_bytes)
+
+def _read_csv(filepath):
+    # Kopier rækkerne, så kaldere kan ændre dem uden at ændre cachen
+    return [row.som_dict() for row in list(_tabel(filepath)['rows'])]
+
+def _laest(filepath, antal_bytes):
+    navn = os.path.basename(filepath)
+    metrikker.tael('bibliotek_fil_laesninger_total', fil=navn)
+    metrikker.tael('bibliotek_fil_laest_bytes_total', antal_bytes, fil=navn)
+
+def _skrevet(filepath, antal_bytes):
+    navn = os.path.basename(filepath)
+    metrikker.tael('bibliotek_fil_skrivninger_total', fil=navn)
+    metrikker.tael('bibliotek_fil_skrevet_bytes_total', antal_bytes, fil=navn)
+
+def _erstat_fil(filepath, skriv):
+    """Skriv filen til en midlertidig fil, fsync den og flyt den på plads"""
+    tmp = f'{filepath}.{os.getpid()}.tmp'
+    with open(tmp, 'w', newline='', encoding='utf-8') as f:
+        skriv(f)
+        f.flush()
+        os.fsync(f.fileno())
+        _skrevet(filepath, os.fstat(f.fileno()).st_size)
+    os.replace(tmp, filepath)
+
+def _write_csv(filepath, fieldnames, rows):
+    # Rækkernes values() står i samme rækkefølge som fieldnames
+    def skriv(f):
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(row.values() for row in rows)
+    _erstat_fil(filepath, skriv)
+
+# Låsen kan tages igen af den tråd, der har den (f.eks. når komprimeringen
+# læser tabellen). Et LOCK_SH inde i et LOCK_EX beholder det eksklusive.
+_laas_traad = threading.RLock()
+_laas_fil = None
+_laas_dybde = 0
+
+@contextmanager
+def _laas(mode):
+    global _laas_fil, _laas_dybde
+    start = time.perf_counter()
+    with _laas_traad:
+        if _laas_dybde == 0:
+            _laas_fil = open(LAASFIL, 'a')
+            fcntl.flock(_laas_fil, mode)
+            metrikker.observer('bibliotek_laas_ventetid_seconds', time.perf_counter() - start,
+                               laas='ex' if mode == fcntl.LOCK_EX else 'sh')
+        _laas_dybde += 1
+        try:
+            yield
+        finally:
+            _laas_dybde -= 1
+            if _laas_dybde == 0:
+                fcntl.flock(_laas_fil, fcntl.LOCK_UN)
+                _laas_fil.close()
+                _laas_fil = None
+
+# Gruppe-commit. En skrivning er en funktion, der under låsen læser de
+# cachede tabeller, ændrer dem i hukommelsen med _gem() og _journalfoer()
+# og returnerer sit resultat. _commit() kører en hel gruppe af dem og
+# skriver derefter hver ændret fil én gang og journalen med én fsync.
+SKRIVESTATISTIK = {'commits': 0, 'skrivninger': 0, 'filer': 0, 'journallinjer': 0}
+
+_gruppe = None
+_koe = []
+_koe_betingelse = threading.Condition()
+_skriver_pid = None
+
+def _gem(filepath, fieldnames, rows, koder=()):
+    """Erstat tabellen i cachen; filen skrives når gruppen committes.
+
+    koder er de brugere eller bøger, der er oprettet eller slettet; deres
+    navne rettes i udlånsvisningen.
+    """
+    gammel = _cache.get(filepath)
+    _cache[filepath] = _ny_tabel(gammel['signatur'] if gammel else None, rows, _klasse(filepath))
+    _gruppe['filer'][filepath] = fieldnames
+    if filepath in _navne:
+        _ret_navne(filepath, gammel, koder)
+
+def _skriv_gruppe(gruppe):
+    for filepath, fieldnames in gruppe['filer'].items():
+        tabel = _cache[filepath]
+        _write_csv(filepath, fieldnames, tabel['rows'])
+        tabel['signatur'] = _signatur(filepath)
+        if BINAERE_KOPIER:
+            # Filen erstattes altid med en ny, så den åbne fil er præcis
+            # den, rækkerne er skrevet til, også efter låsen
+            _bestil_binaer(filepath, tabel['rows'], open(filepath, 'rb'))
+        SKRIVESTATISTIK['filer'] += 1
+
+    if gruppe['journal']:
+        tabel = _cache[UDLAANFIL]
+        data = ''.join(gruppe['journal']).encode('utf-8')
+        with open(UDLAANJOURNAL, 'ab') as f:
+            if f.tell() != tabel['offset']:
+                # Journalen er ændret uden om låsen; indlæs den forfra bagefter
+                del _cache[UDLAANFIL]
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            tabel['journal'] = os.fstat(f.fileno()).st_ino
+        _skrevet(UDLAANJOURNAL, len(data))
+        tabel['offset'] += len(data)
+        tabel['poster'] += len(gruppe['journal'])
+        tabel['linjer'] += len(gruppe['journal'])
+        SKRIVESTATISTIK['journallinjer'] += len(gruppe['journal'])
+        if tabel['poster'] >= JOURNAL_MAKS_POSTER:
+            komprimer_udlaan()
+
+def _commit(opgaver):
+    global _gruppe
+    try:
+        with _laas(fcntl.LOCK_EX):
+            _udlaan()  # Læs andre workers journallinjer, før vi tilføjer vores
+            _gruppe = {'filer': {}, 'journal': []}
+            for opgave in opgaver:
+                try:
+                    opgave['resultat'] = opgave['fn']()
+                except Exception as e:
+                    opgave['fejl'] = e
+            _skriv_gruppe(_gruppe)
+            SKRIVESTATISTIK['commits'] += 1
+            SKRIVESTATISTIK['skrivninger'] += len(opgaver)
+            metrikker.tael('bibliotek_commits_total')
+            metrikker.tael('bibliotek_commit_skrivninger_total', len(opgaver))
+    except Exception as e:
+        # Cachen kan indeholde ændringer, der ikke nåede disken
+        _cache.clear()
+        for opgave in opgaver:
+            opgave.setdefault('fejl', e)
+    finally:
+        _gruppe = None
+        for opgave in opgaver:
+            opgave['faerdig'].set()
+
+def _skriv_loop():
+    while True:
+        with _koe_betingelse:
+            while not _koe:
+                _koe_betingelse.wait()
+        # Vent på skrivninger, der kommer lige efter, og commit dem samlet
+        time.sleep(SKRIV_VINDUE_MS / 1000)
+        with _koe_betingelse:
+            opgaver = _koe[:]
+            del _koe[:]
+        _commit(opgaver)
+
+def _transaktion(fn):
+    """Kør skrivningen fn og vent til dens ændringer er skrevet til disk"""
+    global _skriver_pid
+    opgave = {'fn': fn, 'faerdig': threading.Event()}
+    if SKRIV_VINDUE_MS <= 0:
+        _commit([opgave])
+    else:
+        with _koe_betingelse:
+            # Skrivetråden overlever ikke en fork, så start en pr. proces
+            if _skriver_pid != os.getpid():
+                threading.Thread(target=_skriv_loop, name='csv-skriver', daemon=True).start()
+                _skriver_pid = os.getpid()
+            _koe.append(opgave)
+            _koe_betingelse.notify()
+        opgave['faerdig'].wait()
+    if 'fejl' in opgave:
+        raise opgave['fejl']
+    return opgave['resultat']
+
+# Brugere
+def find_bruger(kode):
+    return kode in _tabel(BRUGERFIL)['kode']
+
+def opret_bruger(kode, navn):
+    def fn():
+        tabel = _tabel(BRUGERFIL)
+        if kode in tabel['kode']:
+            return False
+        _gem(BRUGERFIL, BRUGER_FELTER, tabel['rows'] + [raekker.Bruger(kode, navn)], [kode])
+        return True
+    return _transaktion(fn)
+
+def importer_brugere(rows):
+    """Opret brugerne, hvis koderne ikke findes, med ét skriv. Returnerer en bool pr. række."""
+    def fn():
+        tabel = _tabel(BRUGERFIL)
+        kendte = tabel['kode']
+        oprettet = [row['kode'] not in kendte for row in rows]
+        nye = [raekker.Bruger(row['kode'], row['navn'])
+               for row, ny in zip(rows, oprettet) if ny]
+        if nye:
+            _gem(BRUGERFIL, BRUGER_FELTER, tabel['rows'] + nye, [row.kode for row in nye])
+        return oprettet
+    return _transaktion(fn)
+
+def hent_alle_brugere():
+    return _read_csv(BRUGERFIL)
+
+# Bøger
+def find_bog(kode):
+    return kode in _tabel(BOGFIL)['kode']
+
+def _gem_boeger(tabel, rows, koder, aendring):
+    """Gem bogtabellen og flyt søgeindekset med, hvis det er bygget"""
+    indeks = tabel.get('soeg')
+    _gem(BOGFIL, BOG_FELTER, rows, koder)
+    if indeks is not None:
+        aendring(indeks)
+        _cache[BOGFIL]['soeg'] = indeks
+
+def opret_bog(kode, titel, forfatter, placering):
+    def fn():
+        tabel = _tabel(BOGFIL)
+        if kode in tabel['kode']:
+            return False
+        bog = raekker.Bog(kode, titel, forfatter, placering)
+        _gem_boeger(tabel, tabel['rows'] + [bog], [kode],
+                    lambda indeks: soegning.tilfoej(indeks, bog))
+        return True
+    return _transaktion(fn)
+
+def importer_boeger(rows):
+    """Opret bøgerne, hvis koderne ikke findes, med ét skriv. Returnerer en bool pr. række."""
+    def fn():
+        tabel = _tabel(BOGFIL)
+        kendte = tabel['kode']
+        oprettet = [row['kode'] not in kendte for row in rows]
+        nye = [raekker.Bog(row['kode'], row['titel'], row['forfatter'], row['placering'])
+               for row, ny in zip(rows, oprettet) if ny]
+        if nye:
+            _gem_boeger(tabel, tabel['rows'] + nye, [row.kode for row in nye],
+                        lambda indeks: soegning.tilfoej_mange(indeks, nye))
+        return oprettet
+    return _transaktion(fn)
+
+def hent_bog(kode):
+    bog = _tabel(BOGFIL)['kode'].get(kode)
+    return bog.som_dict() if bog is not None else None
+
+def hent_alle_boeger():
+    return _read_csv(BOGFIL)
+
+# Søgeindekset hører til den cachede bogtabel og følger med i _gem_boeger().
+# Når en anden proces har ændret filen, synkroniseres det forrige indeks med
+# den genindlæste tabel.
+_sidste_soegeindeks = None
+
+def _soegeindeks():
+    global _sidste_soegeindeks
+    tabel = _tabel(BOGFIL)
+    metrikker.cache('soegeindeks', 'soeg' in tabel)
+    if 'soeg' not in tabel:
+        with _laas_traad:
+            if 'soeg' not in tabel:
+                tabel['soeg'] = soegning.synkroniser(_sidste_soegeindeks, tabel['rows'])
+                _sidste_soegeindeks = tabel['soeg']
+    return tabel['soeg']
+
+def soeg_boeger(tekst, side, antal):
+    return soegning.soeg(_soegeindeks(), tekst, side, antal)
+
+# Udlånsvisning. Hvert udlån i hukommelsen er beriget med brugernavn og
+# titel, så oversigten og eksporten kan læse dem direkte. Alle udlån med
+# samme kode deler ét raekker.Navn, så en oprettet eller slettet bruger
+# eller bog kun ændrer det ene navn og ikke skal findes i udlånene.
+# Egne ændringer rettes i _gem(); har en anden proces ændret filen,
+# sammenlignes navnene med den genindlæste tabel ved næste læsning.
+UKENDT_BRUGERNAVN = 'Ukendt bruger'
+UKENDT_TITEL = 'Ukendt titel'
+_NAVNEFELTER = {BRUGERFIL: ('navn', UKENDT_BRUGERNAVN), BOGFIL: ('titel', UKENDT_TITEL)}
+_navne = {BRUGERFIL: {}, BOGFIL: {}}       # fil -> {kode: Navn}
+_navne_fra = {BRUGERFIL: None, BOGFIL: None}  # fil -> tabellen, navnene passer til
+_navneversion = 0  # Tælles op, når et navn ændres
+
+def _navn(filepath, tabel, kode):
+    felt, ukendt = _NAVNEFELTER[filepath]
+    row = tabel['kode'].get(kode)
+    return getattr(row, felt) if row is not None else ukendt
+
+def _ret_navne(filepath, gammel, koder):
+    """Ret navnene for koderne efter _gem(), hvis de passede til den gamle tabel"""
+    global _navneversion
+    if _navne_fra[filepath] is not gammel:
+        return
+    tabel = _cache[filepath]
+    navne = _navne[filepath]
+    for kode in koder:
+        navn = navne.get(kode)
+        if navn is not None:
+            navn.tekst = _navn(filepath, tabel, kode)
+            _navneversion += 1
+    _navne_fra[filepath] = tabel
+
+def _aktuelle_navne(filepath):
+    """{kode: Navn} for filen, rettet til efter den nuværende tabel"""
+    global _navneversion
+    tabel = _tabel(filepath)
+    navne = _navne[filepath]
+    if _navne_fra[filepath] is not tabel:
+        with _laas_traad:
+            if _navne_fra[filepath] is not tabel:
+                for kode, navn in list(navne.items()):
+                    tekst = _navn(filepath, tabel, kode)
+                    if navn.tekst != tekst:
+                        navn.tekst = tekst
+                        _navneversion += 1
+                _navne_fra[filepath] = tabel
+    return navne
+
+def _berig(rows):
+    """Sæt brugernavn og titel på udlånene"""
+    brugere, boeger = _aktuelle_navne(BRUGERFIL), _aktuelle_navne(BOGFIL)
+    brugertabel, bogtabel = _navne_fra[BRUGERFIL], _navne_fra[BOGFIL]
+    for row in rows:
+        # setdefault, så to tråde ikke kan lave hver sit Navn for samme kode
+        navn = brugere.get(row.bruger)
+        if navn is None:
+            navn = brugere.setdefault(
+                row.bruger, raekker.Navn(_navn(BRUGERFIL, brugertabel, row.bruger)))
+        row.brugernavn = navn
+        titel = boeger.get(row.bog)
+        if titel is None:
+            titel = boeger.setdefault(row.bog, raekker.Navn(_navn(BOGFIL, bogtabel, row.bog)))
+        row.titel = titel
+
+def _visning(fra, til, kun_aktive):
+    """Udlånene til oversigt og eksport, berigede og sorteret efter dato.
+
+    Rækkerne beriges, når de indlæses eller oprettes; her rettes kun navne,
+    som en anden proces har ændret.
+    """
+    _aktuelle_navne(BRUGERFIL)
+    _aktuelle_navne(BOGFIL)
+    return _aabne_udlaan(fra, til) if kun_aktive else _alle_udlaan(fra, til)
+
+# Udlån
+def _aabn(tabel, row):
+    """Føj et åbent udlån til indeksene. Har bogen allerede et åbent udlån,
+    lukkes det ældste af de to, som om bogen blev afleveret, da det nyeste
+    startede. Returnerer det lukkede udlån eller None."""
+    tidligere = tabel['aabne_bog'].get(row.bog)
+    if tidligere is not None:
+        if row.dato < tidligere.dato:
+            row.afleveret = tidligere.dato
+            return row
+        tidligere.afleveret = row.dato
+        _luk(tabel, tidligere)
+    tabel['aabne_bog'][row.bog] = row
+    tabel['aabne_bruger'].setdefault(row.bruger, {})[row.bog] = row
+    forfald = tabel.get('forfald')
+    if forfald is not None:
+        bisect.insort(forfald[1], (_forfald(row, forfald[0]), row.bog))
+    return tidligere
+
+def _luk(tabel, row):
+    del tabel['aabne_bog'][row.bog]
+    aabne = tabel['aabne_bruger'][row.bruger]
+    del aabne[row.bog]
+    if not aabne:
+        del tabel['aabne_bruger'][row.bruger]
+    forfald = tabel.get('forfald')
+    if forfald is not None:
+        liste = forfald[1]
+        del liste[bisect.bisect_left(liste, (_forfald(row, forfald[0]), row.bog))]
+
+def _anvend(tabel, handling, bruger, bog, tidspunkt, forfald=''):
+    tidspunkt = raekker.tid(tidspunkt)
+    if handling == 'udlaan':
+        # Et udlån, der allerede står i snapshottet (f.eks. hvis
+        # komprimeringen blev afbrudt før journalen blev tømt), springes over
+        seneste = tabel['seneste'].get(bog)
+        if seneste is not None and seneste.dato >= tidspunkt:
+            return
+        row = raekker.Udlaan(bruger, bog, tidspunkt, None, raekker.tid(forfald))
+        _berig((row,))
+        tabel['rows'].append(row)
+        tabel['seneste'][bog] = row
+        lukket = _aabn(tabel, row)
+        tabel['version'] += 1
+        _statistik_haendelse(tabel, statistik.udlaan, row)
+        if lukket is not None:
+            _statistik_haendelse(tabel, statistik.aflevering, lukket)
+    elif handling == 'aflevering':
+        # En aflevering kan kun lukke et udlån, der startede før den. Det
+        # gør genafspilningen efter en afbrudt komprimering idempotent.
+        row = tabel['aabne_bog'].get(bog)
+        if row is not None and row.dato <= tidspunkt:
+            row.afleveret = tidspunkt
+            _luk(tabel, row)
+            tabel['version'] += 1
+            _statistik_haendelse(tabel, statistik.aflevering, row)
+
+def _afspil_journal(tabel):
+    """Anvend nye, færdigskrevne linjer i journalen. Returnerer False hvis
+    journalen er blevet udskiftet og tabellen skal indlæses forfra."""
+    try:
+        with open(UDLAANJOURNAL, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            if tabel['journal'] is None:
+                tabel['journal'] = inode
+            elif tabel['journal'] != inode:
+                return False
+            f.seek(tabel['offset'])
+            data = f.read()
+    except FileNotFoundError:
+        return tabel['journal'] is None
+    if data:
+        _laest(UDLAANJOURNAL, len(data))
+    slut = data.rfind(b'\n') + 1
+    for linje in csv.reader(io.StringIO(data[:slut].decode('utf-8'))):
+        tabel['linjer'] += 1
+        if len(JOURNAL_FELTER) - 1 <= len(linje) <= len(JOURNAL_FELTER):
+            try:
+                _anvend(tabel, *linje)
+            except ValueError:
+                _afvis(UDLAANJOURNAL, [(tabel['linjer'], linje)])
+                continue
+            tabel['poster'] += 1
+    tabel['offset'] += slut
+    return True
+
+def _udlaan_aktuel(tabel):
+    journal = _signatur(UDLAANJOURNAL)
+    inode, stoerrelse = (journal[0], journal[1]) if journal else (None, 0)
+    return (tabel['snapshot'] == _signatur(UDLAANFIL)
+            and tabel['journal'] == inode and tabel['offset'] == stoerrelse)
+
+def _udlaan():
+    """Returnér udlånstabellen: snapshottet i UDLAANFIL med journalen lagt oveni"""
+    tabel = _cache.get(UDLAANFIL)
+    if tabel is not None and _udlaan_aktuel(tabel):
+        metrikker.cache('udlaan', True)
+        return tabel
+
+    metrikker.cache('udlaan', False)
+    with _laas(fcntl.LOCK_SH):
+        tabel = _cache.get(UDLAANFIL)
+        if tabel is not None and tabel['snapshot'] == _signatur(UDLAANFIL):
+            if _afspil_journal(tabel):
+                return tabel
+
+        snapshot, rows = _laes_fil(UDLAANFIL, raekker.Udlaan)
+        tabel = {
+            'snapshot': snapshot,
+            'journal': None,
+            'offset': 0,
+            'poster': 0,
+            'linjer': 0,
+            'version': 0,
+            'rows': rows,
+            'seneste': {row.bog: row for row in rows},
+            # Indeks over åbne udlån: bog -> udlån og bruger -> {bog: udlån}
+            'aabne_bog': {},
+            'aabne_bruger': {},
+        }
+        # Indeksene og navnene bygges uden den cykliske GC (se raekker.uden_gc)
+        with raekker.uden_gc():
+            for row in rows:
+                if row.afleveret is None:
+                    _aabn(tabel, row)
+            _berig(rows)
+        _afviste.pop(UDLAANJOURNAL, None)  # Journalen afspilles forfra
+        _afspil_journal(tabel)
+        _cache[UDLAANFIL] = tabel
+    return tabel
+
+def _journalfoer(handling, bruger_kode, bog_kode, dage=None):
+    """Anvend hændelsen på udlånstabellen; linjen skrives når gruppen committes.
+    Et udlån forfalder om dage dage."""
+    nu = datetime.now()
+    felter = [handling, bruger_kode, bog_kode, nu.isoformat()]
+    if dage is not None:
+        felter.append((nu + timedelta(days=dage)).isoformat())
+    linje = io.StringIO()
+    csv.writer(linje).writerow(felter)
+    _anvend(_udlaan(), *felter)
+    _gruppe['journal'].append(linje.getvalue())
+
+# Arkiv
+def _dato(row):
+    return row.dato
+
+def _arkivfil(maaned):
+    return os.path.join(ARKIVMAPPE, f'udlaan-{maaned}.csv')
+
+def _arkiv_maaneder(fra=None, til=None):
+    """Arkivets måneder (ÅÅÅÅ-MM) i rækkefølge, der kan have udlån i [fra, til)"""
+    try:
+        navne = os.listdir(ARKIVMAPPE)
+    except FileNotFoundError:
+        return []
+    maaneder = sorted(navn[7:-4] for navn in navne
+                      if navn.startswith('udlaan-') and navn.endswith('.csv'))
+    return [m for m in maaneder if (not fra or m >= fra[:7]) and (not til or f'{m}-01' < til)]
+
+def _arkiv(maaned):
+    """Månedens arkiverede udlån sorteret efter dato (cachet som en tabel)"""
+    tabel = _tabel(_arkivfil(maaned))
+    if 'beriget' not in tabel:
+        _berig(tabel['rows'])
+        tabel['beriget'] = True
+    return tabel['rows']
+
+def _i_arkiv(row):
+    rows = _arkiv(raekker.maaned(row.dato))
+    i = bisect.bisect_left(rows, row.dato, key=_dato)
+    while i < len(rows) and rows[i].dato == row.dato:
+        if rows[i].bog == row.bog:
+            return True
+        i += 1
+    return False
+
+def _arkiver(maaned, rows):
+    """Føj udlånene til månedens arkivfil; dem, der allerede står der, springes over"""
+    filepath = _arkivfil(maaned)
+    gamle = _arkiv(maaned)
+    kendte = {(row.bog, row.dato) for row in gamle}
+    nye = [row for row in rows if (row.bog, row.dato) not in kendte]
+    if not nye:
+        return
+    samlet = sorted(gamle + nye, key=_dato)
+    os.makedirs(ARKIVMAPPE, exist_ok=True)
+    _gem_afviste(filepath)
+    _write_csv(filepath, UDLAAN_FELTER, samlet)
+    _skriv_binaer(filepath, raekker.Udlaan, samlet)
+    _cache[filepath] = _ny_tabel(_signatur(filepath), samlet, raekker.Udlaan)
+    _cache[filepath]['beriget'] = True
+
+def _i_interval(rows, fra, til):
+    """Rækkerne med udlånsdato i [fra, til); fra og til er heltal eller None"""
+    if fra is None and til is None:
+        return rows
+    return [row for row in rows
+            if (fra is None or row.dato >= fra) and (til is None or row.dato < til)]
+
+_samlet = None
+
+def _alle_udlaan(fra=None, til=None):
+    """Udlån med udlånsdato i [fra, til) sorteret efter dato, fra UDLAANFIL og
+    de måneder i arkivet, der er med i intervallet"""
+    global _samlet
+    tabel = _udlaan()
+    version = tabel['version']
+    gemt = _samlet
+    if gemt is not None and gemt[0] is tabel and gemt[1:4] == (version, fra, til):
+        return gemt[4]
+
+    fra_tid, til_tid = raekker.tid(fra), raekker.tid(til)
+    # UDLAANFIL er i skriverækkefølge, som ikke altid er datoorden (rettede
+    # filer, udlån fra en anden proces med et lidt skævt ur)
+    rows = _i_interval(list(tabel['rows']), fra_tid, til_tid)
+    rows.sort(key=_dato)
+    maaneder = _arkiv_maaneder(fra, til)
+    if maaneder:
+        # Efter en afbrudt komprimering kan et afleveret udlån både stå i
+        # UDLAANFIL og i arkivet, indtil den næste komprimering rydder op
+        med = set(maaneder)
+        rows = [row for row in rows if not (
+            row.afleveret is not None and raekker.maaned(row.dato) in med and _i_arkiv(row))]
+        dele = [rows]
+        for maaned in maaneder:
+            arkiv = _arkiv(maaned)
+            start = bisect.bisect_left(arkiv, fra_tid, key=_dato) if fra else 0
+            slut = bisect.bisect_left(arkiv, til_tid, key=_dato) if til else len(arkiv)
+            dele.append(arkiv[start:slut])
+        rows = list(heapq.merge(*dele, key=_dato))
+    _samlet = (tabel, version, fra, til, rows)
+    return rows
+
+def komprimer_udlaan():
+    """Fold journalen ind i UDLAANFIL, flyt afleverede udlån til arkivet og
+    start en ny, tom journal"""
+    with _laas(fcntl.LOCK_EX):
+        tabel = _udlaan()
+        if not tabel['poster'] and len(tabel['aabne_bog']) == len(tabel['rows']):
+            return False
+
+        aabne = {id(row) for row in tabel['aabne_bog'].values()}
+        varme, maaneder = [], {}
+        for row in tabel['rows']:
+            if id(row) in aabne:
+                varme.append(row)
+            else:
+                maaneder.setdefault(raekker.maaned(row.dato), []).append(row)
+        # Arkivet skrives først; afbrydes vi, før UDLAANFIL er skrevet, står
+        # udlånene begge steder, og næste komprimering springer dem over
+        for maaned, rows in maaneder.items():
+            _arkiver(maaned, rows)
+        _gem_afviste(UDLAANFIL)
+        _gem_afviste(UDLAANJOURNAL)
+        _write_csv(UDLAANFIL, UDLAAN_FELTER, varme)
+        _skriv_binaer(UDLAANFIL, raekker.Udlaan, varme)
+        _erstat_fil(UDLAANJOURNAL, lambda f: None)
+        tabel['rows'] = varme
+        tabel['version'] += 1
+        _statistik['udlaan'] = None  # De afleverede tælles nu med i arkivet
+        tabel['snapshot'] = _signatur(UDLAANFIL)
+        tabel['journal'] = _signatur(UDLAANJOURNAL)[0]
+        tabel['offset'] = 0
+        tabel['poster'] = 0
+        tabel['linjer'] = 0
+    return True
+
+# Statistik. _statistik['samlet'] er aggregatet over alle udlån: hver
+# arkivmåned har sit eget, der bygges, når månedsfilen er ny eller ændret,
+# og udlånene i UDLAANFIL og journalen har ét, som _anvend() holder ved
+# lige sammen med det samlede. En ændret måned eller en genindlæst
+# udlånstabel trækkes fra og lægges til igen, så resten ikke bygges om.
+_statistik = {
+    'samlet': statistik.tomt(),
+    'maaneder': {},     # måned -> (filens signatur, aggregat)
+    'udlaan': None,     # udlånstabellen, 'aktuelt' er bygget over
+    'aktuelt': statistik.tomt(),
+}
+
+def _maanedsstatistik(maaned):
+    """(signatur, aggregat) for arkivmåneden"""
+    filepath = _arkivfil(maaned)
+    tabel = _cache.get(filepath)
+    if tabel is not None and tabel['signatur'] == _signatur(filepath):
+        return tabel['signatur'], statistik.byg(tabel['rows'])
+    # Rækkerne gemmes ikke i cachen; statistikken skal ikke holde hele
+    # arkivet i hukommelsen
+    signatur, rows = _laes_fil(filepath, raekker.Udlaan)
+    return signatur, statistik.byg(rows)
+
+def _statistik_aktuel():
+    """Ret det samlede aggregat til efter arkivet og udlånstabellen. Kaldes under _laas."""
+    samlet = _statistik['samlet']
+    maaneder = _statistik['maaneder']
+    aktuelle = _arkiv_maaneder()
+    for maaned in set(maaneder) - set(aktuelle):
+        statistik.traek_fra(samlet, maaneder.pop(maaned)[1])
+    for maaned in aktuelle:
+        gemt = maaneder.get(maaned)
+        if gemt is None or gemt[0] != _signatur(_arkivfil(maaned)):
+            maaneder[maaned] = _maanedsstatistik(maaned)
+            if gemt is not None:
+                statistik.traek_fra(samlet, gemt[1])
+            statistik.laeg_til(samlet, maaneder[maaned][1])
+
+    tabel = _udlaan()
+    if _statistik['udlaan'] is not tabel:
+        # Afleverede udlån, der også står i arkivet, tælles der
+        rows = [row for row in tabel['rows'] if row.afleveret is None or not _i_arkiv(row)]
+        statistik.traek_fra(samlet, _statistik['aktuelt'])
+        _statistik['aktuelt'] = statistik.byg(rows)
+        statistik.laeg_til(samlet, _statistik['aktuelt'])
+        _statistik['udlaan'] = tabel
+    return tabel
+
+def _statistik_haendelse(tabel, haendelse, row):
+    if _statistik['udlaan'] is tabel:
+        haendelse(_statistik['aktuelt'], row)
+        haendelse(_statistik['samlet'], row)
+
+def hent_statistik(sidste_dag, dage, top, nu, standard_dage):
+    brugere, boeger = _tabel(BRUGERFIL), _tabel(BOGFIL)
+    with _laas(fcntl.LOCK_SH):
+        tabel = _statistik_aktuel()
+        forfald = _forfaldsindeks(tabel, standard_dage)
+        return statistik.rapport(_statistik['samlet'], len(tabel['aabne_bog']),
+                                 bisect.bisect_left(forfald, (raekker.tid(nu),)),
+                                 sidste_dag, dage, top,
+                                 lambda kode: _navn(BRUGERFIL, brugere, kode),
+                                 lambda kode: _navn(BOGFIL, boeger, kode))
+
+def genopbyg_statistik():
+    """Byg statistikken forfra ud fra udlånstabellen og arkivfilerne"""
+    with _laas(fcntl.LOCK_SH):
+        _statistik.update(samlet=statistik.tomt(), maaneder={}, udlaan=None,
+                          aktuelt=statistik.tomt())
+        _statistik_aktuel()
+
+def start_komprimering(interval):
+    """Start en baggrundstråd, der komprimerer journalen hvert interval sekunder"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                komprimer_udlaan()
+            except OSError:
+                pass  # Prøv igen ved næste interval
+    threading.Thread(target=loop, name='udlaan-komprimering', daemon=True).start()
+
+def bog_udlaant(bog_kode):
+    return bog_kode in _udlaan()['aabne_bog']
+
+def registrer_udlaan(bruger_kode, bog_kode, dage):
+    _transaktion(lambda: _journalfoer('udlaan', bruger_kode, bog_kode, dage))
+
+def _checkout(bruger_kode, bog_kode, dage):
+    if bruger_kode not in _tabel(BRUGERFIL)['kode']:
+        return UKENDT_BRUGER
+    if bog_kode not in _tabel(BOGFIL)['kode']:
+        return UKENDT_BOG
+    if bog_kode in _udlaan()['aabne_bog']:
+        return ALLEREDE_UDLAANT
+    _journalfoer('udlaan', bruger_kode, bog_kode, dage)
+    return UDLAAN_OK
+
+def checkout(bruger_kode, bog_kode, dage):
+    """Tjek bruger, bog og om bogen er ude, og registrér udlånet under én lås"""
+    return _transaktion(lambda: _checkout(bruger_kode, bog_kode, dage))
+
+def registrer_udlaan_batch(poster, dage):
+    """Registrér en liste af (bruger, bog) i én commit med et resultat pr. udlån"""
+    return _transaktion(lambda: [_checkout(bruger, bog, dage) for bruger, bog in poster])
+
+def _aflever(bog_kode):
+    if bog_kode not in _udlaan()['aabne_bog']:
+        return False
+    _journalfoer('aflevering', '', bog_kode)
+    return True
+
+def registrer_aflevering(bog_kode):
+    return _transaktion(lambda: _aflever(bog_kode))
+
+def registrer_aflevering_batch(bog_koder):
+    """Registrér en liste af afleveringer i én commit med et resultat pr. bog"""
+    return _transaktion(lambda: [_aflever(bog) for bog in bog_koder])
+
+def hent_aabent_udlaan(bog_kode):
+    """Bogens åbne udlån med brugernavn og titel som i oversigten, eller None"""
+    _aktuelle_navne(BRUGERFIL)
+    _aktuelle_navne(BOGFIL)
+    row = _udlaan()['aabne_bog'].get(bog_kode)
+    return _udlaan_raekke(row) if row is not None else None
+
+# Forfald. De åbne udlån står i tabel['forfald'] sorteret efter forfaldsdato
+# som (forfald, bog), så de forfaldne er et udsnit, der findes med bisect.
+# Listen bygges ved første opslag og holdes ved lige af _aabn() og _luk().
+# Udlån uden forfaldsdato forfalder standardperioden efter udlånsdatoen;
+# skifter perioden, bygges listen igen.
+_DAG = 86400 * 1000000
+
+def _forfald(row, standard):
+    return row.forfald if row.forfald is not None else row.dato + standard
+
+def _forfaldsindeks(tabel, standard_dage):
+    """Den sorterede liste af (forfald, bog) for udlånstabellen"""
+    standard = standard_dage * _DAG
+    forfald = tabel.get('forfald')
+    metrikker.cache('forfald', forfald is not None and forfald[0] == standard)
+    if forfald is None or forfald[0] != standard:
+        with _laas_traad:
+            forfald = tabel.get('forfald')
+            if forfald is None or forfald[0] != standard:
+                forfald = tabel['forfald'] = (standard, sorted(
+                    (_forfald(row, standard), row.bog) for row in tabel['aabne_bog'].values()))
+    return forfald[1]
+
+def hent_forfaldne(fra, til, antal, standard_dage):
+    """De åbne udlån med forfaldsdato i [fra, til) efter forfaldsdato, højst antal"""
+    _aktuelle_navne(BRUGERFIL)
+    _aktuelle_navne(BOGFIL)
+    tabel = _udlaan()
+    forfald = _forfaldsindeks(tabel, standard_dage)
+    start = bisect.bisect_left(forfald, (raekker.tid(fra),)) if fra else 0
+    slut = bisect.bisect_left(forfald, (raekker.tid(til),)) if til else len(forfald)
+    if antal is not None:
+        slut = min(slut, start + antal)
+    aabne = tabel['aabne_bog']
+    udlaan = []
+    for tid, bog in forfald[start:slut]:
+        row = aabne.get(bog)
+        if row is not None:  # Afleveret imens
+            udlaan.append(dict(_udlaan_raekke(row), forfald=raekker.tekst(tid)))
+    return udlaan
+
+def hent_udlaan_for_bruger(bruger_kode):
+    aabne = _udlaan()['aabne_bruger'].get(bruger_kode, {})
+    return [row.som_dict() for row in list(aabne.values())]
+
+def hent_alle_udlaan(fra, til):
+    """Returnér alle udlån (også dem der er afleveret) sorteret efter dato"""
+    return [row.som_dict() for row in _alle_udlaan(fra, til)]
+
+def slet_bruger(kode):
+    def fn():
+        rows = [r for r in _tabel(BRUGERFIL)['rows'] if r.kode != kode]
+        _gem(BRUGERFIL, BRUGER_FELTER, rows, [kode])
+    _transaktion(fn)
+
+def slet_bog(kode):
+    def fn():
+        # Først tjek om bogen er udlånt
+        if kode in _udlaan()['aabne_bog']:
+            return False  # Bogen er stadig udlånt
+
+        # Hvis ikke udlånt, slet fra bogfilen
+        tabel = _tabel(BOGFIL)
+        rows = [r for r in tabel['rows'] if r.kode != kode]
+        _gem_boeger(tabel, rows, [kode], lambda indeks: soegning.fjern(indeks, kode))
+        return True
+    return _transaktion(fn)
+
+def hent_udlaan_med_brugernavn_og_bogtitel(fra, til):
+    udlaan = [_udlaan_raekke(row) for row in _visning(fra, til, False)]
+    for row in udlaan:
+        row['bogtitel'] = row['titel']
+    return udlaan
+
+_eksporteret = None
+
+def eksporter(navn):
+    """Returnér stien til en CSV-fil med hele tabellen"""
+    global _eksporteret
+    if navn == 'udlaan':
+        # Udlånene er delt mellem UDLAANFIL og arkivet; skriv dem samlet,
+        # medmindre filen allerede er skrevet ud fra de samme udlån
+        tabel = _udlaan()
+        version = tabel['version']
+        gemt = _eksporteret
+        if gemt is None or gemt[0] is not tabel or gemt[1:] != (version, _signatur(UDLAANEKSPORT)):
+            _write_csv(UDLAANEKSPORT, UDLAAN_FELTER, _alle_udlaan())
+            _eksporteret = (tabel, version, _signatur(UDLAANEKSPORT))
+        return UDLAANEKSPORT
+    return {'brugere': BRUGERFIL, 'boeger': BOGFIL}[navn]
+
+# Eksport
+_VERSIONSFILER = {
+    'brugere': (BRUGERFIL,),
+    'boeger': (BOGFIL,),
+    'udlaan': (UDLAANFIL, UDLAANJOURNAL),
+}
+
+def tabel_version(navn):
+    """Returnér (version, ændringstidspunkt) ud fra filernes signatur; kun stat"""
+    signaturer = [_signatur(filepath) for filepath in _VERSIONSFILER[navn]]
+    aendret = max((s[2] for s in signaturer if s is not None), default=0) / 1e9
+    return repr(signaturer), aendret
+
+def eksporter_rows(navn, fra, til, kun_aktive, beriget):
+    if navn != 'udlaan':
+        rows = list(_tabel(BRUGERFIL if navn == 'brugere' else BOGFIL)['rows'])
+        return (row.som_dict() for row in rows)
+
+    if beriget:
+        return (_udlaan_raekke(row) for row in _visning(fra, til, kun_aktive))
+    if kun_aktive:
+        rows = _aabne_udlaan(fra, til)
+    else:
+        rows = _alle_udlaan(fra, til)
+    return (row.som_dict() for row in rows)
+
+# Oversigt
+
+# Sorterede udgaver af tabellerne gemmes, indtil tabellerne ændrer sig, så
+# en side uden søgning kun koster et udsnit af den sorterede liste.
+_sorteringer = {}
+
+def _udlaan_raekke(row):
+    return {
+        'bruger': row.bruger,
+        'brugernavn': row.brugernavn.tekst,
+        'bog': row.bog,
+        'titel': row.titel.tekst,
+        'dato': raekker.tekst(row.dato),
+        'afleveret': raekker.tekst(row.afleveret),
+    }
+
+def _aabne_udlaan(fra, til):
+    rows = sorted(_udlaan()['aabne_bog'].values(), key=_dato)
+    return _i_interval(rows, raekker.tid(fra), raekker.tid(til))
+
+def hent_side(tabel, side, antal, sorter, faldende, soeg, kun_aktive, fra, til):
+    if tabel == 'udlaan':
+        udlaan = _udlaan()
+        rows = _visning(fra, til, kun_aktive)
+        kilder = (udlaan,)
+        version = (udlaan['version'], _navneversion, fra, til, id(udlaan))
+        raekke = _udlaan_raekke
+    else:
+        filtabel = _tabel(BRUGERFIL if tabel == 'brugere' else BOGFIL)
+        kilder = (filtabel,)
+        version = (id(filtabel),)
+        rows = list(filtabel['rows'])
+        raekke = raekker.Raekke.som_dict
+
+    if sorter:
+        noegle = (tabel, sorter, kun_aktive)
+        gemt = _sorteringer.get(noegle)
+        metrikker.cache('sortering', gemt is not None and gemt[0] == version)
+        if gemt is None or gemt[0] != version:
+            if tabel == 'udlaan' and sorter in ('brugernavn', 'titel'):
+                sorteret = sorted(rows, key=lambda row: getattr(row, sorter).tekst.lower())
+            elif tabel == 'udlaan' and sorter in ('dato', 'afleveret'):
+                # Tidspunkterne er heltal; åbne udlån (None) kommer først
+                sorteret = sorted(rows, key=lambda row: getattr(row, sorter) or 0)
+            else:
+                sorteret = sorted(rows, key=lambda row: getattr(row, sorter).lower())
+            # Kilderne gemmes med, så deres id'er ikke kan genbruges
+            gemt = _sorteringer[noegle] = (version, kilder, sorteret)
+        rows = gemt[2]
+
+    start = (side - 1) * antal
+    if not soeg:
+        if faldende:
+            slut = max(len(rows) - start, 0)
+            udsnit = rows[max(slut - antal, 0):slut][::-1]
+        else:
+            udsnit = rows[start:start + antal]
+        return [raekke(row) for row in udsnit], len(rows)
+
+    soeg = soeg.lower()
+    if tabel == 'udlaan':
+        # Tidspunkterne er heltal; de skrives kun som tekst, hvis søgningen
+        # overhovedet kan matche et tidspunkt
+        if set(soeg) <= set('0123456789-t:.'):
+            tekster = lambda row: raekke(row).values()
+        else:
+            tekster = lambda row: (row.bruger, row.brugernavn.tekst, row.bog, row.titel.tekst)
+    else:
+        tekster = raekker.Raekke.values
+    fundet = []
+    total = 0
+    for row in reversed(rows) if faldende else rows:
+        if any(soeg in vaerdi.lower() for vaerdi in tekster(row)):
+            if start <= total < start + antal:
+                fundet.append(raekke(row))
+            total += 1
+    return fundet, total
@@ -1,121 +1,444 @@
+"""Bibliotekets dataadgang.
+
+Funktionerne her er grænsefladen mod lageret. Selve lageret er en backend,
+der vælges med miljøvariablen BIBLIOTEK_BACKEND ('csv' eller 'sqlite') eller
+med vaelg_backend(). CSV-filerne i data/ er standard.
+"""
 import csv
+import importlib
+import io
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+import dataversion
+import haendelser
+import metrikker
+
+from csv_backend import UDLAAN_OK, UKENDT_BRUGER, UKENDT_BOG, ALLEREDE_UDLAANT
+
+BACKENDS = {
+    'csv': 'csv_backend',
+    'sqlite': 'sqlite_backend',
+}
+
+_backend = None
+
+def vaelg_backend(navn):
+    global _backend
+    if navn not in BACKENDS:
+        raise ValueError(f"Ukendt backend: {navn!r} (vælg mellem {', '.join(BACKENDS)})")
+    _backend = importlib.import_module(BACKENDS[navn])
+
+vaelg_backend(os.environ.get('BIBLIOTEK_BACKEND', 'csv'))
+
+# Dataversion
+def _skriver(fn):
+    """Tæl dataversionen op efter skrivningen, også hvis den fejlede undervejs"""
+    @wraps(fn)
+    def skriver(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            dataversion.tael_op()
+    return skriver
+
+def hent_dataversion():
+    """En version, der skifter ved hver skrivning gennem data_access, også i
+    andre workers. Læses uden at røre lageret; se dataversion.py.
+
+    Læs den, før data læses, når den bruges som ETag.
+    """
+    return dataversion.version()
+
+# Hændelser
+def _udgiv(*liste):
+    """Udgiv hændelserne (type, data) til live-visningerne; se haendelser.py.
+
+    Skrivningen er allerede sket; kan hændelsen ikke skrives, går den tabt.
+    """
+    try:
+        haendelser.udgiv([h for h in liste if h is not None])
+    except OSError:
+        pass
+
+def _udlaan_haendelse(bog_kode):
+    udlaan = _backend.hent_aabent_udlaan(bog_kode)
+    return ('udlaan', udlaan) if udlaan is not None else None
+
+def _aflevering_haendelse(bog_kode):
+    return ('aflevering', {'bog': bog_kode, 'afleveret': datetime.now().isoformat()})
+
+def abonner_haendelser(sidste_id=None):
+    """En haendelser.Abonnent på skrivningerne efter hændelsen sidste_id, eller fra nu af.
+
+    Hændelserne er 'udlaan' (en række som i oversigten), 'aflevering' {bog,
+    afleveret} med hændelsens tidspunkt, 'bruger_oprettet' {kode, navn},
+    'bruger_slettet' {kode}, 'bog_oprettet' (bogen), 'bog_slettet' {kode},
+    'import' {tabel, oprettet} og 'genindlaes', når hændelser er gået tabt.
+    """
+    return haendelser.abonner(sidste_id)
 
-BRUGERFIL = 'data/brugere.csv'
-BOGFIL = 'data/boeger.csv'
-UDLAANFIL = 'data/udlaan.csv'
+# Vedligehold
+def komprimer_udlaan():
+    return _backend.komprimer_udlaan()
 
-# Hjælpefunktioner
-def _read_csv(filepath):
-    if not os.path.exists(filepath):
-        return []
-    with open(filepath, newline='', encoding='utf-8') as f:
-        return list(csv.DictReader(f))
+def start_komprimering(interval):
+    _backend.start_komprimering(interval)
 
-def _write_csv(filepath, fieldnames, rows):
-    with open(filepath, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+def eksporter(navn):
+    """Returnér stien til en CSV-fil med tabellen 'brugere', 'boeger' eller 'udlaan'"""
+    return _backend.eksporter(navn)
+
+# Eksport
+EKSPORT_FELTER = {
+    'brugere': ['kode', 'navn'],
+    'boeger': ['kode', 'titel', 'forfatter', 'placering'],
+    'udlaan': ['bruger', 'bog', 'dato', 'afleveret', 'forfald'],
+}
+BERIGET_UDLAAN_FELTER = ['bruger', 'brugernavn', 'bog', 'titel', 'dato', 'afleveret']
+
+def tabel_version(navn):
+    """Returnér (version, ændringstidspunkt som epoch-sekunder) for tabellen.
+
+    Versionen skifter ved hver ændring og kan bruges som ETag uden at
+    tabellen læses.
+    """
+    return _backend.tabel_version(navn)
+
+def _interval(fra, til):
+    # Backends filtrerer på ISO-tekst med til eksklusiv
+    return (fra.isoformat() if fra else None,
+            (til + timedelta(days=1)).isoformat() if til else None)
+
+def eksporter_rows(navn, fra=None, til=None, kun_aktive=False, beriget=False):
+    """Returnér en iterator over tabellens rækker i EKSPORT_FELTER-form.
+
+    For udlån kan der filtreres på udlånsdato (fra og til er datetime.date og
+    begge inklusive) og på aktive udlån, og beriget=True tilføjer brugernavn
+    og titel (BERIGET_UDLAAN_FELTER).
+    """
+    return _backend.eksporter_rows(navn, *_interval(fra, til), kun_aktive, beriget)
+
+# Import
+IMPORT_KRAEVEDE_FELTER = {
+    'brugere': ['kode', 'navn'],
+    'boeger': ['kode', 'titel'],
+}
+
+def _laes_import(navn, f):
+    """Returnér (gyldige rækker, {kode: linje}, fejl, antal datalinjer) fra CSV-filen f"""
+    felter = EKSPORT_FELTER[navn]
+    kraevede = IMPORT_KRAEVEDE_FELTER[navn]
+    # Regneark på dansk gemmer ofte CSV med semikolon
+    foerste = f.readline()
+    skilletegn = ';' if foerste.count(';') > foerste.count(',') else ','
+    overskrift = [felt.strip().lower() for felt in next(csv.reader([foerste], delimiter=skilletegn), [])]
+    mangler = [felt for felt in kraevede if felt not in overskrift]
+    if mangler:
+        raise ValueError(f"Filen skal have en overskrift med kolonnerne {', '.join(kraevede)} "
+                         f"(mangler {', '.join(mangler)})")
+    pladser = [overskrift.index(felt) if felt in overskrift else None for felt in felter]
+
+    rows, fejl, linjer = [], [], 0
+    linje_for_kode = {}  # kode -> linjen, hvor den første gang stod
+    reader = csv.reader(f, delimiter=skilletegn)
+    for linje in reader:
+        if not any(linje):
+            continue
+        linjer += 1
+        nr = reader.line_num + 1  # Overskriften blev læst uden om reader
+        row = {felt: linje[i].strip() if i is not None and i < len(linje) else ''
+               for felt, i in zip(felter, pladser)}
+        tomme = [felt for felt in kraevede if not row[felt]]
+        if tomme:
+            fejl.append({'linje': nr, 'kode': row['kode'], 'fejl': f"Mangler {' og '.join(tomme)}"})
+        elif row['kode'] in linje_for_kode:
+            fejl.append({'linje': nr, 'kode': row['kode'],
+                         'fejl': f"Koden står også i linje {linje_for_kode[row['kode']]}"})
+        else:
+            linje_for_kode[row['kode']] = nr
+            rows.append(row)
+    return rows, linje_for_kode, fejl, linjer
+
+def _importer(navn, fil, opret):
+    tekst = io.TextIOWrapper(fil, encoding='utf-8-sig', newline='')
+    try:
+        rows, linje_for_kode, fejl, linjer = _laes_import(navn, tekst)
+    except UnicodeDecodeError:
+        raise ValueError("Filen er ikke gemt som UTF-8") from None
+    except csv.Error as e:
+        raise ValueError(f"Filen kunne ikke læses som CSV: {e}") from None
+    finally:
+        tekst.detach()  # Luk ikke kalderens fil
+
+    oprettet = opret(rows) if rows else []
+    fejl.extend({'linje': linje_for_kode[row['kode']], 'kode': row['kode'],
+                 'fejl': "Koden findes allerede"}
+                for row, ny in zip(rows, oprettet) if not ny)
+    fejl.sort(key=lambda f: f['linje'])
+    return {'linjer': linjer, 'oprettet': sum(oprettet), 'fejl': fejl}
+
+@_skriver
+def importer_brugere(fil):
+    """Opret brugerne i en CSV-fil (binært filobjekt, UTF-8) med ét skriv.
+
+    Filen skal have en overskrift med kode og navn; andre kolonner
+    ignoreres. Rækker uden kode eller navn, koder der står flere gange i
+    filen, og koder der findes i forvejen, oprettes ikke, men står i 'fejl'.
+    Returnerer {'linjer': antal datalinjer, 'oprettet': antal, 'fejl': [...]}.
+    Rejser ValueError, hvis filen som helhed ikke kan læses.
+    """
+    resultat = _importer('brugere', fil, _backend.importer_brugere)
+    if resultat['oprettet']:
+        _udgiv(('import', {'tabel': 'brugere', 'oprettet': resultat['oprettet']}))
+    return resultat
+
+@_skriver
+def importer_boeger(fil):
+    """Opret bøgerne i en CSV-fil som importer_brugere(). Kræver kode og titel."""
+    resultat = _importer('boeger', fil, _backend.importer_boeger)
+    if resultat['oprettet']:
+        _udgiv(('import', {'tabel': 'boeger', 'oprettet': resultat['oprettet']}))
+    return resultat
 
 # Brugere
 def find_bruger(kode):
-    return any(row['kode'] == kode for row in _read_csv(BRUGERFIL))
+    return _backend.find_bruger(kode)
 
+@_skriver
 def opret_bruger(kode, navn):
-    if find_bruger(kode):
-        return False
-    rows = _read_csv(BRUGERFIL)
-    rows.append({'kode': kode, 'navn': navn})
-    _write_csv(BRUGERFIL, ['kode', 'navn'], rows)
-    return True
+    oprettet = _backend.opret_bruger(kode, navn)
+    if oprettet:
+        _udgiv(('bruger_oprettet', {'kode': kode, 'navn': navn}))
+    return oprettet
 
 def hent_alle_brugere():
-    return _read_csv(BRUGERFIL)
+    return _backend.hent_alle_brugere()
+
+@_skriver
+def slet_bruger(kode):
+    _backend.slet_bruger(kode)
+    _udgiv(('bruger_slettet', {'kode': kode}))
 
 # Bøger
 def find_bog(kode):
-    return any(row['kode'] == kode for row in _read_csv(BOGFIL))
+    return _backend.find_bog(kode)
 
+@_skriver
 def opret_bog(kode, titel, forfatter, placering):
-    if find_bog(kode):
-        return False
-    rows = _read_csv(BOGFIL)
-    rows.append({
-        'kode': kode,
-        'titel': titel,
-        'forfatter': forfatter,
-        'placering': placering
-    })
-    _write_csv(BOGFIL, ['kode', 'titel', 'forfatter', 'placering'], rows)
-    return True
+    oprettet = _backend.opret_bog(kode, titel, forfatter, placering)
+    if oprettet:
+        _udgiv(('bog_oprettet', {'kode': kode, 'titel': titel, 'forfatter': forfatter,
+                                 'placering': placering}))
+    return oprettet
+
+def hent_bog(kode):
+    return _backend.hent_bog(kode)
 
 def hent_alle_boeger():
-    return _read_csv(BOGFIL)
+    return _backend.hent_alle_boeger()
+
+@_skriver
+def slet_bog(kode):
+    slettet = _backend.slet_bog(kode)
+    if slettet:
+        _udgiv(('bog_slettet', {'kode': kode}))
+    return slettet
+
+def soeg_boeger(tekst, side=1, antal=20):
+    """Søg i titel, forfatter og placering. Se soegning.py.
+
+    Returnerer et dict med bøgerne på siden (bedste match først, med
+    'relevans'), antal fundne i alt og de (rettede) parametre.
+    """
+    antal = min(max(antal, 1), MAKS_SIDESTOERRELSE)
+    side = max(side, 1)
+    rows, total = _backend.soeg_boeger(tekst, side, antal)
+    return {
+        'rows': rows,
+        'total': total,
+        'side': side,
+        'sider': max((total + antal - 1) // antal, 1),
+        'antal': antal,
+        'soeg': tekst,
+    }
 
 # Udlån
+# Et udlån forfalder UDLAANSPERIODE_DAGE efter udlånet, medmindre der gives
+# et andet antal dage, og forfaldsdatoen gemmes på udlånet. Udlån fra før
+# forfaldsdatoerne forfalder UDLAANSPERIODE_DAGE efter udlånsdatoen.
+UDLAANSPERIODE_DAGE = int(os.environ.get('BIBLIOTEK_UDLAANSPERIODE_DAGE', '30'))
+
+def _periode(dage):
+    return UDLAANSPERIODE_DAGE if dage is None else dage
+
 def bog_udlaant(bog_kode):
-    for row in _read_csv(UDLAANFIL):
-        if row['bog'] == bog_kode and not row.get('afleveret'):
-            return True
-    return False
-
-def registrer_udlaan(bruger_kode, bog_kode):
-    rows = _read_csv(UDLAANFIL)
-    rows.append({
-        'bruger': bruger_kode,
-        'bog': bog_kode,
-        'dato': datetime.now().isoformat(),
-        'afleveret': ''
-    })
-    _write_csv(UDLAANFIL, ['bruger', 'bog', 'dato', 'afleveret'], rows)
+    return _backend.bog_udlaant(bog_kode)
 
+@_skriver
+def registrer_udlaan(bruger_kode, bog_kode, dage=None):
+    _backend.registrer_udlaan(bruger_kode, bog_kode, _periode(dage))
+    _udgiv(_udlaan_haendelse(bog_kode))
+
+@_skriver
+def checkout(bruger_kode, bog_kode, dage=None):
+    """Registrér et udlån, hvis brugeren og bogen findes og bogen ikke er ude.
+    Udlånet forfalder om dage dage (standard: UDLAANSPERIODE_DAGE).
+
+    Returnerer UDLAAN_OK, UKENDT_BRUGER, UKENDT_BOG eller ALLEREDE_UDLAANT.
+    """
+    resultat = _backend.checkout(bruger_kode, bog_kode, _periode(dage))
+    if resultat == UDLAAN_OK:
+        _udgiv(_udlaan_haendelse(bog_kode))
+    return resultat
+
+@_skriver
+def registrer_udlaan_batch(poster, dage=None):
+    """Registrér en liste af (bruger, bog) på én gang.
+
+    Returnerer et checkout()-resultat pr. udlån, i samme rækkefølge.
+    """
+    resultater = _backend.registrer_udlaan_batch(poster, _periode(dage))
+    _udgiv(*(_udlaan_haendelse(bog) for (_, bog), resultat in zip(poster, resultater)
+             if resultat == UDLAAN_OK))
+    return resultater
+
+@_skriver
 def registrer_aflevering(bog_kode):
-    rows = _read_csv(UDLAANFIL)
-    updated = False
-    for row in rows:
-        if row['bog'] == bog_kode and not row.get('afleveret'):
-            row['afleveret'] = datetime.now().isoformat()
-            updated = True
-            break
-    if updated:
-        _write_csv(UDLAANFIL, ['bruger', 'bog', 'dato', 'afleveret'], rows)
-    return updated
+    afleveret = _backend.registrer_aflevering(bog_kode)
+    if afleveret:
+        _udgiv(_aflevering_haendelse(bog_kode))
+    return afleveret
+
+@_skriver
+def registrer_aflevering_batch(bog_koder):
+    """Registrér en liste af afleveringer på én gang. Returnerer en bool pr. bog."""
+    afleveret = _backend.registrer_aflevering_batch(bog_koder)
+    _udgiv(*(_aflevering_haendelse(bog) for bog, ok in zip(bog_koder, afleveret) if ok))
+    return afleveret
 
 def hent_udlaan_for_bruger(bruger_kode):
-    return [
-        row for row in _read_csv(UDLAANFIL)
-        if row['bruger'] == bruger_kode and not row.get('afleveret')
-    ]
+    return _backend.hent_udlaan_for_bruger(bruger_kode)
 
-def hent_alle_udlaan():
-    """Returnér alle udlån (også dem der er afleveret)"""
-    return _read_csv(UDLAANFIL)
+# Forfald
+def hent_overskredne(antal=None):
+    """De åbne udlån, hvis forfaldsdato er passeret, længst overskredne først.
 
-def slet_bruger(kode):
-    rows = [r for r in _read_csv(BRUGERFIL) if r['kode'] != kode]
-    _write_csv(BRUGERFIL, ['kode', 'navn'], rows)
+    Rækkerne er som i oversigten (SIDE_KOLONNER['udlaan']) med 'forfald'.
+    Backenden har de åbne udlån sorteret efter forfaldsdato, så det koster
+    et opslag plus de antal fundne, ikke en gennemgang af udlånene.
+    """
+    return _backend.hent_forfaldne(None, datetime.now().isoformat(), antal, UDLAANSPERIODE_DAGE)
 
-def slet_bog(kode):
-    # Først tjek om bogen er udlånt
-    for row in _read_csv(UDLAANFIL):
-        if row['bog'] == kode and not row.get('afleveret'):
-            return False  # Bogen er stadig udlånt
-
-    # Hvis ikke udlånt, slet fra bogfilen
-    rows = [r for r in _read_csv(BOGFIL) if r['kode'] != kode]
-    _write_csv(BOGFIL, ['kode', 'titel'], rows)
-    return True
-
-def hent_udlaan_med_brugernavn_og_bogtitel():
-    udlaan = _read_csv(UDLAANFIL)
-    brugere = {b['kode']: b['navn'] for b in _read_csv(BRUGERFIL)}
-    boeger = {b['kode']: b['titel'] for b in _read_csv(BOGFIL)}
-
-    # Tilføj navn og titel til udlaan rækkerne
-    for row in udlaan:
-        row['brugernavn'] = brugere.get(row['bruger'], 'Ukendt bruger')
-        row['bogtitel'] = boeger.get(row['bog'], 'Ukendt bog')
-
-    return udlaan
+def hent_forfalder_snart(dage=3, antal=None):
+    """De åbne udlån, der forfalder inden for de næste dage dage, først forfaldne først"""
+    nu = datetime.now()
+    return _backend.hent_forfaldne(nu.isoformat(), (nu + timedelta(days=dage)).isoformat(),
+                                   antal, UDLAANSPERIODE_DAGE)
+
+def hent_alle_udlaan(fra=None, til=None):
+    """Returnér alle udlån (også dem der er afleveret) efter udlånsdato.
+
+    fra og til (datetime.date, begge inklusive) begrænser udlånsdatoen, så
+    kun de nødvendige måneder af arkivet læses.
+    """
+    return _backend.hent_alle_udlaan(*_interval(fra, til))
+
+def hent_udlaan_med_brugernavn_og_bogtitel(fra=None, til=None):
+    """Udlånene som i oversigten (SIDE_KOLONNER['udlaan']) efter udlånsdato.
+
+    Titlen står også som 'bogtitel', som funktionen altid har kaldt den.
+    """
+    return _backend.hent_udlaan_med_brugernavn_og_bogtitel(*_interval(fra, til))
+
+# Statistik
+MAKS_STATISTIK_DAGE = 366
+MAKS_STATISTIK_TOP = 100
+
+def hent_statistik(dage=30, top=10):
+    """Udlån pr. dag de seneste dage dage, de top mest udlånte bøger og mest
+    aktive brugere, gennemsnitlig udlånstid og antal åbne og overskredne udlån.
+
+    Tallene kommer fra aggregater, som udlån og afleveringer holder ved lige;
+    se statistik.rapport() for formen.
+    """
+    dage = min(max(dage, 1), MAKS_STATISTIK_DAGE)
+    top = min(max(top, 1), MAKS_STATISTIK_TOP)
+    nu = datetime.now()
+    resultat = _backend.hent_statistik(nu.date(), dage, top, nu.isoformat(), UDLAANSPERIODE_DAGE)
+    resultat['udlaansperiode_dage'] = UDLAANSPERIODE_DAGE
+    return resultat
+
+def genopbyg_statistik():
+    """Byg statistikken forfra ud fra alle udlån, f.eks. efter en import af gamle udlån"""
+    _backend.genopbyg_statistik()
+
+# Oversigt
+SIDE_KOLONNER = {
+    'brugere': ['kode', 'navn'],
+    'boeger': ['kode', 'titel', 'forfatter', 'placering'],
+    'udlaan': ['bruger', 'brugernavn', 'bog', 'titel', 'dato', 'afleveret'],
+}
+MAKS_SIDESTOERRELSE = 500
+
+def hent_side(tabel, side=1, antal=50, sorter=None, faldende=False, soeg='', kun_aktive=False,
+              fra=None, til=None):
+    """Returnér én side af 'brugere', 'boeger' eller 'udlaan', filtreret og sorteret.
+
+    Udlån får brugernavn og titel med. Søgningen matcher tekst i alle
+    kolonner, kun_aktive begrænser udlån til dem der ikke er afleveret, og
+    fra og til (datetime.date, inklusive) til en periode af udlånsdatoer.
+    Returnerer et dict med rækkerne på siden, antal rækker i alt efter
+    filtrering og de (rettede) parametre.
+    """
+    antal = min(max(antal, 1), MAKS_SIDESTOERRELSE)
+    if sorter not in SIDE_KOLONNER[tabel]:
+        sorter = None
+    if tabel != 'udlaan':
+        kun_aktive, fra, til = False, None, None
+    side = max(side, 1)
+    interval = _interval(fra, til)
+    rows, total = _backend.hent_side(tabel, side, antal, sorter, faldende, soeg, kun_aktive,
+                                     *interval)
+    sider = max((total + antal - 1) // antal, 1)
+    if side > sider:
+        # Siden findes ikke (længere); vis den sidste. Backenden kaldes
+        # direkte, så kaldet kun måles én gang
+        side = sider
+        rows, total = _backend.hent_side(tabel, side, antal, sorter, faldende, soeg, kun_aktive,
+                                         *interval)
+        sider = max((total + antal - 1) // antal, 1)
+    return {
+        'rows': rows,
+        'total': total,
+        'side': side,
+        'sider': sider,
+        'antal': antal,
+        'sorter': sorter,
+        'faldende': faldende,
+        'soeg': soeg,
+        'kun_aktive': kun_aktive,
+        'fra': fra,
+        'til': til,
+    }
+
+# Alle offentlige funktioner tæller kald og tid i metrikker
+def _maalt(fn):
+    kald = metrikker.noegle('bibliotek_data_access_kald_total', funktion=fn.__name__)
+    tid = metrikker.noegle('bibliotek_data_access_seconds_total', funktion=fn.__name__)
+
+    @wraps(fn)
+    def maalt(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrikker.data_access_kald(kald, tid, time.perf_counter() - start)
+    return maalt
+
+for _navn, _fn in list(globals().items()):
+    if (callable(_fn) and getattr(_fn, '__module__', None) == __name__
+            and not _navn.startswith('_') and _navn != 'vaelg_backend'):
+        globals()[_navn] = _maalt(_fn)
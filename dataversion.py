@@ -0,0 +1,72 @@
+"""En global dataversion, som data_access tæller op ved hver skrivning.
+
+Versionen står i en lille fil (DATAVERSIONFIL), som hver proces mmap'er,
+så alle workers ser hinandens skrivninger, og version() er en læsning i
+hukommelsen uden systemkald. Filen starter med et tilfældigt id, der
+laves sammen med filen, så versionerne ikke går igen, hvis filen slettes
+og oprettes forfra. Slettes filen, mens workers kører, ser de dog ikke
+nye skrivninger, før de genstartes.
+
+Til ETag'er: læs versionen, før data læses. Så kan svaret højst være
+nyere end versionen, og det næste opslag henter det igen.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+DATAVERSIONFIL = os.environ.get('BIBLIOTEK_DATAVERSION', 'data/dataversion')
+_FORMAT = struct.Struct('<QQ')  # id, version
+
+_mm = None
+_fd = None
+_pid = None
+# flock'en udelukker andre processer; tråde i samme proces deler filen
+# og skal også udelukke hinanden
+_laas = threading.Lock()
+
+def _efter_fork():
+    global _laas
+    _laas = threading.Lock()
+
+os.register_at_fork(after_in_child=_efter_fork)
+
+def _aaben():
+    """mmap'en af filen; filen åbnes igen efter en fork, så flock'en er processens egen.
+    Kaldes under _laas."""
+    global _mm, _fd, _pid
+    if _pid == os.getpid():
+        return _mm
+    os.makedirs(os.path.dirname(DATAVERSIONFIL) or '.', exist_ok=True)
+    fd = os.open(DATAVERSIONFIL, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        if os.fstat(fd).st_size < _FORMAT.size:
+            os.pwrite(fd, _FORMAT.pack(int.from_bytes(os.urandom(8), 'little'), 0), 0)
+        if _mm is None:
+            _mm = mmap.mmap(fd, _FORMAT.size)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    if _fd is not None:
+        os.close(_fd)
+    _fd, _pid = fd, os.getpid()
+    return _mm
+
+def version():
+    """Versionen som tekst, f.eks. til et ETag"""
+    mm = _mm
+    if mm is None:
+        with _laas:
+            mm = _aaben()
+    return '%016x-%d' % _FORMAT.unpack_from(mm)
+
+def tael_op():
+    with _laas:
+        mm = _aaben()
+        fcntl.flock(_fd, fcntl.LOCK_EX)
+        try:
+            ident, n = _FORMAT.unpack_from(mm)
+            _FORMAT.pack_into(mm, 0, ident, n + 1)
+        finally:
+            fcntl.flock(_fd, fcntl.LOCK_UN)
@@ -0,0 +1,112 @@
+"""Daglige rapporter over overskredne udlån og påmindelser om udlån, der forfalder.
+
+start() starter en tråd, der hver dag kl. RAPPORT_KL skriver to filer i
+RAPPORTMAPPE:
+
+- overskredne-ÅÅÅÅ-MM-DD.csv: de overskredne udlån, længst overskredne først;
+- paamindelser-ÅÅÅÅ-MM-DD.csv: udlån, der forfalder inden for
+  PAAMINDELSE_DAGE dage, samlet pr. bruger, så der kan sendes én
+  påmindelse pr. bruger.
+
+Udlånene findes med data_access.hent_overskredne() og hent_forfalder_snart(),
+der slår op i de åbne udlån sorteret efter forfaldsdato, så historikken
+ikke gennemgås. Kører flere workers, skriver kun én af dem dagens filer:
+de skrives under en flock, og findes de allerede, springes dagen over.
+Startes appen efter RAPPORT_KL, og mangler dagens filer, skrives de med
+det samme.
+"""
+import csv
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import data_access as db
+
+RAPPORTMAPPE = os.environ.get('BIBLIOTEK_RAPPORTMAPPE', 'data/rapporter')
+RAPPORT_KL = os.environ.get('BIBLIOTEK_RAPPORT_KL', '07:00')
+PAAMINDELSE_DAGE = int(os.environ.get('BIBLIOTEK_PAAMINDELSE_DAGE', '3'))
+MAKS_VENT_SEK = 3600  # Så et skift i uret eller dvale ikke forsinker en rapport
+
+OVERSKREDNE_FELTER = ['bruger', 'brugernavn', 'bog', 'titel', 'dato', 'forfald', 'dage_over']
+PAAMINDELSE_FELTER = ['bruger', 'brugernavn', 'bog', 'titel', 'forfald']
+
+
+def _sti(art, dag):
+    return os.path.join(RAPPORTMAPPE, f'{art}-{dag.isoformat()}.csv')
+
+
+def _skriv(sti, felter, rows):
+    tmp = f'{sti}.{os.getpid()}.tmp'
+    with open(tmp, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(felter)
+        writer.writerows([row[felt] for felt in felter] for row in rows)
+    os.replace(tmp, sti)
+
+
+def skriv_rapporter(nu=None):
+    """Skriv dagens rapporter, hvis de ikke findes. Returnerer stierne, der er skrevet."""
+    nu = nu or datetime.now()
+    dag = nu.date()
+    os.makedirs(RAPPORTMAPPE, exist_ok=True)
+    with open(os.path.join(RAPPORTMAPPE, '.laas'), 'a') as laas:
+        fcntl.flock(laas, fcntl.LOCK_EX)
+        skrevet = []
+        sti = _sti('overskredne', dag)
+        if not os.path.exists(sti):
+            overskredne = db.hent_overskredne()
+            for row in overskredne:
+                row['dage_over'] = (nu - datetime.fromisoformat(row['forfald'])).days
+            _skriv(sti, OVERSKREDNE_FELTER, overskredne)
+            skrevet.append(sti)
+        sti = _sti('paamindelser', dag)
+        if not os.path.exists(sti):
+            rows = sorted(db.hent_forfalder_snart(PAAMINDELSE_DAGE),
+                          key=lambda row: (row['bruger'], row['forfald']))
+            _skriv(sti, PAAMINDELSE_FELTER, rows)
+            skrevet.append(sti)
+    return skrevet
+
+
+def rapporter():
+    """[{'navn', 'bytes', 'tidspunkt'}] for de skrevne rapporter, nyeste først"""
+    try:
+        navne = [n for n in os.listdir(RAPPORTMAPPE) if n.endswith('.csv')]
+    except FileNotFoundError:
+        return []
+    filer = []
+    for navn in navne:
+        try:
+            st = os.stat(os.path.join(RAPPORTMAPPE, navn))
+        except FileNotFoundError:
+            continue
+        filer.append({'navn': navn, 'bytes': st.st_size,
+                      'tidspunkt': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(st.st_mtime))})
+    # Navnene slutter med datoen; nyeste dag først, overskredne før påmindelser
+    filer.sort(key=lambda f: (f['navn'][-14:], f['navn']), reverse=True)
+    return filer
+
+
+def _naeste(nu):
+    """Næste tidspunkt kl. RAPPORT_KL efter nu"""
+    kl = datetime.strptime(RAPPORT_KL, '%H:%M').time()
+    naeste = datetime.combine(nu.date(), kl)
+    return naeste if naeste > nu else naeste + timedelta(days=1)
+
+
+def start():
+    """Start tråden, der skriver rapporterne hver dag kl. RAPPORT_KL"""
+    def loop():
+        while True:
+            nu = datetime.now()
+            if _naeste(nu).date() > nu.date():  # Dagens klokkeslæt er passeret
+                try:
+                    skriv_rapporter(nu)
+                except (OSError, sqlite3.Error):
+                    pass  # Prøv igen ved næste interval
+            time.sleep(min(max((_naeste(datetime.now()) - datetime.now()).total_seconds(), 1),
+                           MAKS_VENT_SEK))
+    threading.Thread(target=loop, name='forfald', daemon=True).start()
@@ -0,0 +1,267 @@
+"""Hændelser om udlån, brugere og bøger til live-visninger som adminoversigten.
+
+data_access udgiver hændelser med udgiv() efter skrivningerne. De lægges
+i en fælles log (HAENDELSESFIL), én linje pr. hændelse ('<type> <json>'),
+så alle workers ser hinandens hændelser. Hver proces har én tråd, der
+følger loggen, mens processen har abonnenter, og fordeler nye hændelser
+til dem; egne hændelser sendes med det samme, andres inden for POLL_SEK.
+
+Loggen starter med en linje med et tilfældigt id, og en hændelses id er
+loggens id og positionen efter hændelsen ('<log>-<position>'). En
+abonnent, der kobler til igen med sit sidste id, får de hændelser, den har
+misset. Bliver loggen større end MAKS_BYTES, omdøbes den til
+HAENDELSESFIL.1, og der startes en ny; der kan stadig indhentes fra den
+gamle. Kan hændelserne ikke indhentes (ukendt eller for gammelt id, eller
+abonnenten er mere end MAKS_KOE hændelser bagud), får abonnenten
+hændelsen 'genindlaes' i stedet.
+
+Hændelserne er til visning: to workers' hændelser kan komme i en anden
+rækkefølge end skrivningerne, og lageret er stadig sandheden.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import deque
+
+HAENDELSESFIL = os.environ.get('BIBLIOTEK_HAENDELSER', 'data/haendelser.log')
+MAKS_BYTES = 4 * 1024 * 1024
+MAKS_KOE = 1000
+POLL_SEK = 0.2
+_HOVED = b'haendelser '
+_BLOK = 1 << 20
+
+# Trådens log og position i den; ændres kun under _betingelse. _log er
+# loggens id, eller None indtil første hændelse er skrevet.
+_fd = None
+_log = None
+_pos = 0
+_abonnenter = set()
+_betingelse = threading.Condition()
+_traad_pid = None
+
+def _efter_fork():
+    # Tråden og abonnenterne er forældreprocessens
+    global _fd, _log, _betingelse, _traad_pid
+    _fd = _log = _traad_pid = None
+    _abonnenter.clear()
+    _betingelse = threading.Condition()
+
+os.register_at_fork(after_in_child=_efter_fork)
+
+def udgiv(haendelser):
+    """Læg hændelserne [(type, data)] sidst i loggen med ét skriv"""
+    if not haendelser:
+        return
+    data = ''.join(f'{navn} {json.dumps(d, ensure_ascii=False)}\n'
+                   for navn, d in haendelser).encode('utf-8')
+    os.makedirs(os.path.dirname(HAENDELSESFIL) or '.', exist_ok=True)
+    while True:
+        fd = os.open(HAENDELSESFIL, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            st = os.fstat(fd)
+            try:
+                aktuel = os.stat(HAENDELSESFIL).st_ino == st.st_ino
+            except FileNotFoundError:
+                aktuel = False
+            if not aktuel:
+                continue  # En anden proces har omdøbt loggen, mens vi ventede
+            if st.st_size + len(data) > MAKS_BYTES and st.st_size > len(_HOVED) + 17:
+                # Ingen skriver i den gamle log efter omdøbningen, så læserne
+                # kan læse den færdig og skifte til den nye
+                os.replace(HAENDELSESFIL, HAENDELSESFIL + '.1')
+                continue
+            if not st.st_size:
+                data = _HOVED + os.urandom(8).hex().encode() + b'\n' + data
+            os.write(fd, data)
+            break
+        finally:
+            os.close(fd)
+    if _abonnenter:
+        with _betingelse:
+            _betingelse.notify_all()
+
+def _hoved(fd):
+    """(loggens id, positionen efter hovedet), eller (None, 0) hvis der ikke er skrevet endnu"""
+    linje = os.pread(fd, len(_HOVED) + 17, 0)
+    if len(linje) < len(_HOVED) + 17 or not linje.startswith(_HOVED):
+        return None, 0
+    return linje[len(_HOVED):-1].decode('ascii'), len(linje)
+
+def _linjer(fd, log, fra, til=None):
+    """[(id, type, data)] for de hele linjer fra position fra (til til), og positionen efter dem"""
+    stykker = []
+    pos = fra
+    while til is None or pos < til:
+        stykke = os.pread(fd, _BLOK if til is None else min(_BLOK, til - pos), pos)
+        if not stykke:
+            break
+        stykker.append(stykke)
+        pos += len(stykke)
+    data = b''.join(stykker)
+    ud = []
+    pos = fra
+    start = 0
+    slut = data.find(b'\n')
+    while slut >= 0:
+        navn, _, d = data[start:slut].decode('utf-8').partition(' ')
+        pos += slut + 1 - start
+        ud.append((f'{log}-{pos}', navn, d))
+        start = slut + 1
+        slut = data.find(b'\n', start)
+    return ud, pos
+
+def _aaben(fra_start=False):
+    """Åbn loggen til tråden og stil positionen først eller sidst i den.
+    Kaldes under _betingelse."""
+    global _fd, _log, _pos
+    os.makedirs(os.path.dirname(HAENDELSESFIL) or '.', exist_ok=True)
+    _fd = os.open(HAENDELSESFIL, os.O_RDONLY | os.O_CREAT, 0o644)
+    _log, _pos = _hoved(_fd)
+    if _log is None or fra_start:
+        return
+    # Efter den sidste hele linje; en halvt skrevet linje læses næste gang
+    slut = os.fstat(_fd).st_size
+    sidste = os.pread(_fd, min(slut - _pos, _BLOK), max(slut - _BLOK, _pos))
+    _pos = slut - len(sidste) + sidste.rfind(b'\n') + 1 if b'\n' in sidste else _pos
+
+def _luk():
+    global _fd
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+
+def _laes_nye():
+    """Nye hændelser i loggen siden sidst. Kaldes under _betingelse."""
+    global _log, _pos
+    if _log is None:
+        _log, _pos = _hoved(_fd)
+    nye = []
+    if _log is not None:
+        nye, _pos = _linjer(_fd, _log, _pos)
+        if nye:
+            return nye
+    try:
+        omdoebt = os.stat(HAENDELSESFIL).st_ino != os.fstat(_fd).st_ino
+    except FileNotFoundError:
+        omdoebt = True
+    if not omdoebt:
+        return []
+    # Læs det sidste, der blev skrevet før omdøbningen, og skift til den nye log
+    if _log is not None:
+        nye, _pos = _linjer(_fd, _log, _pos)
+    _luk()
+    _aaben(fra_start=True)
+    if _log is not None:
+        rest, _pos = _linjer(_fd, _log, _pos)
+        nye += rest
+    return nye
+
+def _fordel(nye):
+    for abonnent in _abonnenter:
+        abonnent._tilfoej(nye)
+    _betingelse.notify_all()
+
+def _opdater():
+    """Læs nye hændelser og fordel dem. Kaldes under _betingelse."""
+    try:
+        if _fd is None:
+            _aaben()
+        nye = _laes_nye()
+    except (OSError, UnicodeDecodeError):
+        return  # Prøv igen ved næste runde
+    if nye:
+        _fordel(nye)
+
+def _foelg():
+    with _betingelse:
+        while True:
+            if not _abonnenter:
+                _luk()
+                _betingelse.wait()
+                continue
+            _opdater()
+            _betingelse.wait(POLL_SEK)
+
+def _indhent(sidste_id):
+    """Hændelserne efter sidste_id op til trådens position, eller None hvis det ikke kan lade sig gøre"""
+    log, _, pos = sidste_id.partition('-')
+    try:
+        pos = int(pos)
+    except ValueError:
+        return None
+    if log == _log:
+        return _linjer(_fd, _log, pos, _pos)[0] if pos <= _pos else None
+    # Forrige log, hvis tråden allerede er skiftet til den nye
+    try:
+        fd = os.open(HAENDELSESFIL + '.1', os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        if _hoved(fd)[0] != log:
+            return None
+        gamle = _linjer(fd, log, pos)[0]
+    finally:
+        os.close(fd)
+    return gamle + (_linjer(_fd, _log, _hoved(_fd)[1], _pos)[0] if _log is not None else [])
+
+
+class Abonnent:
+    """Hændelser til én modtager, f.eks. én SSE-forbindelse. Husk afmeld()."""
+
+    def __init__(self):
+        self._koe = deque()
+
+    def _tilfoej(self, nye):
+        if len(self._koe) + len(nye) > MAKS_KOE:
+            # For langt bagud; modtageren må hente det hele igen
+            self._koe = deque([(nye[-1][0], 'genindlaes', '{}')])
+        else:
+            self._koe.extend(nye)
+
+    def hent(self, timeout):
+        """[(id, type, data som JSON-tekst)], evt. tom efter timeout sekunder"""
+        slut = time.monotonic() + timeout
+        with _betingelse:
+            while not self._koe:
+                rest = slut - time.monotonic()
+                if rest <= 0:
+                    return []
+                _betingelse.wait(rest)
+            ud = list(self._koe)
+            self._koe.clear()
+        return ud
+
+    def afmeld(self):
+        with _betingelse:
+            _abonnenter.discard(self)
+
+
+def abonner(sidste_id=None):
+    """En ny Abonnent på hændelserne efter sidste_id, eller fra nu af"""
+    global _traad_pid
+    abonnent = Abonnent()
+    with _betingelse:
+        # Tråden overlever ikke en fork, så start en pr. proces
+        if _traad_pid != os.getpid():
+            threading.Thread(target=_foelg, name='haendelser', daemon=True).start()
+            _traad_pid = os.getpid()
+        # Bring trådens position op til nu, så "fra nu af" passer
+        if not _abonnenter:
+            _luk()
+        _opdater()
+        if _fd is None:
+            _aaben()  # Fejler det igen, får kalderen fejlen
+        if sidste_id:
+            try:
+                gamle = _indhent(sidste_id)
+            except (OSError, UnicodeDecodeError):
+                gamle = None
+            if gamle is None:
+                gamle = [(f'{_log}-{_pos}', 'genindlaes', '{}')]
+            abonnent._tilfoej(gamle)
+        _abonnenter.add(abonnent)
+        _betingelse.notify_all()
+    return abonnent
@@ -0,0 +1,425 @@
+"""Kontrol af CSV-backendens filer i ét gennemløb, og reparation.
+
+    python integritet.py kontrol [--vis 10] [--json]
+    python integritet.py ret MAPPE [--opret-manglende]
+
+kontrol læser brugere, bøger og udlån (arkivet, UDLAANFIL og journalen)
+én gang som en strøm og finder:
+
+- kolonner: en overskrift, der ikke er de forventede kolonner;
+- felter: linjer med et andet antal felter end overskriften;
+- ufaerdig_linje: en fil, der slutter midt i en linje;
+- tom_kode og dublet: brugere og bøger uden kode eller med en kode, der
+  allerede er brugt;
+- ukendt_bruger og ukendt_bog: udlån af brugere og bøger, der ikke findes;
+- tidspunkt: udlånsdatoer, afleveringer og forfaldsdatoer, der ikke er
+  gyldige tidspunkter;
+- afleveret_foer_udlaan: afleveret før udlånsdatoen;
+- dobbelt_udlaan: en bog med mere end ét åbent udlån;
+- aflevering_uden_udlaan og ukendt_handling: journallinjer, der ikke
+  passer til et åbent udlån eller hverken er udlån eller aflevering.
+
+Udlånene holdes ikke i hukommelsen: brugernes og bøgernes koder står i
+sæt, som udlånene slås op i, og kun de åbne udlån og problemerne gemmes.
+Filerne læses under backendens delte lås, så appen kan køre imens.
+
+ret skriver en rettet kopi af filerne (samme navne og arkivet) til MAPPE,
+som skal være tom; data/ ændres ikke. Rækker, der ikke kan rettes, står i
+MAPPE/afvist.csv med fil, linje og problem. Rettelserne er:
+
+- kolonnerne skrives i den forventede rækkefølge, og manglende felter
+  bliver tomme; linjer med for mange felter afvises;
+- brugere og bøger uden kode og senere dubletter afvises;
+- udlån med ugyldige tidspunkter eller afleveret før udlånet afvises;
+- udlån af ukendte brugere og bøger afvises, eller med --opret-manglende
+  beholdes de, og brugerne og bøgerne oprettes med navnet 'Ukendt bruger'
+  og titlen 'Ukendt titel';
+- et åbent udlån, der efterfølges af et nyere udlån af samme bog, afleveres
+  på tidspunktet for det nyere udlån;
+- journallinjer, der ikke kan bruges, og en ufærdig sidste linje afvises.
+
+Stop appen, før den rettede kopi lægges på plads i data/.
+"""
+import argparse
+import csv
+import fcntl
+import io
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import date
+
+import csv_backend
+import raekker
+
+PROBLEMER = {
+    'kolonner': 'Overskriften afviger fra de forventede kolonner',
+    'felter': 'Forkert antal felter',
+    'ufaerdig_linje': 'Filen slutter midt i en linje',
+    'tom_kode': 'Mangler kode',
+    'dublet': 'Koden er brugt før',
+    'ukendt_bruger': 'Udlån af en bruger, der ikke findes',
+    'ukendt_bog': 'Udlån af en bog, der ikke findes',
+    'tidspunkt': 'Ugyldigt tidspunkt',
+    'afleveret_foer_udlaan': 'Afleveret før udlånsdatoen',
+    'dobbelt_udlaan': 'Bogen har et nyere åbent udlån',
+    'aflevering_uden_udlaan': 'Aflevering af en bog uden åbent udlån',
+    'ukendt_handling': 'Journallinjen er hverken udlån eller aflevering',
+}
+JOURNAL_FELTER = csv_backend.JOURNAL_FELTER
+# Den sidste kolonne kom til senere; filer og journallinjer uden den er i orden
+VALGFRI = 'forfald'
+# Kolonner, uden hvilke en række ikke kan bruges
+KRAEVEDE = {'kode': ['kode'], 'udlaan': ['bruger', 'bog', 'dato'],
+            'journal': ['handling', 'bog', 'tidspunkt']}
+UKENDT_BRUGER = 'Ukendt bruger'
+UKENDT_TITEL = 'Ukendt titel'
+
+
+class Rapport:
+    """Antal problemer pr. kategori og de første eksempler på hver"""
+
+    def __init__(self, vis):
+        self.vis = vis
+        self.antal = Counter()
+        self.eksempler = defaultdict(list)
+
+    def __call__(self, kategori, fil, linje, tekst=''):
+        self.antal[kategori] += 1
+        if len(self.eksempler[kategori]) < self.vis:
+            self.eksempler[kategori].append(f'{fil}:{linje}' + (f': {tekst}' if tekst else ''))
+
+    def som_dict(self):
+        return {kategori: {'beskrivelse': PROBLEMER[kategori], 'antal': n,
+                           'eksempler': self.eksempler[kategori]}
+                for kategori, n in self.antal.items()}
+
+
+def _ufaerdig(sti):
+    with open(sti, 'rb') as f:
+        if f.seek(0, os.SEEK_END) == 0:
+            return False
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b'\n'
+
+
+def _linjer(sti, felter, kraevede, rapport, overskrift):
+    with open(sti, encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        hoved = felter
+        if overskrift:
+            hoved = next(reader, None)
+            if hoved is None:
+                return
+            if hoved != felter and hoved != [felt for felt in felter if felt != VALGFRI]:
+                rapport('kolonner', sti, 1, ','.join(hoved))
+        antal = len(hoved)
+        brugbar = all(felt in hoved for felt in kraevede)
+        # Står kolonnerne som forventet, bruges linjen selv som række
+        pladser = None if hoved == felter else [
+            hoved.index(felt) if felt in hoved else None for felt in felter]
+        for linje in reader:
+            if len(linje) == antal:
+                if not brugbar:
+                    row = None
+                elif pladser is None:
+                    row = linje
+                else:
+                    row = [linje[i] if i is not None else '' for i in pladser]
+            elif not linje:
+                continue
+            elif not overskrift and len(linje) == antal - 1 and felter[-1] == VALGFRI:
+                row = linje + ['']
+            else:
+                rapport('felter', sti, reader.line_num, f'{len(linje)} felter, forventede {antal}')
+                # Manglende felter i en fil med overskrift bliver tomme
+                row = None
+                if overskrift and brugbar and len(linje) < antal:
+                    row = [linje[i] if i is not None and i < len(linje) else ''
+                           for i in pladser or range(antal)]
+            yield reader.line_num, linje, row
+
+
+def _laes(sti, felter, kraevede, rapport, overskrift=True):
+    """(linjenummer, rå linje, række med felter i den forventede rækkefølge) for hver
+    linje i filen. Rækken er None, hvis linjen ikke kan bruges.
+
+    rapport får problemerne med overskriften og antallet af felter.
+    """
+    linjer = _linjer(sti, felter, kraevede, rapport, overskrift)
+    if not _ufaerdig(sti):
+        yield from linjer
+        return
+    # Den sidste linje er ikke skrevet færdig
+    forrige = None
+    for linje in linjer:
+        if forrige is not None:
+            yield forrige
+        forrige = linje
+    if forrige is not None:
+        rapport('ufaerdig_linje', sti, forrige[0])
+        yield forrige[0], forrige[1], None
+
+
+# Tidspunkter i appens eget format (datetime.isoformat()) kan sammenlignes
+# som tekst; datoen i dem kontrolleres én gang pr. dag
+_ISOFORMAT = re.compile(r'\d{4}-\d\d-\d\dT(?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d(?:\.\d{6})?')
+_gyldige_dage = {}
+
+def _tid(tekst):
+    """Tidspunktet i appens format, så det kan sammenlignes som tekst, eller None"""
+    if _ISOFORMAT.fullmatch(tekst):
+        dag = tekst[:10]
+        gyldig = _gyldige_dage.get(dag)
+        if gyldig is None:
+            try:
+                gyldig = _gyldige_dage[dag] = bool(date.fromisoformat(dag))
+            except ValueError:
+                gyldig = _gyldige_dage[dag] = False
+        return tekst if gyldig else None
+    try:
+        return raekker.tekst(raekker.tid(tekst)) or None
+    except ValueError:
+        return None
+
+
+def _filer():
+    """[(fil, 'arkiv'/'snapshot'/'journal')] for udlånene i den rækkefølge, de læses"""
+    filer = [(csv_backend._arkivfil(maaned), 'arkiv') for maaned in csv_backend._arkiv_maaneder()]
+    for fil, art in ((csv_backend.UDLAANFIL, 'snapshot'), (csv_backend.UDLAANJOURNAL, 'journal')):
+        if os.path.exists(fil):
+            filer.append((fil, art))
+    return filer
+
+
+def _udlaansfelter(journal):
+    """(felter, kræves) for en udlånsfil eller journalen"""
+    if journal:
+        return JOURNAL_FELTER, KRAEVEDE['journal']
+    return csv_backend.UDLAAN_FELTER, KRAEVEDE['udlaan']
+
+
+def _kontroller_koder(sti, felter, rapport, rettelser):
+    """Kodesættet for brugere eller bøger"""
+    koder = set()
+    if not os.path.exists(sti):
+        return koder
+    for nr, _, row in _laes(sti, felter, KRAEVEDE['kode'], rapport):
+        if row is None:
+            rettelser[sti, nr] = ('afvis', 'felter')
+            continue
+        kode = row[0].strip()
+        if not kode:
+            rapport('tom_kode', sti, nr)
+            rettelser[sti, nr] = ('afvis', 'tom_kode')
+        elif kode in koder:
+            rapport('dublet', sti, nr, kode)
+            rettelser[sti, nr] = ('afvis', 'dublet')
+        else:
+            koder.add(kode)
+    return koder
+
+
+def kontroller(vis=10, opret_manglende=False):
+    """(rapport, rettelser, manglende) for filerne i data/.
+
+    rettelser er {(fil, linje): ('afvis', kategori) eller ('aflever', tidspunkt)}
+    og manglende {'brugere': sæt, 'boeger': sæt} med de ukendte koder, der skal
+    oprettes, hvis opret_manglende er sand.
+    """
+    rapport = Rapport(vis)
+    rettelser = {}
+    manglende = {'brugere': set(), 'boeger': set()}
+    brugere = _kontroller_koder(csv_backend.BRUGERFIL, csv_backend.BRUGER_FELTER, rapport, rettelser)
+    boeger = _kontroller_koder(csv_backend.BOGFIL, csv_backend.BOG_FELTER, rapport, rettelser)
+
+    aabne = defaultdict(list)  # bog -> [(dato, fil, linje)] for de åbne udlån
+    seneste = {}               # bog -> seneste udlånsdato i UDLAANFIL og journalen
+
+    def udlaan(fil, nr, bruger, bog, dato, afleveret, forfald):
+        """(udlånsdatoen, problemet, der afviser udlånet, eller None)"""
+        dato_tid = _tid(dato)
+        if dato_tid is None:
+            rapport('tidspunkt', fil, nr, dato)
+            return None, 'tidspunkt'
+        if forfald and _tid(forfald) is None:
+            rapport('tidspunkt', fil, nr, forfald)
+            return dato_tid, 'tidspunkt'
+        if afleveret:
+            afleveret_tid = _tid(afleveret)
+            if afleveret_tid is None:
+                rapport('tidspunkt', fil, nr, afleveret)
+                return dato_tid, 'tidspunkt'
+            if afleveret_tid < dato_tid:
+                rapport('afleveret_foer_udlaan', fil, nr, f'{dato} > {afleveret}')
+                return dato_tid, 'afleveret_foer_udlaan'
+        if bruger not in brugere:
+            rapport('ukendt_bruger', fil, nr, bruger)
+            if not opret_manglende:
+                return dato_tid, 'ukendt_bruger'
+            manglende['brugere'].add(bruger)
+        if bog not in boeger:
+            rapport('ukendt_bog', fil, nr, bog)
+            if not opret_manglende:
+                return dato_tid, 'ukendt_bog'
+            manglende['boeger'].add(bog)
+        if not afleveret:
+            aabne[bog].append((dato_tid, fil, nr))
+        return dato_tid, None
+
+    for fil, art in _filer():
+        journal = art == 'journal'
+        for nr, _, row in _laes(fil, *_udlaansfelter(journal), rapport, overskrift=not journal):
+            if row is None:
+                rettelser[fil, nr] = ('afvis', 'felter')
+                continue
+            if not journal:
+                dato, problem = udlaan(fil, nr, *row)
+                if problem:
+                    rettelser[fil, nr] = ('afvis', problem)
+                elif art == 'snapshot' and dato > seneste.get(row[1], ''):
+                    seneste[row[1]] = dato
+                continue
+            handling, bruger, bog, tidspunkt, forfald = row
+            if handling == 'udlaan':
+                t = _tid(tidspunkt)
+                if t is not None and seneste.get(bog, '') >= t:
+                    continue  # Står allerede i UDLAANFIL; backenden springer den over
+                _, problem = udlaan(fil, nr, bruger, bog, tidspunkt, '', forfald)
+                if problem:
+                    rettelser[fil, nr] = ('afvis', problem)
+                else:
+                    seneste[bog] = t
+            elif handling == 'aflevering':
+                t = _tid(tidspunkt)
+                if t is None:
+                    rapport('tidspunkt', fil, nr, tidspunkt)
+                    rettelser[fil, nr] = ('afvis', 'tidspunkt')
+                elif aabne.get(bog) and aabne[bog][-1][0] <= t:
+                    aabne[bog].pop()
+                else:
+                    rapport('aflevering_uden_udlaan', fil, nr, bog)
+                    rettelser[fil, nr] = ('afvis', 'aflevering_uden_udlaan')
+            else:
+                rapport('ukendt_handling', fil, nr, handling)
+                rettelser[fil, nr] = ('afvis', 'ukendt_handling')
+
+    # Et åbent udlån efterfulgt af et nyere af samme bog er i virkeligheden afleveret
+    for bog, liste in aabne.items():
+        if len(liste) < 2:
+            continue
+        liste.sort()
+        for (_, fil, nr), (naeste, _, _) in zip(liste, liste[1:]):
+            rapport('dobbelt_udlaan', fil, nr, f'{bog}, nyere udlån {naeste}')
+            rettelser[fil, nr] = ('aflever', naeste)
+    return rapport, rettelser, manglende
+
+
+def _csv_linje(linje):
+    ud = io.StringIO()
+    csv.writer(ud, lineterminator='').writerow(linje)
+    return ud.getvalue()
+
+
+def _skriv_fil(sti, felter, raekker_):
+    os.makedirs(os.path.dirname(sti) or '.', exist_ok=True)
+    with open(sti, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        if felter:
+            writer.writerow(felter)
+        writer.writerows(raekker_)
+
+
+def ret(mappe, rettelser, manglende):
+    """Skriv den rettede kopi af data/ til mappe. Returnerer antal afviste rækker."""
+    if os.path.isdir(mappe) and os.listdir(mappe):
+        raise ValueError(f'{mappe} er ikke tom')
+    afvist = []
+    ingen = Rapport(0)  # Problemerne er allerede talt op
+
+    def rettede(fil, felter, kraevede, journal=False):
+        for nr, linje, row in _laes(fil, felter, kraevede, ingen, overskrift=not journal):
+            handling, vaerdi = rettelser.get((fil, nr), (None, None))
+            if handling == 'afvis' or row is None:
+                afvist.append([fil, nr, vaerdi or 'felter', _csv_linje(linje)])
+            elif handling == 'aflever' and journal:
+                # Afleveringen skal stå lige efter udlånet, før det nyere udlån
+                yield row
+                yield ['aflevering', '', row[2], vaerdi]
+            else:
+                if handling == 'aflever':
+                    row[3] = vaerdi
+                yield row
+
+    def ud(fil):
+        return os.path.join(mappe, os.path.relpath(fil, os.path.dirname(csv_backend.BRUGERFIL)))
+
+    for fil, felter, navne, tekst in (
+            (csv_backend.BRUGERFIL, csv_backend.BRUGER_FELTER, 'brugere', [UKENDT_BRUGER]),
+            (csv_backend.BOGFIL, csv_backend.BOG_FELTER, 'boeger', [UKENDT_TITEL, '', ''])):
+        rows = rettede(fil, felter, KRAEVEDE['kode']) if os.path.exists(fil) else []
+        nye = ([kode] + tekst for kode in sorted(manglende[navne]))
+        _skriv_fil(ud(fil), felter, (row for dele in (rows, nye) for row in dele))
+    for fil, art in _filer():
+        journal = art == 'journal'
+        felter, kraevede = _udlaansfelter(journal)
+        _skriv_fil(ud(fil), None if journal else felter, rettede(fil, felter, kraevede, journal))
+    _skriv_fil(os.path.join(mappe, 'afvist.csv'), ['fil', 'linje', 'problem', 'raekke'], afvist)
+    return len(afvist)
+
+
+def _udskriv(rapport, sek):
+    if not rapport.antal:
+        print(f'Ingen problemer ({sek:.1f} s)')
+        return
+    print(f'{sum(rapport.antal.values())} problemer ({sek:.1f} s):')
+    for kategori, n in rapport.antal.most_common():
+        print(f'  {kategori}: {n} - {PROBLEMER[kategori]}')
+        for eksempel in rapport.eksempler[kategori]:
+            print(f'      {eksempel}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Kontrol og reparation af filerne i data/')
+    under = parser.add_subparsers(dest='kommando', required=True)
+    p = under.add_parser('kontrol', help='find problemer; afslutter med 1, hvis der er nogen')
+    p.add_argument('--vis', type=int, default=10, help='eksempler pr. problem (standard: 10)')
+    p.add_argument('--json', action='store_true', help='skriv rapporten som JSON')
+    p = under.add_parser('ret', help='skriv en rettet kopi af data/ til en tom mappe')
+    p.add_argument('mappe')
+    p.add_argument('--opret-manglende', action='store_true',
+                   help='behold udlån af ukendte brugere og bøger og opret dem')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    # Under den delte lås, så en kørende app ikke skriver eller komprimerer imens
+    with csv_backend._laas(fcntl.LOCK_SH):
+        if args.kommando == 'kontrol':
+            rapport, _, _ = kontroller(args.vis)
+        else:
+            rapport, rettelser, manglende = kontroller(0, args.opret_manglende)
+            try:
+                afviste = ret(args.mappe, rettelser, manglende)
+            except ValueError as e:
+                parser.error(str(e))
+    sek = time.perf_counter() - start
+
+    if args.kommando == 'ret':
+        print(f'Rettet kopi i {args.mappe}: {sum(rapport.antal.values())} problemer, '
+              f'{afviste} rækker afvist (se afvist.csv), '
+              f"{len(manglende['brugere'])} brugere og {len(manglende['boeger'])} bøger oprettet "
+              f'({sek:.1f} s)')
+        return 0
+    if args.json:
+        print(json.dumps({'sekunder': round(sek, 2), 'problemer': rapport.som_dict()},
+                         indent=2, ensure_ascii=False))
+    else:
+        _udskriv(rapport, sek)
+    return 1 if rapport.antal else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
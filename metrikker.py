@@ -0,0 +1,320 @@
+"""Metrikker i Prometheus' tekstformat.
+
+Tællere og histogrammer holdes i hukommelsen i hver proces. Hver proces
+gemmer dem jævnligt i METRIKMAPPE, så prometheus_tekst() kan lægge alle
+workers sammen, uanset hvilken worker der bliver spurgt. Når en worker er
+væk, lægges dens sidst gemte tal over i DOEDEFIL, så tællerne ikke falder,
+når Gunicorn udskifter workers.
+
+Alle metrikker er beskrevet i METRIKKER; tael() og observer() tager
+navnet og labels som keyword-argumenter.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+METRIKMAPPE = os.environ.get('BIBLIOTEK_METRIKMAPPE', 'data/metrikker')
+DOEDEFIL = os.path.join(METRIKMAPPE, 'doede.json')
+GEM_INTERVAL = 10
+
+_SEKUNDER = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_VENTETID = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# navn -> (type, hjælpetekst, buckets)
+METRIKKER = {
+    'bibliotek_http_forespoergsler_total':
+        ('counter', 'Forespørgsler pr. endpoint, metode og status', None),
+    'bibliotek_http_varighed_seconds':
+        ('histogram', 'Tid til svaret er klar (streamede svar: til første bid)', _SEKUNDER),
+    'bibliotek_data_access_kald_total':
+        ('counter', 'Kald til data_access pr. funktion', None),
+    'bibliotek_data_access_seconds_total':
+        ('counter', 'Samlet tid i data_access pr. funktion', None),
+    'bibliotek_data_access_kald_pr_forespoergsel':
+        ('histogram', 'Kald til data_access i én forespørgsel', (0, 1, 2, 3, 5, 10, 20, 50, 100)),
+    'bibliotek_fil_laesninger_total':
+        ('counter', 'Indlæsninger af datafiler', None),
+    'bibliotek_fil_laest_bytes_total':
+        ('counter', 'Bytes læst fra datafiler', None),
+    'bibliotek_fil_skrivninger_total':
+        ('counter', 'Skrivninger af datafiler', None),
+    'bibliotek_fil_skrevet_bytes_total':
+        ('counter', 'Bytes skrevet til datafiler', None),
+    'bibliotek_afviste_raekker_total':
+        ('counter', 'Rækker og journallinjer, der ikke kunne læses, pr. fil', None),
+    'bibliotek_cache_opslag_total':
+        ('counter', 'Opslag i caches; hit-raten er hit / (hit + miss)', None),
+    'bibliotek_laas_ventetid_seconds':
+        ('histogram', 'Ventetid på skrive- og læselåse', _VENTETID),
+    'bibliotek_commits_total':
+        ('counter', 'Gruppe-commits', None),
+    'bibliotek_commit_skrivninger_total':
+        ('counter', 'Skrivninger samlet i gruppe-commits', None),
+}
+
+# Hver tråd tæller i sine egne dicts, så en måling hverken tager en lås
+# eller kan miste en opdatering; _snapshot() lægger trådene sammen og
+# flytter stoppede tråde over i _stoppede.
+_laas = threading.Lock()
+_traade = {}        # tråd -> (tællere, histogrammer) for hver tråd, der har målt
+_stoppede = ({}, {})
+_lokal = threading.local()
+_gemmer_startet = False
+
+
+def _efter_fork():
+    # En worker starter med tomme metrikker og sin egen gemmetråd, så intet
+    # tælles med to gange, når Gunicorn forker efter import (--preload)
+    global _laas, _traade, _stoppede, _lokal, _gemmer_startet
+    _laas = threading.Lock()
+    _traade = {}
+    _stoppede = ({}, {})
+    _lokal = threading.local()
+    _gemmer_startet = False
+
+
+os.register_at_fork(after_in_child=_efter_fork)
+
+
+def _mine():
+    try:
+        return _lokal.metrikker
+    except AttributeError:
+        pass
+    _lokal.metrikker = ({}, {})  # (navn, labels) -> værdi / [antal pr. bucket, sum, antal]
+    with _laas:
+        _traade[threading.current_thread()] = _lokal.metrikker
+    _start_gemmer()
+    return _lokal.metrikker
+
+
+def noegle(navn, **labels):
+    """Nøglen til en metrik med labels; kan beregnes på forhånd til tael_noegle()"""
+    return (navn, tuple(sorted(labels.items())))
+
+
+def tael_noegle(noegle, vaerdi=1):
+    taellere = _mine()[0]
+    taellere[noegle] = taellere.get(noegle, 0) + vaerdi
+
+
+def tael(navn, vaerdi=1, **labels):
+    tael_noegle(noegle(navn, **labels), vaerdi)
+
+
+def observer(navn, vaerdi, **labels):
+    buckets = METRIKKER[navn][2]
+    histogrammer = _mine()[1]
+    n = noegle(navn, **labels)
+    h = histogrammer.get(n)
+    if h is None:
+        h = histogrammer[n] = [[0] * len(buckets), 0, 0]
+    for i, graense in enumerate(buckets):
+        if vaerdi <= graense:
+            h[0][i] += 1
+            break
+    h[1] += vaerdi
+    h[2] += 1
+
+
+_CACHE_NOEGLER = {}
+
+def cache(navn, hit):
+    n = _CACHE_NOEGLER.get((navn, hit))
+    if n is None:
+        n = _CACHE_NOEGLER[(navn, hit)] = noegle(
+            'bibliotek_cache_opslag_total', cache=navn, resultat='hit' if hit else 'miss')
+    tael_noegle(n)
+
+
+# Pr. forespørgsel
+def start_forespoergsel():
+    _lokal.kald = 0
+
+
+def data_access_kald(kald_noegle, tid_noegle, sekunder):
+    """Tæl et kald; nøglerne laves med noegle() for funktionen"""
+    tael_noegle(kald_noegle)
+    tael_noegle(tid_noegle, sekunder)
+    if getattr(_lokal, 'kald', None) is not None:
+        _lokal.kald += 1
+
+
+def slut_forespoergsel(endpoint, metode, status, sekunder):
+    tael('bibliotek_http_forespoergsler_total', endpoint=endpoint, metode=metode, status=status)
+    observer('bibliotek_http_varighed_seconds', sekunder, endpoint=endpoint, metode=metode)
+    observer('bibliotek_data_access_kald_pr_forespoergsel', getattr(_lokal, 'kald', 0) or 0,
+             endpoint=endpoint)
+    _lokal.kald = None
+
+
+# Deling mellem processer
+def _laeg_til(taellere, histogrammer, t, hs):
+    for n, v in t.items():
+        taellere[n] = taellere.get(n, 0) + v
+    for n, (antal, summen, i_alt) in hs.items():
+        samlet = histogrammer.setdefault(n, [[0] * len(antal), 0, 0])
+        samlet[0] = [a + b for a, b in zip(samlet[0], antal)]
+        samlet[1] += summen
+        samlet[2] += i_alt
+
+
+def _snapshot():
+    taellere, histogrammer = {}, {}
+    with _laas:
+        # En stoppet tråd tæller ikke mere, så dens tal kan lægges over i
+        # _stoppede uden at kopiere, og tråden glemmes
+        for traad in [traad for traad in _traade if not traad.is_alive()]:
+            _laeg_til(*_stoppede, *_traade.pop(traad))
+        traade = list(_traade.values())
+        _laeg_til(taellere, histogrammer, *_stoppede)
+    for t, hs in traade:
+        # dict() kopierer uden at slippe GIL'en, så tråden kan tælle videre
+        _laeg_til(taellere, histogrammer, dict(t), dict(hs))
+    return _som_snapshot(taellere, histogrammer)
+
+
+def _som_snapshot(taellere, histogrammer):
+    return {
+        'taellere': [[navn, labels, v] for (navn, labels), v in taellere.items()],
+        'histogrammer': [[navn, labels, *h] for (navn, labels), h in histogrammer.items()],
+    }
+
+
+def _saml(snapshots):
+    """Snapshots (også læst fra JSON) lagt sammen som (tællere, histogrammer)"""
+    taellere, histogrammer = {}, {}
+    for snapshot in snapshots:
+        _laeg_til(taellere, histogrammer,
+                  {(navn, tuple(map(tuple, labels))): v
+                   for navn, labels, v in snapshot['taellere']},
+                  {(navn, tuple(map(tuple, labels))): h
+                   for navn, labels, *h in snapshot['histogrammer']})
+    return taellere, histogrammer
+
+
+def gem():
+    """Skriv processens metrikker til METRIKMAPPE/<pid>.json"""
+    os.makedirs(METRIKMAPPE, exist_ok=True)
+    sti = os.path.join(METRIKMAPPE, f'{os.getpid()}.json')
+    with open(f'{sti}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(_snapshot(), f)
+    os.replace(f'{sti}.tmp', sti)
+
+
+def _start_gemmer():
+    global _gemmer_startet
+    if _gemmer_startet:
+        return
+    _gemmer_startet = True
+
+    def loop():
+        while True:
+            time.sleep(GEM_INTERVAL)
+            try:
+                gem()
+            except OSError:
+                pass  # Prøv igen ved næste interval
+    threading.Thread(target=loop, name='metrikker', daemon=True).start()
+
+
+def _lever(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _laes(sti):
+    try:
+        with open(sti, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _flyt_doede(stier):
+    """Læg de døde workers' filer over i DOEDEFIL og slet dem. Under en flock,
+    så to workers ikke flytter den samme fil to gange."""
+    with open(os.path.join(METRIKMAPPE, '.laas'), 'a') as laas:
+        fcntl.flock(laas, fcntl.LOCK_EX)
+        snapshots = [_laes(sti) for sti in stier if os.path.exists(sti)]
+        if not snapshots:
+            return
+        doede = _laes(DOEDEFIL)
+        snapshots = [s for s in [doede] + snapshots if s is not None]
+        with open(f'{DOEDEFIL}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(_som_snapshot(*_saml(snapshots)), f)
+        os.replace(f'{DOEDEFIL}.tmp', DOEDEFIL)
+        for sti in stier:
+            try:
+                os.remove(sti)
+            except FileNotFoundError:
+                pass
+
+
+def _alle_snapshots():
+    snapshots = [_snapshot()]
+    try:
+        filer = os.listdir(METRIKMAPPE)
+    except FileNotFoundError:
+        filer = []
+    doede = []
+    for filnavn in filer:
+        pid, endelse = os.path.splitext(filnavn)
+        if endelse != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        sti = os.path.join(METRIKMAPPE, filnavn)
+        if not _lever(int(pid)):
+            doede.append(sti)
+            continue
+        snapshot = _laes(sti)
+        if snapshot is not None:
+            snapshots.append(snapshot)
+    if doede:
+        try:
+            _flyt_doede(doede)
+        except OSError:
+            pass  # Prøv igen ved næste forespørgsel; filerne ligger der endnu
+    snapshot = _laes(DOEDEFIL)
+    if snapshot is not None:
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def _labeltekst(labels, ekstra=()):
+    def escape(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    par = [f'{k}="{escape(v)}"' for k, v in list(labels) + list(ekstra)]
+    return '{' + ','.join(par) + '}' if par else ''
+
+
+def prometheus_tekst():
+    """Alle processers metrikker i Prometheus' tekstformat"""
+    taellere, histogrammer = _saml(_alle_snapshots())
+
+    linjer = []
+    for navn, (type_, hjaelp, buckets) in METRIKKER.items():
+        linjer.append(f'# HELP {navn} {hjaelp}')
+        linjer.append(f'# TYPE {navn} {type_}')
+        if type_ == 'counter':
+            for (n, labels), v in sorted(taellere.items()):
+                if n == navn:
+                    linjer.append(f'{navn}{_labeltekst(labels)} {v}')
+            continue
+        for (n, labels), (antal, summen, i_alt) in sorted(histogrammer.items()):
+            if n != navn:
+                continue
+            akkumuleret = 0
+            for graense, a in zip(buckets, antal):
+                akkumuleret += a
+                linjer.append(f'{navn}_bucket{_labeltekst(labels, [("le", graense)])} {akkumuleret}')
+            linjer.append(f'{navn}_bucket{_labeltekst(labels, [("le", "+Inf")])} {i_alt}')
+            linjer.append(f'{navn}_sum{_labeltekst(labels)} {summen}')
+            linjer.append(f'{navn}_count{_labeltekst(labels)} {i_alt}')
+    return '\n'.join(linjer) + '\n'
@@ -0,0 +1,238 @@
+"""Profilering af enkelte forespørgsler til flamegraphs.
+
+Profilering er WSGI-middleware omkring appen. En forespørgsel profileres,
+når en admin sender headeren 'X-Profil: sampling' eller 'X-Profil: cprofile'
+(eller ?profil=sampling / ?profil=cprofile), og desuden en tilfældig andel
+PROFIL_ANDEL af alle forespørgsler med sampling. Uden header, parameter og
+andel går forespørgslen direkte videre til appen; med BIBLIOTEK_PROFILERING=0
+installeres middlewaren slet ikke.
+
+Profilen dækker hele forespørgslen, også Flasks hooks og et streamet svar,
+og gemmes i PROFILMAPPE som collapsed stacks ('a;b;c antal' pr. linje),
+som flamegraph.pl og speedscope læser direkte. Har en admin bedt om
+profilen, står filnavnet i svarets X-Profil-header; de tilfældigt valgte
+forespørgsler får ingen header og findes kun på /admin/profiler.
+
+- sampling: en tråd tager forespørgslens stak hvert SAMPLE_INTERVAL;
+  antallet er samples. Koster næsten intet for forespørgslen, men
+  forespørgsler kortere end SAMPLE_INTERVAL giver en tom profil.
+- cprofile: cProfile måler alle kald; antallet er mikrosekunder i
+  funktionen selv. cProfile kender kun kalderne, ikke hele stakken, så et
+  kald, der sker fra flere steder, fordeles efter tiden fra hver kalder.
+  Kun én forespørgsel ad gangen; ellers bruges sampling.
+"""
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+PROFILERING = os.environ.get('BIBLIOTEK_PROFILERING', '1') != '0'
+PROFILMAPPE = os.environ.get('BIBLIOTEK_PROFILMAPPE', 'data/profiler')
+PROFIL_ANDEL = float(os.environ.get('BIBLIOTEK_PROFIL_ANDEL', '0'))
+SAMPLE_INTERVAL = 0.005
+MAKS_FILER = 200
+MAKS_DYBDE = 200
+ARTER = ('sampling', 'cprofile')
+
+_cprofile_laas = threading.Lock()
+
+
+def _ramme(kode):
+    return f'{kode.co_name} ({os.path.basename(kode.co_filename)}:{kode.co_firstlineno})'
+
+
+def _stak(frame, stop):
+    """Rammerne under middlewaren (koderne i stop) ned til frame som 'a;b;c'"""
+    rammer = []
+    while frame is not None and frame.f_code not in stop:
+        rammer.append(_ramme(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(rammer))
+
+
+class _Sampler:
+    def __init__(self, stop):
+        self._ident = threading.get_ident()
+        self._stop = stop
+        self._faerdig = threading.Event()
+        self.stakke = Counter()
+        self._traad = threading.Thread(target=self._sample, name='profilering', daemon=True)
+        self._traad.start()
+
+    def _sample(self):
+        while not self._faerdig.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._ident)
+            if frame is None:
+                break
+            self.stakke[_stak(frame, self._stop)] += 1
+
+    def slut(self):
+        self._faerdig.set()
+        self._traad.join()
+        return self.stakke
+
+
+class _CProfile:
+    def __init__(self):
+        self._profil = cProfile.Profile()
+        self._profil.enable()
+
+    def slut(self):
+        self._profil.disable()
+        _cprofile_laas.release()
+        self._profil.create_stats()
+        return _foldet(self._profil.stats)
+
+
+def _foldet(stats):
+    """cProfiles stats som Counter {'a;b;c': mikrosekunder i c selv}.
+
+    Et kald fra flere kaldere fordeles efter den samlede tid fra hver kalder.
+    """
+    boern = {}
+    for funktion, (_, _, _, _, kaldere) in stats.items():
+        for kalder, (_, _, _, ct) in kaldere.items():
+            boern.setdefault(kalder, []).append((funktion, ct))
+    navne = {f: f'{f[2]} ({os.path.basename(f[0])}:{f[1]})' for f in stats}
+    stakke = Counter()
+
+    def foelg(funktion, stak, andel, besoegt):
+        _, _, tt, ct, _ = stats[funktion]
+        stak = f'{stak};{navne[funktion]}' if stak else navne[funktion]
+        stakke[stak] += round(tt * andel * 1e6)
+        # Grene under et mikrosekund bliver alligevel til 0
+        if len(besoegt) >= MAKS_DYBDE or ct * andel < 1e-6:
+            return
+        besoegt.add(funktion)
+        for barn, barn_ct in boern.get(funktion, ()):
+            samlet = stats[barn][3]
+            if barn not in besoegt and samlet > 0:
+                foelg(barn, stak, andel * barn_ct / samlet, besoegt)
+        besoegt.discard(funktion)
+
+    for funktion, (_, _, _, _, kaldere) in stats.items():
+        if not any(kalder in stats for kalder in kaldere):
+            foelg(funktion, '', 1.0, set())
+    return +stakke  # Uden stakke med 0
+
+
+def _gem(navn, stakke):
+    os.makedirs(PROFILMAPPE, exist_ok=True)
+    sti = os.path.join(PROFILMAPPE, navn)
+    with open(f'{sti}.tmp', 'w', encoding='utf-8') as f:
+        f.writelines(f'{stak} {antal}\n' for stak, antal in stakke.most_common())
+    os.replace(f'{sti}.tmp', sti)
+    # Ryd de ældste op
+    filer = profiler()
+    for gammel in filer[MAKS_FILER:]:
+        try:
+            os.remove(os.path.join(PROFILMAPPE, gammel['navn']))
+        except FileNotFoundError:
+            pass
+
+
+def profiler():
+    """[{'navn', 'bytes', 'tidspunkt'}] for de gemte profiler, nyeste først"""
+    try:
+        navne = [n for n in os.listdir(PROFILMAPPE) if n.endswith('.txt')]
+    except FileNotFoundError:
+        return []
+    filer = []
+    for navn in navne:
+        try:
+            st = os.stat(os.path.join(PROFILMAPPE, navn))
+        except FileNotFoundError:
+            continue
+        filer.append({'navn': navn, 'bytes': st.st_size,
+                      'tidspunkt': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(st.st_mtime))})
+    filer.sort(key=lambda f: f['tidspunkt'], reverse=True)
+    return filer
+
+
+def _filnavn(environ, art):
+    sti = re.sub(r'[^A-Za-z0-9]+', '_', environ.get('PATH_INFO', '')).strip('_') or 'index'
+    nu = time.time()
+    return (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(nu))}.{int(nu * 1000) % 1000:03d}"
+            f"-{os.getpid()}-{threading.get_ident() % 10000:04d}"
+            f"-{environ.get('REQUEST_METHOD', 'GET')}-{sti[:60]}-{art}.txt")
+
+
+class Profilering:
+    """Middleware omkring en WSGI-app. er_admin(environ) afgør, om headeren
+    eller parameteren må bruges."""
+
+    def __init__(self, app, er_admin):
+        self.app = app
+        self.er_admin = er_admin
+
+    def __call__(self, environ, start_response):
+        if ('HTTP_X_PROFIL' not in environ and 'profil=' not in environ.get('QUERY_STRING', '')
+                and not PROFIL_ANDEL):
+            return self.app(environ, start_response)
+        art, bestilt = self._art(environ)
+        if art is None:
+            return self.app(environ, start_response)
+        return self._profiler(environ, start_response, art, bestilt)
+
+    def _art(self, environ):
+        """(art, bestilt): bestilt er sand, når en admin har bedt om profilen"""
+        art = environ.get('HTTP_X_PROFIL')
+        if art is None and 'profil=' in environ.get('QUERY_STRING', ''):
+            art = parse_qs(environ['QUERY_STRING']).get('profil', [None])[0]
+        if art is not None:
+            art = art.strip().lower()
+            if art in ('1', 'ja'):
+                art = 'sampling'
+            if art in ARTER and self.er_admin(environ):
+                return art, True
+        if PROFIL_ANDEL and random.random() < PROFIL_ANDEL:
+            return 'sampling', False
+        return None, False
+
+    def _profiler(self, environ, start_response, art, bestilt):
+        if art == 'cprofile' and not _cprofile_laas.acquire(blocking=False):
+            art = 'sampling'
+        navn = _filnavn(environ, art)
+
+        def start_med_navn(status, headers, exc_info=None):
+            return start_response(status, headers + [('X-Profil', navn)], exc_info)
+
+        profil = _CProfile() if art == 'cprofile' else _Sampler(_STOP)
+        svar = _Svar(navn, profil)
+        try:
+            svar.svar = self.app(environ, start_med_navn if bestilt else start_response)
+        except BaseException:
+            svar.close()
+            raise
+        return svar
+
+
+class _Svar:
+    """Svaret fra appen; profileringen slutter, når serveren lukker det"""
+
+    def __init__(self, navn, profil):
+        self.navn = navn
+        self.profil = profil
+        self.svar = ()
+
+    def __iter__(self):
+        yield from self.svar
+
+    def close(self):
+        try:
+            if hasattr(self.svar, 'close'):
+                self.svar.close()
+        finally:
+            stakke = self.profil.slut()
+            try:
+                _gem(self.navn, stakke)
+            except OSError:
+                pass  # Profilen går tabt, men svaret er sendt
+
+
+_STOP = {Profilering._profiler.__code__, _Svar.__iter__.__code__}
@@ -0,0 +1,249 @@
+"""Kompakte rækker til tabellerne, som CSV-backenden holder i hukommelsen.
+
+En række er et objekt med __slots__ i stedet for et dict. Stregkoder (og
+forfattere og placeringer, der går igen) interneres, så den samme tekst
+kun findes én gang, og udlånenes tidspunkter gemmes som heltal:
+mikrosekunder siden 1970-01-01 i lokal tid, uden tidszone.
+
+Rækkerne kan læses som dicts (row['felt'], row.get(), dict(row) osv.), og
+tidspunkterne kommer så ud i isoformat som før. Backenden selv bruger
+attributterne direkte, og som_dict() giver en kopi, kaldere må ændre.
+"""
+import csv
+import gc
+import sys
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+_EPOKE = date(1970, 1, 1).toordinal()
+_DAG = 86400 * 1000000
+
+# Tekst til tidspunkter bygges af færdige stykker: datoen caches pr. dag
+_dage = {}
+_MINUTTER = ['%02d:%02d:' % divmod(m, 60) for m in range(1440)]
+_SEKUNDER = ['%02d' % s for s in range(60)]
+
+
+def tid(tekst):
+    """Tidspunktet i isoformat som heltal; None for en tom tekst"""
+    if not tekst:
+        return None
+    try:
+        t = datetime.fromisoformat(tekst)
+    except (TypeError, ValueError):
+        raise ValueError(f'Ugyldigt tidspunkt: {tekst!r}') from None
+    sekunder = (t.toordinal() - _EPOKE) * 86400 + t.hour * 3600 + t.minute * 60 + t.second
+    return sekunder * 1000000 + t.microsecond
+
+
+def _dag(dag):
+    ud = _dage.get(dag)
+    if ud is None:
+        ud = _dage[dag] = (date(1970, 1, 1) + timedelta(days=dag)).isoformat() + 'T'
+    return ud
+
+
+def tekst(tid):
+    """Heltallet som isoformat, ligesom datetime.isoformat(); '' for None"""
+    if tid is None:
+        return ''
+    dag, rest = divmod(tid, _DAG)
+    sekunder, mikro = divmod(rest, 1000000)
+    minutter, sekunder = divmod(sekunder, 60)
+    ud = _dag(dag) + _MINUTTER[minutter] + _SEKUNDER[sekunder]
+    return ud + '.%06d' % mikro if mikro else ud
+
+
+def maaned(tid):
+    """ÅÅÅÅ-MM for tidspunktet"""
+    return _dag(tid // _DAG)[:7]
+
+
+class Raekke:
+    """Fælles dict-grænseflade. Underklasser angiver FELTER og __slots__."""
+    __slots__ = ()
+    FELTER = ()
+
+    def __init_subclass__(cls):
+        cls._FELTSAET = frozenset(cls.FELTER)
+        cls._NOEGLER = dict.fromkeys(cls.FELTER).keys()
+
+    @classmethod
+    def fra_csv(cls, *vaerdier):
+        return cls(*vaerdier)
+
+    def __getitem__(self, felt):
+        if felt not in self._FELTSAET:
+            raise KeyError(felt)
+        return getattr(self, felt)
+
+    def __setitem__(self, felt, vaerdi):
+        if felt not in self._FELTSAET:
+            raise KeyError(felt)
+        setattr(self, felt, vaerdi)
+
+    def get(self, felt, standard=None):
+        return self[felt] if felt in self._FELTSAET else standard
+
+    def keys(self):
+        return self._NOEGLER
+
+    def values(self):
+        return [getattr(self, felt) for felt in self.FELTER]
+
+    def items(self):
+        return list(zip(self.FELTER, self.values()))
+
+    def som_dict(self):
+        return dict(zip(self.FELTER, self.values()))
+
+    def __iter__(self):
+        return iter(self.FELTER)
+
+    def __len__(self):
+        return len(self.FELTER)
+
+    def __contains__(self, felt):
+        return felt in self._FELTSAET
+
+    def __eq__(self, anden):
+        if type(anden) is type(self):
+            return self.values() == anden.values()
+        if isinstance(anden, (Raekke, dict)):
+            return self.som_dict() == dict(anden)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.som_dict()!r})'
+
+
+class Bruger(Raekke):
+    __slots__ = ('kode', 'navn')
+    FELTER = ('kode', 'navn')
+
+    def __init__(self, kode, navn):
+        self.kode = sys.intern(kode)
+        self.navn = navn
+
+    def som_dict(self):
+        return {'kode': self.kode, 'navn': self.navn}
+
+
+class Bog(Raekke):
+    __slots__ = ('kode', 'titel', 'forfatter', 'placering')
+    FELTER = ('kode', 'titel', 'forfatter', 'placering')
+
+    def __init__(self, kode, titel, forfatter, placering):
+        self.kode = sys.intern(kode)
+        self.titel = titel
+        self.forfatter = sys.intern(forfatter)
+        self.placering = sys.intern(placering)
+
+    def som_dict(self):
+        return {'kode': self.kode, 'titel': self.titel, 'forfatter': self.forfatter,
+                'placering': self.placering}
+
+
+class Navn:
+    """Et brugernavn eller en titel, som alle udlån med koden deler"""
+    __slots__ = ('tekst',)
+
+    def __init__(self, tekst):
+        self.tekst = tekst
+
+
+class Udlaan(Raekke):
+    """dato, afleveret og forfald er heltal (se tid()); afleveret er None for et
+    åbent udlån og forfald for udlån fra før forfaldsdatoerne.
+
+    brugernavn og titel er ikke felter i filen, men Navn'e, som backenden
+    sætter, når den beriger udlånet.
+    """
+    __slots__ = ('bruger', 'bog', 'dato', 'afleveret', 'forfald', 'brugernavn', 'titel')
+    FELTER = ('bruger', 'bog', 'dato', 'afleveret', 'forfald')
+    _TIDER = frozenset(('dato', 'afleveret', 'forfald'))
+
+    def __init__(self, bruger, bog, dato, afleveret=None, forfald=None):
+        self.bruger = sys.intern(bruger)
+        self.bog = sys.intern(bog)
+        self.dato = dato
+        self.afleveret = afleveret
+        self.forfald = forfald
+        self.brugernavn = self.titel = None
+
+    @classmethod
+    def fra_csv(cls, bruger, bog, dato, afleveret, forfald):
+        return cls(bruger, bog, tid(dato), tid(afleveret) if afleveret else None,
+                   tid(forfald) if forfald else None)
+
+    def __getitem__(self, felt):
+        if felt in self._TIDER:
+            return tekst(getattr(self, felt))
+        return super().__getitem__(felt)
+
+    def __setitem__(self, felt, vaerdi):
+        if felt in self._TIDER:
+            vaerdi = tid(vaerdi)
+        super().__setitem__(felt, vaerdi)
+
+    def values(self):
+        return [self.bruger, self.bog, tekst(self.dato), tekst(self.afleveret),
+                tekst(self.forfald)]
+
+    def som_dict(self):
+        return {'bruger': self.bruger, 'bog': self.bog, 'dato': tekst(self.dato),
+                'afleveret': tekst(self.afleveret), 'forfald': tekst(self.forfald)}
+
+
+@contextmanager
+def uden_gc():
+    """Slå den cykliske GC fra i blokken"""
+    # Rækkerne indeholder ingen cykler, så den cykliske GC slås fra, mens
+    # de oprettes; ellers gennemløber den dem igen og igen
+    gc_til = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_til:
+            gc.enable()
+
+
+def laes(f, klasse, afviste=None):
+    """Læs rækker af klasse fra en åben CSV-fil med overskrift.
+
+    Kolonner findes ud fra overskriften; manglende kolonner bliver '', og
+    ukendte ignoreres. Tomme linjer springes over som i csv.DictReader.
+    Rækker, klasse.fra_csv() afviser (f.eks. et ugyldigt tidspunkt),
+    springes over og føjes til afviste som (linjenummer, felter).
+    """
+    with uden_gc():
+        return _laes(f, klasse, [] if afviste is None else afviste)
+
+
+def _laes(f, klasse, afviste):
+    reader = csv.reader(f)
+    overskrift = next(reader, None)
+    if overskrift is None:
+        return []
+    ny = klasse.fra_csv
+    antal = len(klasse.FELTER)
+    if overskrift == list(klasse.FELTER):
+        pladser = None
+    else:
+        pladser = [overskrift.index(felt) if felt in overskrift else None
+                   for felt in klasse.FELTER]
+    rows = []
+    for linje in reader:
+        try:
+            if pladser is None and len(linje) == antal:
+                rows.append(ny(*linje))
+            elif linje:
+                rows.append(ny(*[linje[i] if i is not None and i < len(linje) else ''
+                                 for i in (pladser or range(antal))]))
+        except ValueError:
+            afviste.append((reader.line_num, linje))
+    return rows
+
@@ -0,0 +1,232 @@
+"""Søgeindeks over bogkataloget.
+
+Titel, forfatter og placering deles i ord, der normaliseres, så store og små
+bogstaver og accenter er ligegyldige, og æ/ø/å matcher ae/oe/aa. Hvert ord i
+søgningen skal matche et ord i bogen, enten helt, som præfiks eller, hvis
+intet andet matcher, som et stavefejlsmatch via trigrammer.
+
+Indekset er et dict, som backends holder i hukommelsen og opdaterer med
+tilfoej() og fjern(), når en bog oprettes eller slettes, og med
+synkroniser(), når bogtabellen er ændret udefra.
+"""
+import bisect
+import heapq
+import itertools
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+SOEGEFELTER = {'titel': 3, 'forfatter': 2, 'placering': 1}
+TRIGRAM_GRAENSE = 0.3
+# Kortere søgeord matcher kun hele ord; ét bogstav ville matche det meste
+MIN_PRAEFIKS = 2
+
+_BOGSTAVER = str.maketrans({'æ': 'ae', 'ø': 'oe', 'å': 'aa', 'ä': 'ae', 'ö': 'oe', 'ü': 'ue'})
+_ORD = re.compile(r'[^\W_]+')
+_ACCENTER = re.compile(r'[\u0300-\u036f]')
+
+def normaliser(tekst):
+    """Små bogstaver, æ/ø/å som ae/oe/aa og uden accenter"""
+    tekst = tekst.casefold().translate(_BOGSTAVER)
+    if tekst.isascii():
+        return tekst
+    return _ACCENTER.sub('', unicodedata.normalize('NFKD', tekst))
+
+def opdel(tekst):
+    return _ORD.findall(normaliser(tekst))
+
+def _trigrammer(token):
+    token = f'  {token} '
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+def nyt_indeks(boeger):
+    indeks = {
+        'laas': threading.Lock(),
+        'boeger': {},       # kode -> bog
+        'titler': {},       # kode -> (titel, kode) til sortering
+        'titelorden': [],   # alle (titel, kode) sorteret
+        'bog_ord': {},      # kode -> {ord: vægt}
+        'poster': {},       # ord -> {kode: vægt}
+        'ordliste': [],     # alle ord sorteret, til præfikssøgning
+        'trigrammer': {},   # trigram -> {ord}
+    }
+    for bog in boeger:
+        _tilfoej(indeks, bog, sorter=False)
+    indeks['ordliste'] = sorted(indeks['poster'])
+    indeks['titelorden'] = sorted(indeks['titler'].values())
+    return indeks
+
+def _tilfoej(indeks, bog, sorter=True):
+    _fjern(indeks, bog['kode'])
+    vaegte = {}
+    for felt, vaegt in SOEGEFELTER.items():
+        for token in opdel(bog.get(felt) or ''):
+            vaegte[token] = max(vaegte.get(token, 0), vaegt)
+    kode = bog['kode']
+    # Bogen gemmes, som den er; backends ændrer ikke en række, de har givet fra sig
+    indeks['boeger'][kode] = bog
+    titel = indeks['titler'][kode] = (normaliser(bog.get('titel') or ''), kode)
+    if sorter:
+        bisect.insort(indeks['titelorden'], titel)
+    indeks['bog_ord'][kode] = vaegte
+    for token, vaegt in vaegte.items():
+        poster = indeks['poster'].get(token)
+        if poster is None:
+            poster = indeks['poster'][token] = {}
+            if sorter:
+                bisect.insort(indeks['ordliste'], token)
+            for trigram in _trigrammer(token):
+                indeks['trigrammer'].setdefault(trigram, set()).add(token)
+        poster[kode] = vaegt
+
+def _fjern(indeks, kode):
+    vaegte = indeks['bog_ord'].pop(kode, None)
+    if vaegte is None:
+        return
+    del indeks['boeger'][kode]
+    titelorden = indeks['titelorden']
+    del titelorden[bisect.bisect_left(titelorden, indeks['titler'].pop(kode))]
+    for token in vaegte:
+        poster = indeks['poster'][token]
+        del poster[kode]
+        if not poster:
+            del indeks['poster'][token]
+            ordliste = indeks['ordliste']
+            del ordliste[bisect.bisect_left(ordliste, token)]
+            for trigram in _trigrammer(token):
+                tokens = indeks['trigrammer'][trigram]
+                tokens.discard(token)
+                if not tokens:
+                    del indeks['trigrammer'][trigram]
+
+def tilfoej(indeks, bog):
+    """Tilføj bogen til indekset (eller erstat den, hvis koden findes)"""
+    with indeks['laas']:
+        _tilfoej(indeks, bog)
+
+def tilfoej_mange(indeks, boeger):
+    """Tilføj mange bøger på én gang; de sorterede lister bygges én gang til sidst"""
+    nye = {bog['kode']: bog for bog in boeger}
+    with indeks['laas']:
+        for kode in nye:
+            _fjern(indeks, kode)
+        for bog in nye.values():
+            _tilfoej(indeks, bog, sorter=False)
+        indeks['ordliste'] = sorted(indeks['poster'])
+        indeks['titelorden'] = sorted(indeks['titler'].values())
+
+def fjern(indeks, kode):
+    with indeks['laas']:
+        _fjern(indeks, kode)
+
+def synkroniser(indeks, boeger):
+    """Returnér et indeks over boeger, genbrugt fra indeks hvis det findes.
+
+    Kun bøger, der er kommet til, fjernet eller ændret, indekseres igen.
+    """
+    if indeks is None:
+        return nyt_indeks(boeger)
+    nye = {bog['kode']: bog for bog in boeger}
+    with indeks['laas']:
+        for kode in [kode for kode in indeks['boeger'] if kode not in nye]:
+            _fjern(indeks, kode)
+        for kode, bog in nye.items():
+            gammel = indeks['boeger'].get(kode)
+            if gammel is not bog and gammel != bog:
+                _tilfoej(indeks, bog)
+    return indeks
+
+def _match(indeks, q):
+    """Returnér {ord: kvalitet} for de ord i indekset, som q matcher"""
+    match = {}
+    if q in indeks['poster']:
+        match[q] = 1.0
+    ordliste = indeks['ordliste']
+    i = bisect.bisect_right(ordliste, q) if len(q) >= MIN_PRAEFIKS else len(ordliste)
+    while i < len(ordliste) and ordliste[i].startswith(q):
+        # Et præfiks tæller mere, jo mere af ordet det dækker
+        match[ordliste[i]] = 0.5 + 0.5 * len(q) / len(ordliste[i])
+        i += 1
+    if match or len(q) < 3:
+        return match
+
+    q_trigrammer = _trigrammer(q)
+    faelles = Counter()
+    for trigram in q_trigrammer:
+        faelles.update(indeks['trigrammer'].get(trigram, ()))
+    for token, antal in faelles.items():
+        lighed = antal / (len(q_trigrammer) + len(_trigrammer(token)) - antal)
+        if lighed >= TRIGRAM_GRAENSE:
+            match[token] = 0.5 * lighed
+    return match
+
+def _efter_titel(indeks, koder, antal):
+    """De første antal af koder sorteret efter titel"""
+    titelorden = indeks['titelorden']
+    if antal * len(titelorden) < len(koder) ** 2:
+        # Mange koder: gå titlerne igennem i rækkefølge, til der er nok
+        fundne = (kode for _, kode in titelorden if kode in koder)
+        return list(itertools.islice(fundne, antal))
+    return heapq.nsmallest(antal, koder, key=indeks['titler'].get)
+
+def _som_dict(bog):
+    # CSV-backenden giver kompakte rækker (raekker.py), der kan kopieres hurtigere
+    som_dict = getattr(bog, 'som_dict', None)
+    return som_dict() if som_dict else dict(bog)
+
+def soeg(indeks, tekst, side, antal):
+    """Returnér (bøgerne på siden, antal fundne) sorteret efter relevans.
+
+    Hver bog får 'relevans' med. Ved lige relevans sorteres efter titel.
+    """
+    with indeks['laas']:
+        matches = [_match(indeks, q) for q in dict.fromkeys(opdel(tekst))]
+        if not matches or not all(matches):
+            return [], 0
+        poster = indeks['poster']
+        # Start med det ord, der matcher færrest bøger
+        matches.sort(key=lambda m: sum(len(poster[t]) for t in m))
+
+        point = None
+        for match in matches:
+            bedste = {}
+            for token, kvalitet in match.items():
+                kandidater = poster[token]
+                if point is not None and len(kandidater) > len(point):
+                    kandidater = {k: kandidater[k] for k in point if k in kandidater}
+                if not bedste:
+                    if kvalitet == 1.0:
+                        bedste = dict(kandidater)
+                    else:
+                        bedste = {kode: vaegt * kvalitet for kode, vaegt in kandidater.items()}
+                    continue
+                for kode, vaegt in kandidater.items():
+                    if vaegt * kvalitet > bedste.get(kode, 0):
+                        bedste[kode] = vaegt * kvalitet
+            if point is not None:
+                bedste = {kode: p + point[kode] for kode, p in bedste.items() if kode in point}
+            point = bedste
+            if not point:
+                return [], 0
+
+        # Der er få forskellige pointtal, så i stedet for at sortere alle
+        # fund grupperes de efter point, og kun de bøger, der skal bruges fra
+        # de bedste grupper, findes efter titel
+        pointtal = set(point.values())
+        if len(pointtal) == 1:
+            grupper = {pointtal.pop(): point}
+        else:
+            grupper = {}
+            for kode, p in point.items():
+                grupper.setdefault(p, set()).add(kode)
+        top = []
+        for p in sorted(grupper, reverse=True):
+            mangler = side * antal - len(top)
+            if mangler <= 0:
+                break
+            top += [(kode, p) for kode in _efter_titel(indeks, grupper[p], mangler)]
+        boeger = indeks['boeger']
+        rows = [dict(_som_dict(boeger[kode]), relevans=round(p, 3))
+                for kode, p in top[(side - 1) * antal:]]
+        return rows, len(point)
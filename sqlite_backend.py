@@ -0,0 +1,605 @@
+"""SQLite-backend: tabellerne ligger i én SQLite-database i WAL-mode"""
+import argparse
+import csv
+import heapq
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import csv_backend
+import metrikker
+import soegning
+import statistik
+from csv_backend import UDLAAN_OK, UKENDT_BRUGER, UKENDT_BOG, ALLEREDE_UDLAANT
+
+DATABASEFIL = os.environ.get('BIBLIOTEK_DATABASE', 'data/bibliotek.db')
+
+SKEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    noegle TEXT PRIMARY KEY,
+    vaerdi TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS brugere (
+    kode TEXT PRIMARY KEY,
+    navn TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS boeger (
+    kode TEXT PRIMARY KEY,
+    titel TEXT NOT NULL DEFAULT '',
+    forfatter TEXT NOT NULL DEFAULT '',
+    placering TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS udlaan (
+    id INTEGER PRIMARY KEY,
+    bruger TEXT NOT NULL,
+    bog TEXT NOT NULL,
+    dato TEXT NOT NULL,
+    afleveret TEXT NOT NULL DEFAULT '',
+    forfald TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS udlaan_bog ON udlaan (bog);
+CREATE INDEX IF NOT EXISTS udlaan_bruger ON udlaan (bruger);
+CREATE INDEX IF NOT EXISTS udlaan_aabne ON udlaan (bog, bruger) WHERE afleveret = '';
+CREATE INDEX IF NOT EXISTS udlaan_dato ON udlaan (dato);
+CREATE TABLE IF NOT EXISTS versioner (
+    tabel TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    aendret REAL NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO versioner (tabel) VALUES ('brugere'), ('boeger'), ('udlaan');
+-- Udlån med brugernavn og titel til oversigten og eksporten
+CREATE VIEW IF NOT EXISTS udlaan_beriget AS
+SELECT u.id, u.bruger, COALESCE(br.navn, 'Ukendt bruger') AS brugernavn,
+       u.bog, COALESCE(b.titel, 'Ukendt titel') AS titel, u.dato, u.afleveret
+FROM udlaan u
+LEFT JOIN brugere br ON br.kode = u.bruger
+LEFT JOIN boeger b ON b.kode = u.bog;
+''' + ''.join(
+    # Hver ændring tæller tabellens version op, så eksporten kan lave ETags
+    f'''
+CREATE TRIGGER IF NOT EXISTS {tabel}_{handling.lower()} AFTER {handling} ON {tabel}
+BEGIN
+    UPDATE versioner SET version = version + 1,
+                         aendret = (julianday('now') - 2440587.5) * 86400.0
+    WHERE tabel = '{tabel}';
+END;'''
+    for tabel in ('brugere', 'boeger', 'udlaan')
+    for handling in ('INSERT', 'UPDATE', 'DELETE')) + '''
+-- Statistik, som triggerne holder ved lige. Udlånstiden regnes i hele
+-- sekunder ligesom i statistik.py.
+CREATE TABLE IF NOT EXISTS statistik (
+    noegle TEXT PRIMARY KEY,
+    vaerdi INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO statistik (noegle) VALUES ('udlaan'), ('afleveret'), ('varighed');
+CREATE TABLE IF NOT EXISTS statistik_dag (dag TEXT PRIMARY KEY, antal INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS statistik_bog (bog TEXT PRIMARY KEY, antal INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS statistik_bruger (bruger TEXT PRIMARY KEY, antal INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS statistik_bog_antal ON statistik_bog (antal DESC, bog);
+CREATE INDEX IF NOT EXISTS statistik_bruger_antal ON statistik_bruger (antal DESC, bruger);
+CREATE TRIGGER IF NOT EXISTS statistik_udlaan AFTER INSERT ON udlaan
+BEGIN
+    UPDATE statistik SET vaerdi = vaerdi + 1 WHERE noegle = 'udlaan';
+    INSERT INTO statistik_dag VALUES (substr(new.dato, 1, 10), 1)
+        ON CONFLICT (dag) DO UPDATE SET antal = antal + 1;
+    INSERT INTO statistik_bog VALUES (new.bog, 1)
+        ON CONFLICT (bog) DO UPDATE SET antal = antal + 1;
+    INSERT INTO statistik_bruger VALUES (new.bruger, 1)
+        ON CONFLICT (bruger) DO UPDATE SET antal = antal + 1;
+    UPDATE statistik SET vaerdi = vaerdi + 1
+        WHERE noegle = 'afleveret' AND new.afleveret != '';
+    UPDATE statistik SET vaerdi = vaerdi + strftime('%s', new.afleveret) - strftime('%s', new.dato)
+        WHERE noegle = 'varighed' AND new.afleveret != '';
+END;
+CREATE TRIGGER IF NOT EXISTS statistik_aflevering AFTER UPDATE OF afleveret ON udlaan
+WHEN old.afleveret = '' AND new.afleveret != ''
+BEGIN
+    UPDATE statistik SET vaerdi = vaerdi + 1 WHERE noegle = 'afleveret';
+    UPDATE statistik SET vaerdi = vaerdi + strftime('%s', new.afleveret) - strftime('%s', new.dato)
+        WHERE noegle = 'varighed';
+END;
+'''
+
+# Én forbindelse pr. tråd. Pid'en gemmes, så en forbindelse arvet over en
+# fork (Gunicorn med --preload) ikke genbruges i workeren.
+_lokal = threading.local()
+
+# Skemaet oprettes og CSV-filerne migreres én gang pr. proces og databasefil;
+# en ny forbindelse sætter kun sine PRAGMAs
+_skema_laas = threading.Lock()
+_skema_klar = None  # (pid, DATABASEFIL)
+
+def _efter_fork():
+    global _skema_laas
+    _skema_laas = threading.Lock()
+
+os.register_at_fork(after_in_child=_efter_fork)
+
+def _forbindelse():
+    con = getattr(_lokal, 'con', None)
+    if con is None or _lokal.pid != os.getpid():
+        con = sqlite3.connect(DATABASEFIL, timeout=30, isolation_level=None,
+                              check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        _lokal.con, _lokal.pid = con, os.getpid()
+    if _skema_klar != (os.getpid(), DATABASEFIL) and not getattr(_lokal, 'opretter', False):
+        _opret_skema(con)
+    return con
+
+def _opret_skema(con):
+    global _skema_klar
+    with _skema_laas:
+        if _skema_klar == (os.getpid(), DATABASEFIL):
+            return
+        # Migreringen kalder selv _forbindelse() i denne tråd
+        _lokal.opretter = True
+        try:
+            con.executescript(SKEMA)
+            _tilfoej_forfald(con)
+            migrer_fra_csv()
+            if not con.execute("SELECT 1 FROM meta WHERE noegle = 'statistik'").fetchone():
+                # Databasen er fra før statistikken; byg den ud fra udlånene
+                genopbyg_statistik()
+        finally:
+            _lokal.opretter = False
+        _skema_klar = (os.getpid(), DATABASEFIL)
+
+def _tilfoej_forfald(con):
+    """Tilføj forfald til en database fra før forfaldsdatoerne og indekset over
+    de åbne udlån efter forfaldsdato (og udlånsdato for dem uden)"""
+    if 'forfald' not in {row[1] for row in con.execute('PRAGMA table_info(udlaan)')}:
+        con.execute("ALTER TABLE udlaan ADD COLUMN forfald TEXT NOT NULL DEFAULT ''")
+    con.execute("CREATE INDEX IF NOT EXISTS udlaan_forfald ON udlaan (forfald, dato) "
+                "WHERE afleveret = ''")
+
+@contextmanager
+def _transaktion():
+    con = _forbindelse()
+    start = time.perf_counter()
+    con.execute('BEGIN IMMEDIATE')
+    metrikker.observer('bibliotek_laas_ventetid_seconds', time.perf_counter() - start,
+                       laas='sqlite')
+    try:
+        yield con
+    except BaseException:
+        con.execute('ROLLBACK')
+        raise
+    con.execute('COMMIT')
+
+def _rows(cursor):
+    return [dict(row) for row in cursor]
+
+# Migrering og eksport
+def migrer_fra_csv():
+    """Importér data/*.csv én gang. Returnerer False hvis det allerede er gjort."""
+    with _transaktion() as con:
+        if con.execute("SELECT 1 FROM meta WHERE noegle = 'migreret'").fetchone():
+            return False
+        con.executemany(
+            'INSERT OR IGNORE INTO brugere (kode, navn) VALUES (:kode, :navn)',
+            ({'kode': b['kode'], 'navn': b.get('navn') or ''}
+             for b in csv_backend.hent_alle_brugere()))
+        con.executemany(
+            'INSERT OR IGNORE INTO boeger (kode, titel, forfatter, placering) '
+            'VALUES (:kode, :titel, :forfatter, :placering)',
+            ({felt: b.get(felt) or '' for felt in csv_backend.BOG_FELTER}
+             for b in csv_backend.hent_alle_boeger()))
+        con.executemany(
+            'INSERT INTO udlaan (bruger, bog, dato, afleveret, forfald) '
+            'VALUES (:bruger, :bog, :dato, :afleveret, :forfald)',
+            ({felt: u.get(felt) or '' for felt in csv_backend.UDLAAN_FELTER}
+             for u in csv_backend.hent_alle_udlaan(None, None)))
+        con.execute("INSERT INTO meta (noegle, vaerdi) VALUES ('migreret', ?)",
+                    (datetime.now().isoformat(),))
+    return True
+
+_EKSPORT = {
+    'brugere': (csv_backend.BRUGERFIL, csv_backend.BRUGER_FELTER,
+                'SELECT kode, navn FROM brugere ORDER BY rowid'),
+    'boeger': (csv_backend.BOGFIL, csv_backend.BOG_FELTER,
+               'SELECT kode, titel, forfatter, placering FROM boeger ORDER BY rowid'),
+    'udlaan': (csv_backend.UDLAANFIL, csv_backend.UDLAAN_FELTER,
+               'SELECT bruger, bog, dato, afleveret, forfald FROM udlaan ORDER BY id'),
+}
+
+def eksporter(navn):
+    """Skriv tabellen til dens CSV-fil og returnér stien"""
+    filepath, fieldnames, sql = _EKSPORT[navn]
+    cursor = _forbindelse().execute(sql)
+
+    def skriv(f):
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(cursor)
+
+    csv_backend._erstat_fil(filepath, skriv)
+    return filepath
+
+def komprimer_udlaan():
+    """Flyt WAL-filen ind i databasen, så den ikke vokser uden grænse"""
+    _forbindelse().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return True
+
+def start_komprimering(interval):
+    """Start en baggrundstråd, der laver et WAL-checkpoint hvert interval sekunder"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                komprimer_udlaan()
+            except sqlite3.Error:
+                pass  # Prøv igen ved næste interval
+    threading.Thread(target=loop, name='sqlite-checkpoint', daemon=True).start()
+
+# Brugere
+def find_bruger(kode):
+    sql = 'SELECT 1 FROM brugere WHERE kode = ?'
+    return _forbindelse().execute(sql, (kode,)).fetchone() is not None
+
+def opret_bruger(kode, navn):
+    with _transaktion() as con:
+        cursor = con.execute(
+            'INSERT OR IGNORE INTO brugere (kode, navn) VALUES (?, ?)', (kode, navn))
+    return cursor.rowcount == 1
+
+def importer_brugere(rows):
+    """Opret brugerne, hvis koderne ikke findes, i én transaktion. Returnerer en bool pr. række."""
+    with _transaktion() as con:
+        kendte = {row[0] for row in con.execute('SELECT kode FROM brugere')}
+        oprettet = [row['kode'] not in kendte for row in rows]
+        con.executemany('INSERT INTO brugere (kode, navn) VALUES (:kode, :navn)',
+                        (row for row, ny in zip(rows, oprettet) if ny))
+    return oprettet
+
+def hent_alle_brugere():
+    return _rows(_forbindelse().execute('SELECT kode, navn FROM brugere ORDER BY rowid'))
+
+# Bøger
+def find_bog(kode):
+    sql = 'SELECT 1 FROM boeger WHERE kode = ?'
+    return _forbindelse().execute(sql, (kode,)).fetchone() is not None
+
+def opret_bog(kode, titel, forfatter, placering):
+    bog = {'kode': kode, 'titel': titel, 'forfatter': forfatter, 'placering': placering}
+    with _transaktion() as con:
+        foer = _boeger_version(con)
+        cursor = con.execute(
+            'INSERT OR IGNORE INTO boeger (kode, titel, forfatter, placering) '
+            'VALUES (?, ?, ?, ?)', (kode, titel, forfatter, placering))
+        if cursor.rowcount == 1:
+            _opdater_soegeindeks(foer, _boeger_version(con),
+                                 lambda indeks: soegning.tilfoej(indeks, bog))
+    return cursor.rowcount == 1
+
+def importer_boeger(rows):
+    """Opret bøgerne, hvis koderne ikke findes, i én transaktion. Returnerer en bool pr. række."""
+    with _transaktion() as con:
+        kendte = {row[0] for row in con.execute('SELECT kode FROM boeger')}
+        oprettet = [row['kode'] not in kendte for row in rows]
+        nye = [row for row, ny in zip(rows, oprettet) if ny]
+        if nye:
+            foer = _boeger_version(con)
+            con.executemany(
+                'INSERT INTO boeger (kode, titel, forfatter, placering) '
+                'VALUES (:kode, :titel, :forfatter, :placering)', nye)
+            _opdater_soegeindeks(foer, _boeger_version(con),
+                                 lambda indeks: soegning.tilfoej_mange(indeks, nye))
+    return oprettet
+
+def hent_bog(kode):
+    row = _forbindelse().execute(
+        'SELECT kode, titel, forfatter, placering FROM boeger WHERE kode = ?',
+        (kode,)).fetchone()
+    return dict(row) if row is not None else None
+
+def hent_alle_boeger():
+    return _rows(_forbindelse().execute(
+        'SELECT kode, titel, forfatter, placering FROM boeger ORDER BY rowid'))
+
+# Søgeindekset bygges i hver proces ud fra bogtabellen og huskes sammen med
+# tabellens version. Egne ændringer lægges ind med det samme; ændres
+# versionen af en anden proces, synkroniseres indekset ved næste søgning.
+_soeg = {'version': None, 'indeks': None}
+_soeg_laas = threading.Lock()
+
+def _boeger_version(con):
+    return con.execute("SELECT version FROM versioner WHERE tabel = 'boeger'").fetchone()[0]
+
+def _opdater_soegeindeks(foer, efter, aendring):
+    # Kaldes inde i transaktionen, så ingen anden kan have skrevet imellem
+    with _soeg_laas:
+        if _soeg['indeks'] is not None and _soeg['version'] == foer:
+            aendring(_soeg['indeks'])
+            _soeg['version'] = efter
+
+def _soegeindeks():
+    con = _forbindelse()
+    with _soeg_laas:
+        version = _boeger_version(con)
+        metrikker.cache('soegeindeks', _soeg['version'] == version)
+        if _soeg['version'] != version:
+            boeger = _rows(con.execute(
+                'SELECT kode, titel, forfatter, placering FROM boeger ORDER BY rowid'))
+            _soeg['indeks'] = soegning.synkroniser(_soeg['indeks'], boeger)
+            _soeg['version'] = version
+        return _soeg['indeks']
+
+def soeg_boeger(tekst, side, antal):
+    return soegning.soeg(_soegeindeks(), tekst, side, antal)
+
+# Udlån
+def bog_udlaant(bog_kode):
+    sql = "SELECT 1 FROM udlaan WHERE bog = ? AND afleveret = ''"
+    return _forbindelse().execute(sql, (bog_kode,)).fetchone() is not None
+
+def _indsaet_udlaan(con, bruger_kode, bog_kode, dage):
+    nu = datetime.now()
+    con.execute('INSERT INTO udlaan (bruger, bog, dato, forfald) VALUES (?, ?, ?, ?)',
+                (bruger_kode, bog_kode, nu.isoformat(), (nu + timedelta(days=dage)).isoformat()))
+
+def registrer_udlaan(bruger_kode, bog_kode, dage):
+    with _transaktion() as con:
+        # Som i CSV-backenden: et åbent udlån af bogen regnes for afleveret,
+        # da det nye startede
+        con.execute("UPDATE udlaan SET afleveret = ? WHERE bog = ? AND afleveret = ''",
+                    (datetime.now().isoformat(), bog_kode))
+        _indsaet_udlaan(con, bruger_kode, bog_kode, dage)
+
+def _checkout(con, bruger_kode, bog_kode, dage):
+    bruger, bog, udlaant = con.execute(
+        "SELECT EXISTS (SELECT 1 FROM brugere WHERE kode = :bruger), "
+        "EXISTS (SELECT 1 FROM boeger WHERE kode = :bog), "
+        "EXISTS (SELECT 1 FROM udlaan WHERE bog = :bog AND afleveret = '')",
+        {'bruger': bruger_kode, 'bog': bog_kode}).fetchone()
+    if not bruger:
+        return UKENDT_BRUGER
+    if not bog:
+        return UKENDT_BOG
+    if udlaant:
+        return ALLEREDE_UDLAANT
+    _indsaet_udlaan(con, bruger_kode, bog_kode, dage)
+    return UDLAAN_OK
+
+def checkout(bruger_kode, bog_kode, dage):
+    """Tjek bruger, bog og om bogen er ude, og registrér udlånet i én transaktion"""
+    with _transaktion() as con:
+        return _checkout(con, bruger_kode, bog_kode, dage)
+
+def registrer_udlaan_batch(poster, dage):
+    """Registrér en liste af (bruger, bog) i én transaktion med et resultat pr. udlån"""
+    with _transaktion() as con:
+        return [_checkout(con, bruger, bog, dage) for bruger, bog in poster]
+
+def _aflever(con, bog_kode):
+    cursor = con.execute(
+        "UPDATE udlaan SET afleveret = ? WHERE id = ("
+        "SELECT id FROM udlaan WHERE bog = ? AND afleveret = '' ORDER BY id LIMIT 1)",
+        (datetime.now().isoformat(), bog_kode))
+    return cursor.rowcount == 1
+
+def registrer_aflevering(bog_kode):
+    with _transaktion() as con:
+        return _aflever(con, bog_kode)
+
+def registrer_aflevering_batch(bog_koder):
+    """Registrér en liste af afleveringer i én transaktion med et resultat pr. bog"""
+    with _transaktion() as con:
+        return [_aflever(con, bog) for bog in bog_koder]
+
+def hent_aabent_udlaan(bog_kode):
+    """Bogens åbne udlån med brugernavn og titel som i oversigten, eller None"""
+    row = _forbindelse().execute(
+        "SELECT bruger, brugernavn, bog, titel, dato, afleveret FROM udlaan_beriget "
+        "WHERE bog = ? AND afleveret = '' ORDER BY id DESC LIMIT 1", (bog_kode,)).fetchone()
+    return dict(row) if row is not None else None
+
+# Forfald. Udlån uden forfaldsdato (fra før forfaldsdatoerne) forfalder
+# standardperioden efter udlånsdatoen. Begge slags findes med et
+# intervalopslag i udlaan_forfald og flettes efter forfaldsdato.
+_FORFALD_SQL = (
+    "SELECT u.bruger, COALESCE(br.navn, 'Ukendt bruger') AS brugernavn, u.bog, "
+    "COALESCE(b.titel, 'Ukendt titel') AS titel, u.dato, u.afleveret, {forfald} AS forfald "
+    "FROM udlaan u "
+    "LEFT JOIN brugere br ON br.kode = u.bruger LEFT JOIN boeger b ON b.kode = u.bog "
+    "WHERE u.afleveret = '' AND {hvor} ORDER BY u.forfald, u.dato LIMIT ?")
+
+def _forskudt(tekst, dage):
+    return (datetime.fromisoformat(tekst) + timedelta(days=dage)).isoformat()
+
+def hent_forfaldne(fra, til, antal, standard_dage):
+    """De åbne udlån med forfaldsdato i [fra, til) efter forfaldsdato, højst antal"""
+    graense = -1 if antal is None else antal
+    dele = []
+    for felt, forskydning, hvor in (('u.forfald', 0, ["u.forfald > ''"]),
+                                    ('u.dato', -standard_dage, ["u.forfald = ''"])):
+        params = []
+        for tekst, sammenligning in ((fra, '>='), (til, '<')):
+            if tekst:
+                hvor.append(f'{felt} {sammenligning} ?')
+                params.append(_forskudt(tekst, forskydning))
+        sql = _FORFALD_SQL.format(hvor=' AND '.join(hvor), forfald=(
+            'u.forfald' if forskydning == 0 else "''"))
+        rows = _rows(_forbindelse().execute(sql, params + [graense]))
+        for row in rows:
+            if not row['forfald']:
+                row['forfald'] = _forskudt(row['dato'], standard_dage)
+        dele.append(rows)
+    udlaan = list(heapq.merge(*dele, key=lambda row: row['forfald']))
+    return udlaan if antal is None else udlaan[:antal]
+
+def hent_udlaan_for_bruger(bruger_kode):
+    return _rows(_forbindelse().execute(
+        "SELECT bruger, bog, dato, afleveret, forfald FROM udlaan "
+        "WHERE bruger = ? AND afleveret = '' ORDER BY id", (bruger_kode,)))
+
+def _dato_filter(fra, til):
+    """(WHERE-betingelser, parametre) for udlånsdato i [fra, til)"""
+    hvor, params = [], []
+    if fra:
+        hvor.append('u.dato >= ?')
+        params.append(fra)
+    if til:
+        hvor.append('u.dato < ?')
+        params.append(til)
+    return hvor, params
+
+def hent_alle_udlaan(fra, til):
+    """Returnér alle udlån (også dem der er afleveret) sorteret efter dato"""
+    hvor, params = _dato_filter(fra, til)
+    return _rows(_forbindelse().execute(
+        'SELECT bruger, bog, dato, afleveret, forfald FROM udlaan u'
+        + (' WHERE ' + ' AND '.join(hvor) if hvor else '') + ' ORDER BY u.dato, u.id', params))
+
+def slet_bruger(kode):
+    with _transaktion() as con:
+        con.execute('DELETE FROM brugere WHERE kode = ?', (kode,))
+
+def slet_bog(kode):
+    with _transaktion() as con:
+        if con.execute("SELECT 1 FROM udlaan WHERE bog = ? AND afleveret = ''",
+                       (kode,)).fetchone():
+            return False  # Bogen er stadig udlånt
+        foer = _boeger_version(con)
+        if con.execute('DELETE FROM boeger WHERE kode = ?', (kode,)).rowcount:
+            _opdater_soegeindeks(foer, _boeger_version(con),
+                                 lambda indeks: soegning.fjern(indeks, kode))
+    return True
+
+def hent_udlaan_med_brugernavn_og_bogtitel(fra, til):
+    hvor, params = _dato_filter(fra, til)
+    return _rows(_forbindelse().execute(
+        'SELECT u.bruger, u.brugernavn, u.bog, u.titel, u.dato, u.afleveret, '
+        'u.titel AS bogtitel FROM udlaan_beriget u'
+        + (' WHERE ' + ' AND '.join(hvor) if hvor else '') + ' ORDER BY u.dato, u.id', params))
+
+
+# Statistik
+def genopbyg_statistik():
+    """Byg statistiktabellerne forfra ud fra udlaan"""
+    with _transaktion() as con:
+        for tabel in ('statistik_dag', 'statistik_bog', 'statistik_bruger'):
+            con.execute(f'DELETE FROM {tabel}')
+        con.execute('INSERT INTO statistik_dag SELECT substr(dato, 1, 10), COUNT(*) '
+                    'FROM udlaan GROUP BY 1')
+        con.execute('INSERT INTO statistik_bog SELECT bog, COUNT(*) FROM udlaan GROUP BY bog')
+        con.execute('INSERT INTO statistik_bruger SELECT bruger, COUNT(*) '
+                    'FROM udlaan GROUP BY bruger')
+        udlaan, afleveret, varighed = con.execute(
+            "SELECT COUNT(*), COUNT(NULLIF(afleveret, '')), "
+            "COALESCE(SUM(CASE WHEN afleveret != '' "
+            "THEN strftime('%s', afleveret) - strftime('%s', dato) END), 0) FROM udlaan").fetchone()
+        con.executemany('UPDATE statistik SET vaerdi = ? WHERE noegle = ?',
+                        [(udlaan, 'udlaan'), (afleveret, 'afleveret'), (varighed, 'varighed')])
+        con.execute("INSERT OR REPLACE INTO meta (noegle, vaerdi) VALUES ('statistik', ?)",
+                    (datetime.now().isoformat(),))
+
+def hent_statistik(sidste_dag, dage, top, nu, standard_dage):
+    con = _forbindelse()
+    foerste = sidste_dag - timedelta(days=dage - 1)
+    # Én læsetransaktion, så tallene passer sammen
+    con.execute('BEGIN')
+    try:
+        aggregat = statistik.tomt()
+        aggregat.update(con.execute('SELECT noegle, vaerdi FROM statistik').fetchall())
+        aggregat['pr_dag'] = Counter({
+            statistik.dag(date.fromisoformat(row[0])): row[1] for row in con.execute(
+                'SELECT dag, antal FROM statistik_dag WHERE dag BETWEEN ? AND ?',
+                (foerste.isoformat(), sidste_dag.isoformat()))})
+        titler = {}
+        for kode, antal, titel in con.execute(
+                'SELECT s.bog, s.antal, b.titel FROM statistik_bog s '
+                'LEFT JOIN boeger b ON b.kode = s.bog ORDER BY s.antal DESC, s.bog LIMIT ?', (top,)):
+            aggregat['pr_bog'][kode] = antal
+            titler[kode] = titel
+        navne = {}
+        for kode, antal, navn in con.execute(
+                'SELECT s.bruger, s.antal, b.navn FROM statistik_bruger s '
+                'LEFT JOIN brugere b ON b.kode = s.bruger '
+                'ORDER BY s.antal DESC, s.bruger LIMIT ?', (top,)):
+            aggregat['pr_bruger'][kode] = antal
+            navne[kode] = navn
+        aabne, overskredne = con.execute(
+            "SELECT COUNT(*), COUNT(CASE WHEN forfald != '' AND forfald < :nu "
+            "OR forfald = '' AND dato < :foer THEN 1 END) FROM udlaan WHERE afleveret = ''",
+            {'nu': nu, 'foer': _forskudt(nu, -standard_dage)}).fetchone()
+    finally:
+        con.execute('COMMIT')
+    return statistik.rapport(aggregat, aabne, overskredne, sidste_dag, dage, top,
+                             lambda kode: navne[kode] or csv_backend.UKENDT_BRUGERNAVN,
+                             lambda kode: titler[kode] or csv_backend.UKENDT_TITEL)
+
+# Eksport
+def tabel_version(navn):
+    """Returnér (version, ændringstidspunkt) for tabellen"""
+    row = _forbindelse().execute(
+        "SELECT v.version, v.aendret, m.vaerdi FROM versioner v "
+        "LEFT JOIN meta m ON m.noegle = 'migreret' WHERE v.tabel = ?", (navn,)).fetchone()
+    # Migreringstidspunktet skiller versionerne ad, hvis databasen laves om
+    return f'{row[2]}:{row[0]}', row[1]
+
+def eksporter_rows(navn, fra, til, kun_aktive, beriget):
+    if navn != 'udlaan':
+        return (dict(row) for row in _forbindelse().execute(_EKSPORT[navn][2]))
+
+    if beriget:
+        sql = _SIDE_SQL['udlaan']
+    else:
+        sql = 'SELECT u.id AS nr, u.bruger, u.bog, u.dato, u.afleveret, u.forfald FROM udlaan u'
+    hvor, params = _dato_filter(fra, til)
+    if kun_aktive:
+        hvor.append("u.afleveret = ''")
+    if hvor:
+        sql += ' WHERE ' + ' AND '.join(hvor)
+    sql += ' ORDER BY u.dato, u.id'
+    cursor = _forbindelse().execute(sql, params)
+    return ({k: row[k] for k in row.keys() if k != 'nr'} for row in cursor)
+
+# Oversigt
+_SIDE_SQL = {
+    'brugere': 'SELECT rowid AS nr, kode, navn FROM brugere',
+    'boeger': 'SELECT rowid AS nr, kode, titel, forfatter, placering FROM boeger',
+    'udlaan': 'SELECT u.id AS nr, u.bruger, u.brugernavn, u.bog, u.titel, u.dato, u.afleveret '
+              'FROM udlaan_beriget u',
+}
+
+def hent_side(tabel, side, antal, sorter, faldende, soeg, kun_aktive, fra, til):
+    # sorter er allerede tjekket mod kolonnerne i data_access
+    sql = _SIDE_SQL[tabel]
+    filtre, params = _dato_filter(fra, til)
+    if kun_aktive:
+        filtre.append("u.afleveret = ''")
+    if filtre:
+        sql += ' WHERE ' + ' AND '.join(filtre)
+    con = _forbindelse()
+    kolonner = [k[0] for k in con.execute(f'SELECT * FROM ({sql}) LIMIT 0', params).description][1:]
+
+    hvor = ''
+    if soeg:
+        hvor = ' WHERE ' + ' OR '.join(f'instr(lower({k}), ?) > 0' for k in kolonner)
+        params = params + [soeg.lower()] * len(kolonner)
+    retning = 'DESC' if faldende else 'ASC'
+    orden = f'{sorter} COLLATE NOCASE {retning}, nr {retning}' if sorter else f'nr {retning}'
+
+    total = con.execute(f'SELECT COUNT(*) FROM ({sql}){hvor}', params).fetchone()[0]
+    rows = con.execute(
+        f'SELECT {", ".join(kolonner)} FROM ({sql}){hvor} ORDER BY {orden} LIMIT ? OFFSET ?',
+        params + [antal, (side - 1) * antal])
+    return _rows(rows), total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrér mellem CSV-filerne og SQLite-databasen')
+    parser.add_argument('kommando', choices=['migrer', 'eksporter'])
+    args = parser.parse_args()
+    if args.kommando == 'migrer':
+        _forbindelse()  # Migrerer automatisk første gang
+        print(f"Data fra CSV-filerne ligger i {DATABASEFIL}")
+    else:
+        for navn in _EKSPORT:
+            print(eksporter(navn))
@@ -0,0 +1,186 @@
+"""Statistik over udlån som aggregater, der kan opdateres løbende.
+
+Et aggregat er et dict med antal udlån og afleveringer, den samlede
+udlånstid og tællere pr. dag, bog og bruger. udlaan() og aflevering()
+lægger én hændelse til, byg() bygger et aggregat forfra over en liste af
+udlån (raekker.Udlaan), og aggregater kan lægges til og trækkes fra
+hinanden, så dele af udlånene (f.eks. en arkivmåned) kan skiftes ud.
+
+byg() regner tider og dage vektoriseret med NumPy, hvis det er
+installeret, og ellers i ren Python; de to giver samme resultat. NumPy er
+valgfrit (se requirements.txt): ved 200.000 udlån tager byg() ca. 160 ms
+i ren Python og 100 ms med NumPy. byg() bruges kun, når statistikken
+bygges forfra; siderne læser de løbende opdaterede aggregater. Kør
+python statistik.py kontrol for at sammenligne de to på data/.
+
+Udlånstiden regnes i hele sekunder mellem tidspunkterne skåret ned til
+hele sekunder, så den kan regnes ens i Python, NumPy og SQLite.
+"""
+import argparse
+import bisect
+import time
+from collections import Counter
+from datetime import date, timedelta
+from operator import attrgetter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_DAG = 86400 * 1000000
+_EPOKE = date(1970, 1, 1)
+
+def tomt():
+    return {
+        'udlaan': 0,
+        'afleveret': 0,
+        'varighed': 0,          # sekunder i alt for de afleverede udlån
+        'pr_dag': Counter(),    # dage siden 1970-01-01 -> udlån
+        'pr_bog': Counter(),    # bogkode -> udlån
+        'pr_bruger': Counter(), # brugerkode -> udlån
+    }
+
+def _tael_op(aggregat, felt, kode):
+    taeller = aggregat[felt]
+    n = taeller[kode]
+    taeller[kode] = n + 1
+    # Ranglisten, hvis flest() har bygget den, flyttes med
+    rang = aggregat.get('rang')
+    if rang is not None:
+        liste = rang[felt]
+        if n:
+            del liste[bisect.bisect_left(liste, (-n, kode))]
+        bisect.insort(liste, (-n - 1, kode))
+
+def udlaan(aggregat, row):
+    aggregat['udlaan'] += 1
+    aggregat['pr_dag'][row.dato // _DAG] += 1
+    _tael_op(aggregat, 'pr_bog', row.bog)
+    _tael_op(aggregat, 'pr_bruger', row.bruger)
+
+def aflevering(aggregat, row):
+    aggregat['afleveret'] += 1
+    aggregat['varighed'] += row.afleveret // 1000000 - row.dato // 1000000
+
+def _byg_python(rows):
+    aggregat = tomt()
+    afleverede = [row for row in rows if row.afleveret is not None]
+    aggregat['udlaan'] = len(rows)
+    aggregat['afleveret'] = len(afleverede)
+    aggregat['varighed'] = sum(row.afleveret // 1000000 - row.dato // 1000000
+                               for row in afleverede)
+    aggregat['pr_dag'] = Counter(row.dato // _DAG for row in rows)
+    aggregat['pr_bog'] = Counter(row.bog for row in rows)
+    aggregat['pr_bruger'] = Counter(row.bruger for row in rows)
+    return aggregat
+
+def _byg_numpy(rows):
+    n = len(rows)
+    dato = np.fromiter((row.dato for row in rows), np.int64, n)
+    afleveret = np.fromiter((-1 if row.afleveret is None else row.afleveret for row in rows),
+                            np.int64, n)
+    afleverede = afleveret >= 0
+    aggregat = tomt()
+    aggregat['udlaan'] = n
+    aggregat['afleveret'] = int(afleverede.sum())
+    aggregat['varighed'] = int((afleveret[afleverede] // 1000000
+                                - dato[afleverede] // 1000000).sum())
+    if n:
+        dage = dato // _DAG
+        foerste = int(dage.min())
+        antal = np.bincount(dage - foerste)
+        aggregat['pr_dag'] = Counter({foerste + int(d): int(antal[d])
+                                      for d in np.flatnonzero(antal)})
+    # Koderne er internerede tekster, og Counter tæller dem allerede i C;
+    # at lave dem om til tal til NumPy først koster mere, end det sparer
+    aggregat['pr_bog'] = Counter(map(attrgetter('bog'), rows))
+    aggregat['pr_bruger'] = Counter(map(attrgetter('bruger'), rows))
+    return aggregat
+
+def byg(rows):
+    """Aggregatet for udlånene, som om hvert var lagt til med udlaan() og aflevering()"""
+    return _byg_numpy(rows) if np is not None else _byg_python(rows)
+
+def laeg_til(aggregat, andet):
+    aggregat.pop('rang', None)
+    for felt in ('udlaan', 'afleveret', 'varighed'):
+        aggregat[felt] += andet[felt]
+    for felt in ('pr_dag', 'pr_bog', 'pr_bruger'):
+        aggregat[felt] += andet[felt]
+
+def traek_fra(aggregat, andet):
+    # Counter's -= fjerner de nøgler, der kommer ned på 0
+    aggregat.pop('rang', None)
+    for felt in ('udlaan', 'afleveret', 'varighed'):
+        aggregat[felt] -= andet[felt]
+    for felt in ('pr_dag', 'pr_bog', 'pr_bruger'):
+        aggregat[felt] -= andet[felt]
+
+def dag(dato):
+    """Dagens nøgle i 'pr_dag' for en datetime.date"""
+    return (dato - _EPOKE).days
+
+def flest(aggregat, felt, antal):
+    """[(kode, antal)] for de antal bøger eller brugere ('pr_bog' eller
+    'pr_bruger') med flest udlån; lige mange sorteres efter koden.
+
+    Første kald bygger en rangliste, som udlaan() derefter holder sorteret.
+    """
+    rang = aggregat.get('rang')
+    if rang is None:
+        rang = aggregat['rang'] = {
+            f: sorted((-n, kode) for kode, n in aggregat[f].items() if n > 0)
+            for f in ('pr_bog', 'pr_bruger')}
+    return [(kode, -n) for n, kode in rang[felt][:antal]]
+
+def rapport(aggregat, aabne, overskredne, sidste_dag, dage, top, navne, titler):
+    """Statistikken som et JSON-venligt dict.
+
+    pr_dag dækker de dage dage, der slutter med sidste_dag (datetime.date).
+    navne og titler er funktioner fra kode til brugernavn og titel.
+    """
+    foerste = dag(sidste_dag) - dage + 1
+    afleveret = aggregat['afleveret']
+    return {
+        'udlaan_i_alt': aggregat['udlaan'],
+        'afleveret_i_alt': afleveret,
+        'gennemsnitlig_udlaanstid_dage':
+            round(aggregat['varighed'] / afleveret / 86400, 2) if afleveret else None,
+        'aabne': aabne,
+        'overskredne': overskredne,
+        'pr_dag': [{'dato': (_EPOKE + timedelta(days=d)).isoformat(),
+                    'antal': aggregat['pr_dag'].get(d, 0)}
+                   for d in range(foerste, foerste + dage)],
+        'mest_udlaante_boeger': [{'bog': kode, 'titel': titler(kode), 'antal': n}
+                                 for kode, n in flest(aggregat, 'pr_bog', top)],
+        'mest_aktive_brugere': [{'bruger': kode, 'navn': navne(kode), 'antal': n}
+                                for kode, n in flest(aggregat, 'pr_bruger', top)],
+    }
+
+def kontrol():
+    """Byg aggregatet over alle udlån i data/ med begge metoder og sammenlign"""
+    import csv_backend
+    rows = csv_backend._alle_udlaan()
+    tider = {}
+    resultater = {}
+    for navn, fn in (('python', _byg_python), ('numpy', _byg_numpy if np else None)):
+        if fn is None:
+            print(f'{navn}: ikke installeret')
+            continue
+        start = time.perf_counter()
+        resultater[navn] = fn(rows)
+        tider[navn] = time.perf_counter() - start
+        print(f'{navn}: {tider[navn] * 1000:.1f} ms for {len(rows)} udlån')
+    ens = len({repr(sorted((k, sorted(v.items()) if isinstance(v, Counter) else v)
+                           for k, v in r.items() if k != 'rang'))
+               for r in resultater.values()}) <= 1
+    print('Ens' if ens else 'FORSKELLIGE')
+    return ens
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Statistik over udlån')
+    parser.add_argument('kommando', choices=['kontrol'])
+    parser.parse_args()
+    raise SystemExit(0 if kontrol() else 1)